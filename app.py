@@ -3,11 +3,13 @@ import uuid
 import streamlit as st
 from PIL import Image
 
+from config import SPECULATIVE_EXECUTION
 from llm import (
     classify_question,
     compound_answer,
+    get_rag_chain,
     quantitative_answer,
-    rag_pipeline,
+    speculative_answer,
 )
 from src.app_utils import (
     assistent_message,
@@ -15,6 +17,7 @@ from src.app_utils import (
     stream_parser,
     user_message,
 )
+from src.tracing import new_trace
 
 
 if __name__ == "__main__":
@@ -43,13 +46,18 @@ if __name__ == "__main__":
                 user_message(msg["content"], i)
 
     if prompt := st.chat_input():
+        new_trace()
         with st.chat_message("user"):
             col1, col2 = st.columns([3, 1])
 
             with col1:
                 st.markdown(prompt)
             with col2:
-                question_class = classify_question(prompt)
+                if SPECULATIVE_EXECUTION:
+                    speculation = speculative_answer(prompt)
+                    question_class = speculation.question_class
+                else:
+                    question_class = classify_question(prompt)
                 options = ["Quantitative", "Qualitative", "Compound"]
                 option = st.selectbox(
                     "Question Type",
@@ -61,16 +69,19 @@ if __name__ == "__main__":
         st.session_state.messages.append({"role": "user", "content": prompt})
 
         with st.chat_message("assistant"):
-            if question_class.lower() == "compound":
+            if SPECULATIVE_EXECUTION:
+                MODEL_TYPE = speculation.model_type
+                stream = speculation.stream
+                context = speculation.context
+            elif question_class.lower() == "compound":
                 MODEL_TYPE = "ollama"
-                stream = compound_answer(prompt)
-                context = []
+                stream, context = compound_answer(prompt)
             elif question_class.lower() == "quantitative":
                 MODEL_TYPE = "ollama"
                 stream = quantitative_answer(prompt)
                 context = []
             elif question_class.lower() == "qualitative":
-                chain = rag_pipeline()
+                chain = get_rag_chain()
                 stream = chain.stream(input=prompt)
                 context = get_context(stream)
                 MODEL_TYPE = "langchain"
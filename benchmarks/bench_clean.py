@@ -0,0 +1,269 @@
+"""
+Benchmarks the old (row-wise apply) and new (vectorised) cleaning paths of src/pipeline.py.
+
+Synthetic review frames shaped like the raw CSV files of every source in MAPPINGS are generated
+at the requested sizes. Every stage of consolidation and clean is timed for both paths, the peak
+memory of every stage is measured in a separate run with tracemalloc, and the outputs of both
+paths are compared. The results are written as JSON and can be compared with a baseline to catch
+regressions.
+
+Usage (from the repository root):
+python -m benchmarks.bench_clean --sizes 10000,100000,1000000 --output bench_clean.json
+python -m benchmarks.bench_clean --baseline bench_clean.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import MAPPINGS
+from src.pipeline import (
+    add_contains_source_word,
+    add_likes_weighted,
+    add_weekday,
+    compact_types,
+    consolidation,
+    format_columns,
+)
+
+
+WORDS = [
+    "great",
+    "app",
+    "crashes",
+    "love",
+    "subscription",
+    "ads",
+    "music",
+    "update",
+    "slow",
+    "login",
+    "answers",
+    "movies",
+    "playlist",
+    "price",
+    "useless",
+]
+
+
+def synthetic_reviews(source: str, rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generates a raw review DataFrame with the column names of a source's CSV file.
+
+    About 2% of the rows are exact duplicates, 1% have no content and 10% mention the source.
+
+    Parameters:
+    source (str): The source whose raw columns are generated.
+    rows (int): The number of rows.
+    seed (int): The seed of the random generator.
+
+    Returns:
+    pd.DataFrame: The raw DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    words = rng.choice(WORDS, size=(rows, 6))
+    content = pd.Series([" ".join(row) for row in words], dtype=object)
+    mentions = rng.random(rows) < 0.1
+    content[mentions] = content[mentions] + f" {source.capitalize()}"
+    content[rng.random(rows) < 0.01] = None
+    dates = pd.Timestamp("2022-01-01") + pd.to_timedelta(
+        rng.integers(0, 2 * 365 * 24 * 3600, rows), unit="s"
+    )
+    values = {
+        "created_date": dates.astype(str),
+        "content": content,
+        "score": rng.integers(1, 6, rows),
+        "likes": rng.zipf(2.0, rows) - 1,
+        "name": rng.choice(["Anna", "Ben", "Chris", "Dana"], rows),
+    }
+    df = pd.DataFrame({raw: values[column] for raw, column in MAPPINGS[source].items()})
+    duplicates = df.sample(frac=0.02, random_state=seed)
+    return pd.concat([df, duplicates], ignore_index=True)
+
+
+def stages(
+    source: str, run_old_pipeline: bool
+) -> List[Tuple[str, Callable[[Any], Any]]]:
+    """
+    Returns the stages of consolidation and clean in the order they are applied.
+
+    Parameters:
+    source (str): The name of the source.
+    run_old_pipeline (bool): If True, uses the old pipeline, else the new pipeline.
+
+    Returns:
+    List[Tuple[str, Callable[[Any], Any]]]: The name and function of every stage.
+    """
+    return [
+        ("consolidation", lambda df: consolidation(df, source)),
+        ("drop_duplicates", lambda df: df.drop_duplicates().reset_index(drop=True)),
+        ("format_columns", format_columns),
+        ("weekday", lambda df: add_weekday(df, run_old_pipeline)),
+        (
+            "contains_source_word",
+            lambda df: add_contains_source_word(df, run_old_pipeline, source),
+        ),
+        (
+            "likes_weighted",
+            lambda df: add_likes_weighted(df, run_old_pipeline, df["likes"].mean()),
+        ),
+        ("compact_types", lambda df: compact_types(df, source)),
+    ]
+
+
+def run_stages(
+    raw: pd.DataFrame, source: str, run_old_pipeline: bool, measure_memory: bool
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+    Runs every stage on a copy of the raw DataFrame and measures it.
+
+    Parameters:
+    raw (pd.DataFrame): The raw DataFrame.
+    source (str): The name of the source.
+    run_old_pipeline (bool): If True, uses the old pipeline, else the new pipeline.
+    measure_memory (bool): If True, measures the peak memory instead of the duration.
+
+    Returns:
+    Tuple[pd.DataFrame, Dict[str, float]]: The cleaned DataFrame and the seconds or peak bytes of
+    every stage.
+    """
+    df = raw.copy()
+    results = {}
+    for name, stage in stages(source, run_old_pipeline):
+        if measure_memory:
+            tracemalloc.start()
+            df = stage(df)
+            results[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            df = stage(df)
+            results[name] = time.perf_counter() - start
+    return df, results
+
+
+def benchmark(sources: List[str], sizes: List[int]) -> List[Dict[str, Any]]:
+    """
+    Benchmarks both cleaning paths for every source and size.
+
+    Parameters:
+    sources (List[str]): The names of the sources.
+    sizes (List[int]): The numbers of rows.
+
+    Returns:
+    List[Dict[str, Any]]: One result per source, size and path.
+    """
+    results = []
+    for size in sizes:
+        for source in sources:
+            raw = synthetic_reviews(source, size)
+            outputs = {}
+            for path, run_old_pipeline in (("new", False), ("old", True)):
+                outputs[path], seconds = run_stages(
+                    raw, source, run_old_pipeline, False
+                )
+                _, peak_bytes = run_stages(raw, source, run_old_pipeline, True)
+                results.append(
+                    {
+                        "source": source,
+                        "rows": size,
+                        "path": path,
+                        "seconds": seconds,
+                        "total_seconds": sum(seconds.values()),
+                        "peak_bytes": peak_bytes,
+                    }
+                )
+                print(
+                    f"{source:<8} {size:>10} rows  {path}: "
+                    f"{sum(seconds.values()):8.3f}s  "
+                    f"peak {max(peak_bytes.values()) / 2**20:8.1f} MiB"
+                )
+            try:
+                pd.testing.assert_frame_equal(outputs["new"], outputs["old"])
+                identical = True
+            except AssertionError as e:
+                identical = False
+                print(f"{source} at {size} rows: outputs differ\n{e}")
+            for result in results[-2:]:
+                result["identical"] = identical
+    return results
+
+
+def regressions(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    """
+    Compares the stage durations with a baseline.
+
+    Parameters:
+    results (List[Dict[str, Any]]): The current results.
+    baseline (List[Dict[str, Any]]): The results of an earlier run.
+    tolerance (float): The allowed relative slowdown, e.g. 0.2 for 20%.
+
+    Returns:
+    List[str]: A description of every stage that got slower than allowed.
+    """
+    previous = {
+        (result["source"], result["rows"], result["path"]): result
+        for result in baseline
+    }
+    found = []
+    for result in results:
+        key = (result["source"], result["rows"], result["path"])
+        if key not in previous:
+            continue
+        for stage, seconds in result["seconds"].items():
+            before = previous[key]["seconds"].get(stage)
+            if before and seconds > before * (1 + tolerance):
+                found.append(
+                    f"{key}: {stage} took {seconds:.3f}s instead of {before:.3f}s"
+                )
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--sources", default=",".join(MAPPINGS))
+    parser.add_argument("--output", default="bench_clean.json")
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = benchmark(args.sources.split(","), sizes)
+    report = {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "created_at": time.time(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    failed = [
+        f"{r['source']} at {r['rows']} rows" for r in results if not r["identical"]
+    ]
+    if baseline is not None:
+        failed += regressions(results, baseline, args.tolerance)
+    for failure in failed:
+        print(f"FAILED: {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
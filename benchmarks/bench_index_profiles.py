@@ -0,0 +1,201 @@
+"""
+Compares the recall@10 and latency of the index profiles in INDEX_PROFILES.
+
+A sample of the embeddings in the live index is copied into one temporary index per profile.
+Held-out embeddings of the same sample are used as queries, and the results of every profile
+are compared with the results of the exact flat-float32 profile. The report is printed and
+written as JSON.
+
+Usage (from the repository root, with the pipeline already run):
+python -m benchmarks.bench_index_profiles --documents 10000 --queries 200
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import redis
+
+from config import (
+    INDEX_PROFILES,
+    REDIS_INDEX_ALIAS,
+    REDIS_INDEX_NAME,
+    REDIS_SCHEMA,
+    REDIS_URL,
+)
+from src.vector_index import (
+    VECTOR_DTYPES,
+    create_index,
+    document_count,
+    drop_index,
+    index_profile,
+    key_prefix,
+    knn_params,
+    knn_query,
+    resolve_index,
+    write_documents,
+)
+
+
+BASELINE_PROFILE = "flat-float32"
+
+
+def sample_vectors(client: redis.Redis, count: int) -> np.ndarray:
+    """
+    Reads up to count embeddings from the live index.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    count (int): The number of embeddings.
+
+    Returns:
+    np.ndarray: The embeddings as float32 matrix.
+    """
+    index_name = resolve_index(client, REDIS_INDEX_ALIAS) or REDIS_INDEX_NAME
+    dtype = VECTOR_DTYPES[index_profile(client, index_name)["datatype"]]
+    vectors = []
+    for key in client.scan_iter(match=f"{key_prefix(index_name)}*", count=1000):
+        vector = client.hget(key, "content_vector")
+        if vector is not None:
+            vectors.append(np.frombuffer(vector, dtype=dtype).astype(np.float32))
+        if len(vectors) == count:
+            break
+    return np.vstack(vectors)
+
+
+def build_index(
+    client: redis.Redis, name: str, profile_name: str, vectors: np.ndarray
+) -> float:
+    """
+    Creates a temporary index for a profile, fills it and waits until it is built.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the temporary index.
+    profile_name (str): The name of the index profile.
+    vectors (np.ndarray): The embeddings to index.
+
+    Returns:
+    float: The seconds until all documents were indexed.
+    """
+    start = time.perf_counter()
+    create_index(client, name, REDIS_SCHEMA, profile_name)
+    for offset in range(0, len(vectors), 500):
+        batch = vectors[offset : offset + 500]
+        write_documents(
+            client,
+            name,
+            INDEX_PROFILES[profile_name],
+            [str(offset + i) for i in range(len(batch))],
+            [""] * len(batch),
+            batch,
+            [{}] * len(batch),
+        )
+    document_count(client, name)
+    return time.perf_counter() - start
+
+
+def run_queries(
+    client: redis.Redis, name: str, profile: Dict[str, Any], queries: np.ndarray
+) -> Tuple[List[List[str]], List[float]]:
+    """
+    Runs a KNN query with k=10 for every query vector.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the index.
+    profile (Dict[str, Any]): The index profile.
+    queries (np.ndarray): The query vectors.
+
+    Returns:
+    Tuple[List[List[str]], List[float]]: The ids of the results and the latency in seconds of
+    every query.
+    """
+    query = knn_query(10, profile, [])
+    ids, latencies = [], []
+    for vector in queries:
+        start = time.perf_counter()
+        result = client.ft(name).search(query, query_params=knn_params(vector, profile))
+        latencies.append(time.perf_counter() - start)
+        ids.append([doc.id for doc in result.docs])
+    return ids, latencies
+
+
+def recall_at_10(results: List[List[str]], baseline: List[List[str]]) -> float:
+    """
+    Returns the mean share of the baseline results that were also found.
+
+    Parameters:
+    results (List[List[str]]): The ids of the results of every query.
+    baseline (List[List[str]]): The ids of the exact results of every query.
+
+    Returns:
+    float: The recall@10.
+    """
+    return float(
+        np.mean(
+            [
+                len(set(found) & set(exact)) / max(len(exact), 1)
+                for found, exact in zip(results, baseline)
+            ]
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--output", default="bench_index_profiles.json")
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(REDIS_URL)
+    vectors = sample_vectors(client, args.documents + args.queries)
+    documents, queries = vectors[: -args.queries], vectors[-args.queries :]
+
+    profiles = [BASELINE_PROFILE] + [p for p in INDEX_PROFILES if p != BASELINE_PROFILE]
+    results, baseline = [], None
+    for name in profiles:
+        profile = INDEX_PROFILES[name]
+        index_name = f"bench-{name}"
+        try:
+            build_seconds = build_index(client, index_name, name, documents)
+            ids, latencies = run_queries(client, index_name, profile, queries)
+            info = client.ft(index_name).info()
+        finally:
+            drop_index(client, index_name)
+        if baseline is None:
+            baseline = ids
+        results.append(
+            {
+                "profile": name,
+                **profile,
+                "documents": len(documents),
+                "queries": len(queries),
+                "recall_at_10": recall_at_10(ids, baseline),
+                "latency_mean_ms": 1000 * float(np.mean(latencies)),
+                "latency_p95_ms": 1000 * float(np.percentile(latencies, 95)),
+                "build_seconds": build_seconds,
+                "vector_index_mb": float(info.get("vector_index_sz_mb", "nan")),
+            }
+        )
+
+    print(
+        f"{'profile':<14}{'recall@10':>10}{'mean ms':>10}{'p95 ms':>10}"
+        f"{'build s':>10}{'index MB':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['profile']:<14}{result['recall_at_10']:>10.3f}"
+            f"{result['latency_mean_ms']:>10.2f}{result['latency_p95_ms']:>10.2f}"
+            f"{result['build_seconds']:>10.1f}{result['vector_index_mb']:>10.1f}"
+        )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Compares the in-process NumPy retriever with the Redis vector index it was exported from.
+
+Exported embeddings are used as queries. Every query is run against Redis and against the NumPy
+index one by one, and the NumPy index is additionally searched in batches. The recall@k of the NumPy
+results is computed against the results of Redis, which are exact for a FLAT index, and the
+report is printed and written as JSON.
+
+Usage (from the repository root, with the pipeline run and the index exported by export_index.py):
+python -m benchmarks.bench_numpy_index --queries 200 --filters "*,@source:{netflix}"
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import redis
+from langchain_community.embeddings import OllamaEmbeddings
+
+from config import EMBEDDING_MODEL, NUMPY_INDEX_DIR, REDIS_SCHEMA, REDIS_URL
+from src.numpy_index import NumpyKNNRetriever, NumpyVectorIndex
+from src.vector_index import (
+    RedisKNNRetriever,
+    index_profile,
+    load_schema,
+    metadata_fields,
+)
+
+
+def time_searches(
+    search: Callable[[List[float]], List[Any]], queries: np.ndarray
+) -> Tuple[List[List[str]], List[float]]:
+    """
+    Runs a search for every query vector.
+
+    Parameters:
+    search (Callable[[List[float]], List[Any]]): The search returning the documents of a vector.
+    queries (np.ndarray): The query vectors.
+
+    Returns:
+    Tuple[List[List[str]], List[float]]: The ids of the results and the latency in seconds of
+    every query.
+    """
+    ids, latencies = [], []
+    for vector in queries:
+        start = time.perf_counter()
+        documents = search(vector.tolist())
+        latencies.append(time.perf_counter() - start)
+        ids.append([doc.metadata["id"] for doc in documents])
+    return ids, latencies
+
+
+def recall_at_k(results: List[List[str]], baseline: List[List[str]]) -> float:
+    """
+    Returns the mean share of the baseline results that were also found.
+
+    Parameters:
+    results (List[List[str]]): The ids of the results of every query.
+    baseline (List[List[str]]): The ids of the exact results of every query.
+
+    Returns:
+    float: The recall@k.
+    """
+    return float(
+        np.mean(
+            [
+                len(set(found) & set(exact)) / max(len(exact), 1)
+                for found, exact in zip(results, baseline)
+            ]
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--directory", default=NUMPY_INDEX_DIR)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--filters", default="*")
+    parser.add_argument("--output", default="bench_numpy_index.json")
+    args = parser.parse_args()
+
+    index = NumpyVectorIndex(args.directory)
+    client = redis.Redis.from_url(REDIS_URL)
+    index_name = index.meta["index_name"]
+    profile = index_profile(client, index_name)
+    if profile["algorithm"] != "FLAT":
+        print(
+            f"{index_name} is an {profile['algorithm']} index, its results are approximate"
+        )
+
+    fields = metadata_fields(load_schema(REDIS_SCHEMA))
+    embedder = OllamaEmbeddings(model=EMBEDDING_MODEL)
+    redis_retriever = RedisKNNRetriever(
+        client=client,
+        index_name=index_name,
+        embedder=embedder,
+        profile=profile,
+        fields=fields,
+        k=args.k,
+    )
+    numpy_retriever = NumpyKNNRetriever(
+        index=index, embedder=embedder, fields=fields, k=args.k
+    )
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(index), size=min(args.queries, len(index)), replace=False)
+    queries = np.asarray(index.vectors[np.sort(rows)], dtype=np.float32)
+
+    results: List[Dict[str, Any]] = []
+    for filter_expression in args.filters.split(","):
+        # Warm up the page cache of the memory map and the filter mask
+        numpy_retriever.batch_search(queries[: args.batch].tolist(), filter_expression)
+
+        redis_ids, redis_latencies = time_searches(
+            lambda v: redis_retriever.search(v, filter_expression), queries
+        )
+        numpy_ids, numpy_latencies = time_searches(
+            lambda v: numpy_retriever.search(v, filter_expression), queries
+        )
+        start = time.perf_counter()
+        for offset in range(0, len(queries), args.batch):
+            numpy_retriever.batch_search(
+                queries[offset : offset + args.batch].tolist(), filter_expression
+            )
+        batch_seconds = time.perf_counter() - start
+
+        results.append(
+            {
+                "filter": filter_expression,
+                "documents": len(index),
+                "queries": len(queries),
+                "dtype": index.meta["dtype"],
+                "recall_at_k": recall_at_k(numpy_ids, redis_ids),
+                "redis_mean_ms": 1000 * float(np.mean(redis_latencies)),
+                "redis_p95_ms": 1000 * float(np.percentile(redis_latencies, 95)),
+                "numpy_mean_ms": 1000 * float(np.mean(numpy_latencies)),
+                "numpy_p95_ms": 1000 * float(np.percentile(numpy_latencies, 95)),
+                "numpy_batch_ms_per_query": 1000 * batch_seconds / len(queries),
+                "numpy_index_mb": os.path.getsize(
+                    os.path.join(args.directory, "vectors.bin")
+                )
+                / 2**20,
+            }
+        )
+
+    print(
+        f"{'filter':<22}{'recall':>8}{'redis ms':>10}{'p95':>8}{'numpy ms':>10}{'p95':>8}"
+        f"{'batch ms':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['filter']:<22}{result['recall_at_k']:>8.3f}"
+            f"{result['redis_mean_ms']:>10.2f}{result['redis_p95_ms']:>8.2f}"
+            f"{result['numpy_mean_ms']:>10.2f}{result['numpy_p95_ms']:>8.2f}"
+            f"{result['numpy_batch_ms_per_query']:>10.2f}"
+        )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
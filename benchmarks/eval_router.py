@@ -0,0 +1,144 @@
+"""
+Compares the accuracy and latency of the local question router with the LLM classifier.
+
+Every question of the eval split of ROUTER_EXAMPLES is classified by the router, which is fitted on
+the train split, and by the LLM classifier with the response cache bypassed. For several confidence
+margins the share of questions falling back to the LLM and the accuracy and mean latency of the
+combined classifier are reported. The report is printed and written as JSON.
+
+Usage (from the repository root, with Ollama running):
+python -m benchmarks.eval_router --margins 0,0.01,0.02,0.05
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from config import ROUTER_EXAMPLES
+from llm import classify_question_llm, route_question
+from src.router import load_examples
+
+
+def latency_stats(latencies: List[float]) -> Dict[str, float]:
+    """
+    Summarises latencies in milliseconds.
+
+    Parameters:
+    latencies (List[float]): The latencies in seconds.
+
+    Returns:
+    Dict[str, float]: The mean, median and 95th percentile in milliseconds.
+    """
+    return {
+        "mean_ms": 1000 * float(np.mean(latencies)),
+        "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+        "p95_ms": 1000 * float(np.percentile(latencies, 95)),
+    }
+
+
+def evaluate(margins: List[float]) -> Dict[str, Any]:
+    """
+    Classifies the eval split with both classifiers and combines them at every margin.
+
+    Parameters:
+    margins (List[float]): The confidence margins below which the LLM is used.
+
+    Returns:
+    Dict[str, Any]: The accuracy and latency of both classifiers and of every combination.
+    """
+    examples = load_examples(ROUTER_EXAMPLES, "eval")
+    # Fits the router (or loads its centroids) before measuring
+    route_question(examples[0][0])
+
+    rows = []
+    for question, label in examples:
+        start = time.perf_counter()
+        routed, margin = route_question(question)
+        router_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        classified = classify_question_llm(question, use_cache=False).strip().lower()
+        llm_seconds = time.perf_counter() - start
+
+        rows.append(
+            {
+                "question": question,
+                "label": label,
+                "router": routed,
+                "margin": margin,
+                "router_seconds": router_seconds,
+                "llm": classified,
+                "llm_seconds": llm_seconds,
+            }
+        )
+
+    combined = []
+    for threshold in margins:
+        fallback = [row["margin"] < threshold for row in rows]
+        predictions = [
+            row["llm"] if use_llm else row["router"]
+            for row, use_llm in zip(rows, fallback)
+        ]
+        latencies = [
+            row["router_seconds"] + (row["llm_seconds"] if use_llm else 0.0)
+            for row, use_llm in zip(rows, fallback)
+        ]
+        combined.append(
+            {
+                "margin": threshold,
+                "fallback_rate": float(np.mean(fallback)),
+                "accuracy": float(
+                    np.mean([p == row["label"] for p, row in zip(predictions, rows)])
+                ),
+                **latency_stats(latencies),
+            }
+        )
+
+    return {
+        "questions": len(rows),
+        "router": {
+            "accuracy": float(np.mean([row["router"] == row["label"] for row in rows])),
+            **latency_stats([row["router_seconds"] for row in rows]),
+        },
+        "llm": {
+            "accuracy": float(np.mean([row["llm"] == row["label"] for row in rows])),
+            **latency_stats([row["llm_seconds"] for row in rows]),
+        },
+        "combined": combined,
+        "rows": rows,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--margins", default="0,0.01,0.02,0.05")
+    parser.add_argument("--output", default="bench_router.json")
+    args = parser.parse_args()
+
+    report = evaluate([float(margin) for margin in args.margins.split(",")])
+
+    print(
+        f"{'classifier':<16}{'accuracy':>10}{'fallback':>10}{'mean ms':>10}{'p95 ms':>10}"
+    )
+    for name in ("router", "llm"):
+        result = report[name]
+        print(
+            f"{name:<16}{result['accuracy']:>10.3f}{'':>10}"
+            f"{result['mean_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+        )
+    for result in report["combined"]:
+        print(
+            f"{'margin ' + str(result['margin']):<16}{result['accuracy']:>10.3f}"
+            f"{result['fallback_rate']:>10.2f}"
+            f"{result['mean_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+        )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
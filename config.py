@@ -24,6 +24,114 @@ DATA_ROOT = "data"
 
 REDIS_URL = "redis://localhost:6379"
 
+REDIS_MAX_CONNECTIONS = 16
+
+# Number of documents written per Redis pipeline during ingestion
+REDIS_WRITE_BATCH_SIZE = 500
+
+# Alias the app queries, it points to the current physical index (see reindex.py)
+REDIS_INDEX_ALIAS = "reviews-main"
+
+# Physical index used by main.py as long as the alias does not exist yet
 REDIS_INDEX_NAME = "reviews-main-v5"
 
 REDIS_SCHEMA = "redis_schema.yaml"
+
+# Vector index settings applied on top of the vector field of REDIS_SCHEMA
+INDEX_PROFILES = {
+    "flat-float32": {"algorithm": "FLAT", "datatype": "FLOAT32"},
+    "flat-float16": {"algorithm": "FLAT", "datatype": "FLOAT16"},
+    "hnsw-float32": {
+        "algorithm": "HNSW",
+        "datatype": "FLOAT32",
+        "m": 16,
+        "ef_construction": 200,
+        "ef_runtime": 20,
+    },
+    "hnsw-float16": {
+        "algorithm": "HNSW",
+        "datatype": "FLOAT16",
+        "m": 16,
+        "ef_construction": 200,
+        "ef_runtime": 20,
+    },
+}
+
+REDIS_INDEX_PROFILE = "flat-float32"
+
+CHAT_MODEL = "llama3"
+
+EMBEDDING_MODEL = "llama3"
+
+# Interval at which the app checks whether the alias points to an index with another profile
+RAG_CHAIN_REFRESH_SECONDS = 60
+
+# Maximum estimated tokens of the retrieved reviews in the RAG prompt, and of a single review
+CONTEXT_TOKEN_BUDGET = 1200
+CONTEXT_MAX_DOC_TOKENS = 300
+# Word trigram overlap from which a retrieved review is dropped as near-duplicate of a better one
+CONTEXT_DUPLICATE_THRESHOLD = 0.8
+# Weight of diversity over relevance when ordering the retrieved reviews (maximal marginal relevance)
+CONTEXT_DIVERSITY = 0.3
+
+# Restrict the KNN search to the source, score, weekday and dates a question asks about
+RETRIEVAL_PREFILTER = True
+
+# "redis" searches the vector index in Redis, "numpy" searches the snapshot written by export_index.py
+# in the memory of the process
+RETRIEVER_BACKEND = "redis"
+NUMPY_INDEX_DIR = ".cache/numpy_index"
+# dtype of the exported vectors, "float16" halves the memory at a small loss of precision
+NUMPY_INDEX_DTYPE = "float32"
+
+EMBEDDING_CACHE_DIR = ".cache/embeddings"
+
+EMBEDDING_CACHE_SIZE = 100_000
+
+FRAME_CACHE_DIR = ".cache/frames"
+
+ROUTER_EXAMPLES = "router_examples.yaml"
+
+ROUTER_CACHE_DIR = ".cache/router"
+
+# Minimum similarity margin of the local router over the second best class, below it the LLM
+# classifies the question. None always uses the LLM
+ROUTER_MIN_MARGIN = 0.02
+
+# In-process entries of the response cache in front of the Redis tier
+RESPONSE_CACHE_SIZE = 1024
+
+RESPONSE_CACHE_TTL = 24 * 3600
+
+# Maximum number of entries per kind of request in Redis
+RESPONSE_CACHE_MAX_ENTRIES = 10_000
+
+# Cosine similarity above which the cached classification of a similar question is reused,
+# None disables the semantic tier
+SEMANTIC_CACHE_THRESHOLD = None
+
+# Classify, retrieve and generate the quantitative query of a question concurrently in the app
+SPECULATIVE_EXECUTION = True
+
+# Threads shared by the speculative tasks of all questions, three per concurrent question
+SPECULATION_WORKERS = 12
+
+# Concurrent requests and waiting requests per backend of server.py
+SERVER_BACKENDS = {
+    "ollama": {"concurrency": 2, "queue_size": 8},
+    "redis": {"concurrency": 16, "queue_size": 64},
+}
+
+# Maximum number of sub-questions a compound question is split into, they are answered concurrently
+COMPOUND_MAX_QUESTIONS = 4
+# Threads reading the answers of the sub-questions after the first one while the first is streamed,
+# apart from the speculative tasks so long answers cannot starve them
+COMPOUND_PUMP_WORKERS = 12
+
+# Answer quantitative questions from the per-source rollups written by main.py where possible
+ROLLUPS_ENABLED = True
+# Seconds the rollups are cached in a process before they are reloaded from Redis
+ROLLUP_REFRESH_SECONDS = 60
+
+# Records the duration of every stage of a request as JSON logs and Prometheus histograms
+TRACING_ENABLED = False
@@ -0,0 +1,51 @@
+"""
+Exports the vector index for the in-process NumPy retriever.
+
+The embeddings and metadata of the index behind REDIS_INDEX_ALIAS are written to NUMPY_INDEX_DIR,
+where the retriever of the app memory-maps them if RETRIEVER_BACKEND is set to "numpy". The export
+is a snapshot, run it again after main.py or reindex.py changed the index.
+
+Usage (from the repository root, with the pipeline already run):
+python export_index.py --dtype float16
+"""
+
+import argparse
+import time
+
+from config import (
+    NUMPY_INDEX_DIR,
+    NUMPY_INDEX_DTYPE,
+    REDIS_INDEX_ALIAS,
+    REDIS_INDEX_NAME,
+    REDIS_SCHEMA,
+)
+from llm import redis_client
+from src.numpy_index import export_index
+from src.vector_index import load_schema, metadata_fields, resolve_index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--directory", default=NUMPY_INDEX_DIR)
+    parser.add_argument(
+        "--dtype", choices=["float32", "float16"], default=NUMPY_INDEX_DTYPE
+    )
+    args = parser.parse_args()
+
+    index_name = resolve_index(redis_client, REDIS_INDEX_ALIAS) or REDIS_INDEX_NAME
+    start = time.perf_counter()
+    count = export_index(
+        redis_client,
+        index_name,
+        args.directory,
+        metadata_fields(load_schema(REDIS_SCHEMA)),
+        args.dtype,
+    )
+    print(
+        f"Exported {count} documents of {index_name} to {args.directory} "
+        f"as {args.dtype} in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,322 @@
-from typing import Any, Dict
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import ollama
 import pandas as pd
 import redis
 from langchain_community.chat_models import ChatOllama
 from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.vectorstores.redis import Redis
+from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
-from redis.commands.search.query import Query
-
-from config import REDIS_INDEX_NAME, REDIS_SCHEMA, REDIS_URL
+from langchain_core.runnables import Runnable, RunnableParallel, RunnablePassthrough
+
+from config import (
+    CHAT_MODEL,
+    COMPOUND_MAX_QUESTIONS,
+    COMPOUND_PUMP_WORKERS,
+    CONTEXT_DIVERSITY,
+    CONTEXT_DUPLICATE_THRESHOLD,
+    CONTEXT_MAX_DOC_TOKENS,
+    CONTEXT_TOKEN_BUDGET,
+    EMBEDDING_MODEL,
+    NUMPY_INDEX_DIR,
+    RAG_CHAIN_REFRESH_SECONDS,
+    REDIS_INDEX_ALIAS,
+    REDIS_INDEX_NAME,
+    REDIS_INDEX_PROFILE,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_SCHEMA,
+    REDIS_URL,
+    REDIS_WRITE_BATCH_SIZE,
+    RETRIEVAL_PREFILTER,
+    RETRIEVER_BACKEND,
+    ROLLUP_REFRESH_SECONDS,
+    ROLLUPS_ENABLED,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    ROUTER_CACHE_DIR,
+    ROUTER_EXAMPLES,
+    ROUTER_MIN_MARGIN,
+    SEMANTIC_CACHE_THRESHOLD,
+    SPECULATION_WORKERS,
+)
 from prompts import (
     CLASSIFICATION_PROMPT,
     COMPOUND_PROMPT,
     QUANTITATIVE_PROMPT,
+    QUERY_RETRY_PROMPT,
     RAG_PIPELINE,
     REPHRASE_PROMPT,
 )
+from src.compound import (
+    SubAnswer,
+    chunk_text,
+    merged_context,
+    parse_sub_questions,
+    part_header,
+)
+from src.context import assemble_context, estimate_tokens
+from src.embedding_cache import CachedEmbeddings, EmbeddingCache
+from src.filters import extract_filters
+from src.incremental import document_ids
+from src.ingestion import embed_batches, iter_batches, metadata_records
+from src.numpy_index import (
+    NumpyKNNRetriever,
+    NumpyVectorIndex,
+    exported_fields,
+    snapshot_version,
+)
+from src.aggregation import (
+    aggregate_answer,
+    aggregate_request,
+    canonical_request,
+    is_plan,
+    parse_plan,
+    sortable_fields,
+)
+from src.query_parser import QueryError, count_query, query_fields
+from src.redis_writer import BulkWriter
+from src.response_cache import ResponseCache, cache_stream, replay_stream
+from src.rollups import (
+    load_rollups,
+    missing_sources,
+    rollup_answer,
+    rollups_version,
+)
+from src.router import CentroidRouter, load_examples
+from src.tracing import record, span
+from src.vector_index import (
+    RedisKNNRetriever,
+    create_index,
+    index_profile,
+    indexed_fields,
+    load_schema,
+    metadata_fields,
+    resolve_index,
+)
+
 
+redis_pool = redis.ConnectionPool.from_url(
+    REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+rs = redis_client.ft(REDIS_INDEX_ALIAS)
+
+_rag_chain_lock = threading.Lock()
+_rag_components: Optional["RagComponents"] = None
+_rag_chain_profile: Optional[Dict[str, Any]] = None
+_rag_chain_checked_at = 0.0
+rag_chain_stats = {"builds": 0, "build_seconds": 0.0, "built_at": None}
+
+query_embedder = OllamaEmbeddings(model=EMBEDDING_MODEL)
+
+response_cache = ResponseCache(
+    redis_client,
+    capacity=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    embedder=query_embedder if SEMANTIC_CACHE_THRESHOLD is not None else None,
+    similarity_threshold=SEMANTIC_CACHE_THRESHOLD,
+)
 
-redis_client = redis.Redis.from_url(REDIS_URL)
-rs = redis_client.ft(REDIS_INDEX_NAME)
+_speculation_executor = ThreadPoolExecutor(
+    max_workers=SPECULATION_WORKERS, thread_name_prefix="speculation"
+)
+_pump_executor = ThreadPoolExecutor(
+    max_workers=COMPOUND_PUMP_WORKERS, thread_name_prefix="compound-pump"
+)
 
+_router_lock = threading.Lock()
+_router: Optional[CentroidRouter] = None
 
-def _format_docs(docs):
-    return "\n\n".join(doc.page_content for doc in docs)
+schema_fields = query_fields(load_schema(REDIS_SCHEMA))
+schema_sortable = sortable_fields(load_schema(REDIS_SCHEMA))
 
+_rollups_lock = threading.Lock()
+_rollups: Dict[str, Dict[str, Any]] = {}
+_rollups_loaded_at = float("-inf")
+_rollups_version: Optional[int] = None
 
-def quantitative_answer(question: str) -> Dict[str, Any]:
+_filter_fields_lock = threading.Lock()
+_filter_fields: Dict[str, str] = {}
+_filter_fields_loaded_at = float("-inf")
+
+
+def _format_docs(inputs: Dict[str, Any]) -> str:
+    start = time.perf_counter()
+    context, stats = assemble_context(
+        inputs["context"],
+        CONTEXT_TOKEN_BUDGET,
+        CONTEXT_MAX_DOC_TOKENS,
+        CONTEXT_DUPLICATE_THRESHOLD,
+        CONTEXT_DIVERSITY,
+    )
+    stats["prompt_tokens"] = estimate_tokens(
+        RAG_PIPELINE.format(context=context, question=inputs["question"])
+    )
+    record("context.assemble", time.perf_counter() - start, **stats)
+    print(
+        f"Context: {stats['docs_out']}/{stats['docs_in']} reviews, "
+        f"{stats['tokens_out']}/{stats['tokens_in']} tokens, "
+        f"prompt ~{stats['prompt_tokens']} tokens"
+    )
+    return context
+
+
+def generate_quantitative_query(question: str) -> str:
     """
-    Generates a quantitative answer for a given question using the Ollama chat model.
+    Generates the RediSearch query that answers a quantitative question using the Ollama chat model.
 
     This function sends a chat request to the Ollama chat model with a system role message
     containing a predefined QUANTITATIVE_PROMPT and a user role message containing the question.
+    The content of the response is either a query counting the matching reviews or an aggregation
+    plan as JSON. It is validated against the fields of the index schema and normalised with
+    canonical_request. If it is not valid, the chat model is asked once to correct it, passing on
+    the parse error, before giving up with "na". Queries are served from the response cache if
+    possible.
 
-    It then extracts the content of the message from the chat model's response, replaces all
-    parentheses with square brackets, and prints the query.
+    Parameters:
+    question (str): The question to be answered.
 
-    If the query is not "na", it performs a search using the query and sets the total number
-    of results as the answer. If the query is "na", it sets the answer as "na".
+    Returns:
+    str: The canonical query or aggregation plan, or "na" if the question cannot be answered with
+    a query.
+    """
+    cached = response_cache.get("query", question, QUANTITATIVE_PROMPT, CHAT_MODEL)
+    if cached is not None:
+        # Entries written before queries were validated may not parse
+        try:
+            return canonical_request(cached, schema_fields)
+        except QueryError:
+            pass
+    messages = [
+        {
+            "role": "system",
+            "content": QUANTITATIVE_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": question,
+        },
+    ]
+    query = "na"
+    for attempt in range(2):
+        with span("query_generation.llm", model=CHAT_MODEL, attempt=attempt):
+            query_dict = ollama.chat(model=CHAT_MODEL, messages=messages)
+        content = query_dict["message"]["content"]
+        try:
+            query = canonical_request(content, schema_fields)
+            break
+        except QueryError as error:
+            messages += [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": QUERY_RETRY_PROMPT.format(error=error)},
+            ]
+    response_cache.put("query", question, QUANTITATIVE_PROMPT, CHAT_MODEL, query)
+    return query
+
+
+def get_rollups() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the rollups of the index behind the alias.
+
+    The rollups are reloaded as soon as their version changes, i.e. the pipeline wrote new rollups
+    or reindex.py swapped the alias, and at least every ROLLUP_REFRESH_SECONDS. If a source of the
+    index has no rollup, no query is answered from the rollups.
+
+    Returns:
+    Dict[str, Dict[str, Any]]: The rollup of every source, empty if there are none.
+    """
+    global _rollups, _rollups_loaded_at, _rollups_version
+    version = rollups_version(redis_client)
+    if (
+        version == _rollups_version
+        and time.monotonic() - _rollups_loaded_at < ROLLUP_REFRESH_SECONDS
+    ):
+        return _rollups
+    with _rollups_lock:
+        if (
+            version != _rollups_version
+            or time.monotonic() - _rollups_loaded_at >= ROLLUP_REFRESH_SECONDS
+        ):
+            index_name = resolve_index(redis_client, REDIS_INDEX_ALIAS)
+            _rollups = load_rollups(redis_client, index_name) if index_name else {}
+            missing = (
+                missing_sources(redis_client, index_name, _rollups)
+                if _rollups
+                else set()
+            )
+            if missing:
+                # Totals over all sources would leave them out
+                print(
+                    f"No rollups for {', '.join(sorted(missing))}, run python main.py to write "
+                    "them, answering from the index until then"
+                )
+                _rollups = {}
+            _rollups_loaded_at = time.monotonic()
+            _rollups_version = version
+    return _rollups
+
+
+def execute_quantitative_query(query: str) -> str:
+    """
+    Executes a query or aggregation plan as returned by generate_quantitative_query.
+
+    If ROLLUPS_ENABLED is set, queries the rollups can answer are answered from them without
+    searching. Other queries count the matching reviews without fetching any of them, aggregation
+    plans are computed inside Redis with FT.AGGREGATE.
+
+    Parameters:
+    query (str): The canonical query or aggregation plan.
+
+    Returns:
+    str: The count or the formatted aggregation, or "na" if the query is "na".
+    """
+    if query == "na":
+        return "na"
+    if ROLLUPS_ENABLED:
+        with span("rollups", query=query):
+            answer = rollup_answer(query, get_rollups(), schema_fields)
+        if answer is not None:
+            return answer
+    if is_plan(query):
+        plan = parse_plan(query, schema_fields)
+        with span("redis.aggregate", query=query):
+            result = rs.aggregate(aggregate_request(plan, schema_sortable))
+        return aggregate_answer(plan, result.rows)
+    with span("redis.search", query=query):
+        return str(rs.search(count_query(query)).total)
+
+
+def quantitative_answer(question: str, query: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Generates a quantitative answer for a given question using the Ollama chat model.
+
+    This function generates a query for the question with generate_quantitative_query, unless
+    a query generated in advance is given, and prints the query.
+
+    The query or aggregation plan is executed with execute_quantitative_query, which sets the
+    answer to "na" if the query is "na".
 
     It then rephrases the answer using the rephrase_answer function and returns the rephrased answer.
 
     Parameters:
     question (str): The question to be answered.
+    query (Optional[str]): The query generated for the question, if already known.
 
     Returns:
     Dict[str, Any]: The rephrased answer stream from the Ollama chat model.
     """
-    query_dict = ollama.chat(
-        model="llama3",
-        messages=[
-            {
-                "role": "system",
-                "content": QUANTITATIVE_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": question,
-            },
-        ],
-    )
-    query = query_dict["message"]["content"].replace("(", "[").replace(")", "]")
+    if query is None:
+        query = generate_quantitative_query(question)
     print(query)
-    if query != "na":
-        answer = rs.search(Query(query)).total
-    else:
-        answer = "na"
+    answer = execute_quantitative_query(query)
     stream = rephrase_answer(question, answer)
     return stream
 
@@ -80,7 +328,8 @@ def rephrase_answer(question: str, answer: str) -> Dict[str, Any]:
     This function sends a chat request to the Ollama chat model with a system role message
     containing a predefined REPHRASE_PROMPT and a user role message containing the question
     and answer in the format "Question: {question} Answer: {answer}". The chat model is set
-    to stream the response.
+    to stream the response. Rephrased answers are served from the response cache if possible
+    and replayed as a stream of a single chunk.
 
     Parameters:
     question (str): The original question.
@@ -89,8 +338,12 @@ def rephrase_answer(question: str, answer: str) -> Dict[str, Any]:
     Returns:
     Dict[str, Any]: The rephrased answer stream from the Ollama chat model.
     """
+    message = f"Question: {question} Answer: {answer}"
+    cached = response_cache.get("rephrase", message, REPHRASE_PROMPT, CHAT_MODEL)
+    if cached is not None:
+        return replay_stream(cached)
     stream = ollama.chat(
-        model="llama3",
+        model=CHAT_MODEL,
         stream=True,
         messages=[
             {
@@ -99,151 +352,613 @@ def rephrase_answer(question: str, answer: str) -> Dict[str, Any]:
             },
             {
                 "role": "user",
-                "content": f"Question: {question} Answer: {answer}",
+                "content": message,
             },
         ],
     )
-    return stream
+    return cache_stream(
+        stream, response_cache, "rephrase", message, REPHRASE_PROMPT, CHAT_MODEL
+    )
 
 
-def compound_answer(question: str) -> Dict[str, Any]:
+def decompose_question(question: str) -> List[str]:
     """
-    Generates a compound answer for a given question using the Ollama chat model.
+    Splits a compound question into its sub-questions using the Ollama chat model.
 
-    This function sends a chat request to the Ollama chat model with a system role message
-    containing a predefined COMPOUND_PROMPT and a user role message containing the question.
-    The chat model is set to stream the response.
+    The response of the chat model is served from the response cache if possible.
+
+    Parameters:
+    question (str): The compound question.
+
+    Returns:
+    List[str]: At most COMPOUND_MAX_QUESTIONS sub-questions.
+    """
+    response = response_cache.get("decompose", question, COMPOUND_PROMPT, CHAT_MODEL)
+    if response is None:
+        with span("compound.decompose", model=CHAT_MODEL):
+            response = ollama.chat(
+                model=CHAT_MODEL,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": COMPOUND_PROMPT,
+                    },
+                    {
+                        "role": "user",
+                        "content": question,
+                    },
+                ],
+            )["message"]["content"]
+        response_cache.put("decompose", question, COMPOUND_PROMPT, CHAT_MODEL, response)
+    return parse_sub_questions(response, question, COMPOUND_MAX_QUESTIONS)
+
+
+def answer_part(question: str) -> SubAnswer:
+    """
+    Classifies a sub-question of a compound question and starts its answer.
+
+    Quantitative sub-questions are answered by quantitative_answer, all others by the RAG pipeline,
+    so a sub-question that is classified as compound again is not split any further.
+
+    Parameters:
+    question (str): The sub-question.
+
+    Returns:
+    SubAnswer: The class of the sub-question, its answer stream and the retrieved reviews.
+    """
+    question_class = classify_question(question).strip().lower()
+    if question_class == "quantitative":
+        stream = quantitative_answer(question)
+        return SubAnswer(question, question_class, stream, [], "ollama")
+    components = get_rag_components()
+    context = components.retriever.invoke(question)
+    stream = components.answer_chain.stream({"context": context, "question": question})
+    return SubAnswer(question, "qualitative", stream, context, "langchain")
+
+
+def _close(part: SubAnswer) -> None:
+    # Closing the stream of a sub-question stops its generation
+    if hasattr(part.stream, "close"):
+        part.stream.close()
+
+
+def _close_prepared(future: Future) -> None:
+    # Closes the answer of a sub-question that is not needed anymore
+    if not future.cancelled() and future.exception() is None:
+        _close(future.result())
+
+
+def _pump(part: SubAnswer, chunks: queue.Queue, stop: threading.Event) -> None:
+    # Reads the answer of a sub-question into a queue, ended by None, until stop is set
+    try:
+        for chunk in part.stream:
+            if stop.is_set():
+                break
+            text = chunk_text(chunk, part.model_type)
+            if text:
+                chunks.put(text)
+    except Exception as error:
+        chunks.put(error)
+    finally:
+        _close(part)
+    chunks.put(None)
+
+
+def merge_answers(parts: List[SubAnswer]) -> Iterable[Dict[str, Any]]:
+    """
+    Merges the answers of the sub-questions into a single answer stream.
+
+    The answers of all sub-questions are generated concurrently. The answer of the first
+    sub-question is streamed as it is generated while the others are buffered by threads of a pool
+    of their own, so each following answer is complete or already partly generated when its turn
+    comes. Every answer is headed by its sub-question if there are several. If the merged stream
+    fails or is closed early, the generation of the other answers is stopped.
+
+    Parameters:
+    parts (List[SubAnswer]): The answers of the sub-questions, as returned by answer_part.
+
+    Returns:
+    Iterable[Dict[str, Any]]: The merged answer stream in the format of the Ollama chat model.
+    """
+    queues = [queue.Queue() for _ in parts]
+    stop = threading.Event()
+    # The first answer is read by the consumer, the pumps must not hold the speculation threads
+    for part, chunks in zip(parts[1:], queues[1:]):
+        _pump_executor.submit(copy_context().run, _pump, part, chunks, stop)
+
+    def stream() -> Iterable[Dict[str, Any]]:
+        try:
+            for position, (part, chunks) in enumerate(zip(parts, queues)):
+                if len(parts) > 1:
+                    yield {"message": {"content": part_header(part.question, position)}}
+                if position == 0:
+                    try:
+                        for chunk in part.stream:
+                            text = chunk_text(chunk, part.model_type)
+                            if text:
+                                yield {"message": {"content": text}}
+                    finally:
+                        _close(part)
+                    continue
+                while (text := chunks.get()) is not None:
+                    if isinstance(text, Exception):
+                        raise text
+                    yield {"message": {"content": text}}
+        finally:
+            stop.set()
+
+    return stream()
+
+
+def compound_answer(question: str) -> Tuple[Iterable[Dict[str, Any]], List[Document]]:
+    """
+    Answers a compound question by answering its sub-questions concurrently.
+
+    The question is split into sub-questions with decompose_question. Every sub-question is
+    classified and answered by the quantitative or the qualitative agent on the shared thread pool,
+    so the answer takes about as long as its slowest part, and the answers are merged with
+    merge_answers. If a sub-question cannot be answered, the sub-questions that did not start yet
+    are cancelled and the answers of the others are not generated.
 
     Parameters:
     question (str): The question to be answered.
 
     Returns:
-    Dict[str, Any]: The answer stream from the Ollama chat model.
+    Tuple[Iterable[Dict[str, Any]], List[Document]]: The merged answer stream in the format of the
+    Ollama chat model and the reviews retrieved for the qualitative sub-questions.
     """
-    stream = ollama.chat(
-        model="llama3",
-        stream=True,
-        messages=[
-            {
-                "role": "system",
-                "content": COMPOUND_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": question,
-            },
-        ],
-    )
-    return stream
+    sub_questions = decompose_question(question)
+    # Every part runs in a copy of the current context to stay in the trace of the request
+    futures = [
+        _speculation_executor.submit(copy_context().run, answer_part, sub_question)
+        for sub_question in sub_questions
+    ]
+    wait(futures, return_when=FIRST_EXCEPTION)
+    failed = [
+        future for future in futures if future.done() and future.exception() is not None
+    ]
+    if failed:
+        for future in futures:
+            future.cancel()
+        # Parts that are still being prepared are closed once they are done
+        for future in futures:
+            future.add_done_callback(_close_prepared)
+        raise failed[0].exception()
+    parts = [future.result() for future in futures]
+    return merge_answers(parts), merged_context(parts)
+
+
+class RagComponents(NamedTuple):
+    """
+    The RAG pipeline together with its parts, so the retrieval can run on its own.
 
+    retriever (Union[RedisKNNRetriever, NumpyKNNRetriever]): The retriever of the reviews.
+    answer_chain (Runnable): The chain that generates the answer from the question and the retrieved
+    context, streaming the input followed by the chunks of the answer.
+    chain (RunnableParallel): The full pipeline, the retriever followed by the answer chain.
+    """
 
-def rag_pipeline() -> RunnableParallel:
+    retriever: Union[RedisKNNRetriever, NumpyKNNRetriever]
+    answer_chain: Runnable
+    chain: RunnableParallel
+
+
+def get_filter_fields() -> Dict[str, str]:
     """
-    Creates a RAG (Retrieval-Augmented Generation) pipeline using the Ollama chat model.
+    Returns the queryable fields of the schema that the searched index was created with, reloaded
+    at most every RAG_CHAIN_REFRESH_SECONDS.
+
+    With RETRIEVER_BACKEND set to "numpy", these are the fields of the export in NUMPY_INDEX_DIR,
+    otherwise the fields of the index behind the alias.
+
+    Returns:
+    Dict[str, str]: The type of every queryable field of the index, all fields of the schema if
+    the index does not exist, and the previous fields if Redis cannot be reached.
+    """
+    global _filter_fields, _filter_fields_loaded_at
+    if time.monotonic() - _filter_fields_loaded_at < RAG_CHAIN_REFRESH_SECONDS:
+        return _filter_fields
+    with _filter_fields_lock:
+        if time.monotonic() - _filter_fields_loaded_at >= RAG_CHAIN_REFRESH_SECONDS:
+            try:
+                if RETRIEVER_BACKEND == "numpy":
+                    indexed = set(exported_fields(NUMPY_INDEX_DIR))
+                else:
+                    indexed = indexed_fields(redis_client, REDIS_INDEX_ALIAS)
+            except (FileNotFoundError, redis.ResponseError):
+                indexed = set(schema_fields)
+            except redis.RedisError:
+                indexed = set(_filter_fields or schema_fields)
+            _filter_fields = {
+                field: field_type
+                for field, field_type in schema_fields.items()
+                if field in indexed
+            }
+            _filter_fields_loaded_at = time.monotonic()
+    return _filter_fields
+
+
+def question_filters(question: str) -> str:
+    """
+    Extracts the filters restricting the reviews retrieved for a question, see extract_filters.
+
+    Only fields of the index behind the alias are filtered on, indices created before the source
+    and created_timestamp fields existed are not filtered by them.
+
+    Parameters:
+    question (str): The question.
 
-    This function first creates an embedder using the OllamaEmbeddings model. It then creates a vector store
-    from an existing index in a Redis database using the embedder.
+    Returns:
+    str: The filter expression, '*' if the question asks for no filter.
+    """
+    return extract_filters(question, get_filter_fields())
 
-    It then creates a retriever from the vector store with a search parameter of 10.
+
+def rag_components() -> RagComponents:
+    """
+    Creates a RAG (Retrieval-Augmented Generation) pipeline using the Ollama chat model.
+
+    This function first creates an embedder using the OllamaEmbeddings model. It then creates a retriever
+    that returns the 10 nearest reviews from the index behind the index alias in the Redis database, using
+    the vector settings of the profile that index was created with. If RETRIEVAL_PREFILTER is set, only
+    reviews passing the filters extracted from the question by question_filters are candidates. With
+    RETRIEVER_BACKEND set to "numpy", the reviews are searched in the snapshot of the index exported to
+    NUMPY_INDEX_DIR instead, in the memory of the process, with the fields of the export.
 
     It creates a chat prompt template from a predefined RAG_PIPELINE template and a chat model using the
     ChatOllama model.
 
-    It then creates a rag_chain_from_docs which is a sequence of operations that formats the context,
-    applies the prompt, applies the model, and parses the output to a string.
+    It then creates a rag_chain_from_docs which is a sequence of operations that assembles the context
+    from the retrieved reviews within CONTEXT_TOKEN_BUDGET (see assemble_context), applies the prompt,
+    applies the model, and parses the output to a string, and an answer chain that assigns the
+    rag_chain_from_docs as the answer.
 
     Finally, it creates a chain which is a parallel runnable that takes the retriever as the context and
-    a passthrough as the question, and assigns the rag_chain_from_docs as the answer.
+    a passthrough as the question, followed by the answer chain.
 
     Returns:
-    RunnableParallel: The RAG pipeline.
+    RagComponents: The RAG pipeline and its parts.
     """
-    embedder = OllamaEmbeddings(model="llama3")
-
-    vectorstore = Redis.from_existing_index(
-        embedding=embedder,
-        index_name=REDIS_INDEX_NAME,
-        schema=REDIS_SCHEMA,
-        redis_url=REDIS_URL,
-    )
-
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
+    embedder = OllamaEmbeddings(model=EMBEDDING_MODEL)
+
+    if RETRIEVER_BACKEND == "numpy":
+        index = NumpyVectorIndex(NUMPY_INDEX_DIR)
+        # Only a hint, the search itself does not need Redis
+        try:
+            alias_index = resolve_index(redis_client, REDIS_INDEX_ALIAS)
+        except redis.RedisError:
+            alias_index = index.meta["index_name"]
+        if index.meta["index_name"] != alias_index:
+            print(
+                f"The exported index in {NUMPY_INDEX_DIR} is a snapshot of "
+                f"{index.meta['index_name']}, run python export_index.py to refresh it"
+            )
+        retriever = NumpyKNNRetriever(
+            index=index,
+            embedder=embedder,
+            fields=exported_fields(NUMPY_INDEX_DIR),
+            k=10,
+            prefilter=question_filters if RETRIEVAL_PREFILTER else None,
+        )
+    else:
+        retriever = RedisKNNRetriever(
+            client=redis_client,
+            index_name=REDIS_INDEX_ALIAS,
+            embedder=embedder,
+            profile=index_profile(redis_client, REDIS_INDEX_ALIAS),
+            fields=metadata_fields(load_schema(REDIS_SCHEMA)),
+            k=10,
+            prefilter=question_filters if RETRIEVAL_PREFILTER else None,
+        )
 
     prompt = ChatPromptTemplate.from_template(RAG_PIPELINE)
 
-    model = ChatOllama(model="llama3")
+    model = ChatOllama(model=CHAT_MODEL)
 
     rag_chain_from_docs = (
-        RunnablePassthrough.assign(context=(lambda x: _format_docs(x["context"])))
+        RunnablePassthrough.assign(context=_format_docs)
         | prompt
         | model
         | StrOutputParser()
     )
+    answer_chain = RunnablePassthrough.assign(answer=rag_chain_from_docs)
 
-    chain = RunnableParallel(
-        {"context": retriever, "question": RunnablePassthrough()}
-    ).assign(answer=rag_chain_from_docs)
-    return chain
+    chain = (
+        RunnableParallel({"context": retriever, "question": RunnablePassthrough()})
+        | answer_chain
+    )
+    return RagComponents(retriever, answer_chain, chain)
 
 
-def create_embeddings(df: pd.DataFrame) -> None:
+def rag_pipeline() -> RunnableParallel:
+    """
+    Creates a RAG (Retrieval-Augmented Generation) pipeline using the Ollama chat model.
+
+    Returns:
+    RunnableParallel: The RAG pipeline built by rag_components.
+    """
+    return rag_components().chain
+
+
+def get_rag_components() -> RagComponents:
+    """
+    Returns the RAG pipeline and its parts shared by all threads and Streamlit sessions of the process.
+
+    The pipeline, including its embedder, retriever, prompt and chat model, is built by rag_components
+    on the first call only, so every question only pays for the retrieval and the generation. The
+    construction time is recorded in rag_chain_stats. At most every RAG_CHAIN_REFRESH_SECONDS the
+    profile of the index behind the alias is checked and the pipeline is rebuilt if reindex.py
+    swapped the alias to an index with another profile. With RETRIEVER_BACKEND set to "numpy",
+    Redis is not used, the pipeline is rebuilt once export_index.py wrote a new export.
+
+    Returns:
+    RagComponents: The shared RAG pipeline and its parts.
+    """
+    global _rag_components, _rag_chain_profile, _rag_chain_checked_at
+    if (
+        _rag_components is not None
+        and time.monotonic() - _rag_chain_checked_at < RAG_CHAIN_REFRESH_SECONDS
+    ):
+        return _rag_components
+    with _rag_chain_lock:
+        if time.monotonic() - _rag_chain_checked_at < RAG_CHAIN_REFRESH_SECONDS:
+            return _rag_components
+        if RETRIEVER_BACKEND == "numpy":
+            profile = {"exported_at": snapshot_version(NUMPY_INDEX_DIR)}
+        else:
+            profile = index_profile(redis_client, REDIS_INDEX_ALIAS)
+        if _rag_components is None or profile != _rag_chain_profile:
+            start = time.perf_counter()
+            _rag_components = rag_components()
+            rag_chain_stats["builds"] += 1
+            rag_chain_stats["build_seconds"] = time.perf_counter() - start
+            rag_chain_stats["built_at"] = time.time()
+            print(f"RAG pipeline built in {rag_chain_stats['build_seconds']:.3f}s")
+            _rag_chain_profile = profile
+        _rag_chain_checked_at = time.monotonic()
+    return _rag_components
+
+
+def get_rag_chain() -> RunnableParallel:
+    """
+    Returns the RAG pipeline shared by all threads and Streamlit sessions of the process.
+
+    Returns:
+    RunnableParallel: The shared RAG pipeline, see get_rag_components.
+    """
+    return get_rag_components().chain
+
+
+def create_embeddings(
+    df: pd.DataFrame,
+    source: str,
+    batch_size: int = 64,
+    concurrency: int = 4,
+    cache: Optional[EmbeddingCache] = None,
+    index_name: str = REDIS_INDEX_NAME,
+    profile_name: str = REDIS_INDEX_PROFILE,
+    write_batch_size: int = REDIS_WRITE_BATCH_SIZE,
+) -> None:
     """
     Creates embeddings for a given DataFrame using the Ollama chat model.
 
     Parameters:
     df (pd.DataFrame): The DataFrame for which to create embeddings.
+    source (str): The source of the reviews, part of every document id.
+    batch_size (int): The number of reviews embedded and written per batch.
+    concurrency (int): The number of batches embedded in parallel against Ollama.
+    cache (Optional[EmbeddingCache]): An embedding cache, if given only cache misses are sent to Ollama.
+    index_name (str): The name of the physical index the reviews are written to.
+    profile_name (str): The index profile used if the index does not exist yet.
+    write_batch_size (int): The number of documents written per Redis pipeline.
+
+    This function splits the DataFrame into batches and embeds the 'content' of the batches
+    on a bounded pool of worker threads using the OllamaEmbeddings model. Every embedded batch
+    is handed to a BulkWriter together with its metadata (all columns except 'content') as soon
+    as it is ready, which writes the documents to the Redis database in pipelines of
+    write_batch_size documents, so only a few batches are held in memory at any time. The index is
+    created with the given index profile if it does not exist and the vectors are stored in the
+    datatype of the profile the index was created with. If a cache is given, reviews whose
+    content was embedded with the same model before are served from it.
+
+    Every review is stored under a stable document id derived from its source, content and
+    creation date, so writing the same review again overwrites it instead of duplicating it.
+
+    The metadata is converted to Redis field values per batch, so the DataFrame keeps its
+    compact types, and the throughput in documents per second is printed after every batch.
+    The write throughput and the number of retried pipelines are printed at the end.
+    """
+    embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
+    if cache is not None:
+        embeddings = CachedEmbeddings(embeddings, cache, EMBEDDING_MODEL)
+    create_index(redis_client, index_name, REDIS_SCHEMA, profile_name)
+    writer = BulkWriter(
+        redis_client,
+        index_name,
+        index_profile(redis_client, index_name),
+        batch_size=write_batch_size,
+    )
 
-    This function modifies the input DataFrame by converting the 'created_date' and
-    'contains_source_word' columns to string type. It then creates a list of all columns
-    except 'content' and converts these columns to a list of dictionaries.
-
-    It also creates a list of all 'content' in the DataFrame.
+    total = len(df)
+    written = 0
+    start = time.time()
+    for batch, vectors in embed_batches(
+        iter_batches(df, batch_size), embeddings, concurrency
+    ):
+        writer.add(
+            document_ids(batch, source),
+            batch["content"].tolist(),
+            vectors,
+            metadata_records(batch),
+        )
+        written += len(batch)
+        elapsed = time.time() - start
+        print(f"Embedded {written}/{total} reviews ({written / elapsed:.1f} docs/sec)")
+    writer.flush()
+    print(f"Redis writes: {writer.stats()}")
+
+
+def get_router() -> CentroidRouter:
+    """
+    Returns the local question router shared by all threads of the process.
 
-    It then creates embeddings for the first 1000 texts and corresponding metadata using
-    the OllamaEmbeddings model and stores them in a Redis database.
+    The router is fitted on the training examples of ROUTER_EXAMPLES on the first call, its
+    centroids are stored in ROUTER_CACHE_DIR, so the examples are only embedded again when they or
+    the embedding model change.
 
-    Finally, it writes the schema to the Redis database.
+    Returns:
+    CentroidRouter: The shared router.
     """
-    embeddings = OllamaEmbeddings(model="llama3")
-    df["created_date"] = df["created_date"].apply(str)
-    df["contains_source_word"] = df["contains_source_word"].apply(str)
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = CentroidRouter.load_or_fit(
+                query_embedder,
+                load_examples(ROUTER_EXAMPLES, "train"),
+                ROUTER_CACHE_DIR,
+                EMBEDDING_MODEL,
+            )
+    return _router
+
+
+def route_question(question: str) -> Tuple[str, float]:
+    """
+    Classifies a question with the local router, without calling the chat model.
 
-    metadata_columns = df.columns.tolist()
-    metadata_columns.remove("content")
-    metadata = df[metadata_columns].to_dict("records")
-    texts = df["content"].tolist()
+    Parameters:
+    question (str): The question to be classified.
 
-    rds = Redis.from_texts(
-        texts[:1000],
-        embeddings,
-        metadatas=metadata[:1000],
-        redis_url=REDIS_URL,
-        index_name=REDIS_INDEX_NAME,
-    )
-    rds.write_schema(REDIS_SCHEMA)
+    Returns:
+    Tuple[str, float]: The class and the confidence margin of the router.
+    """
+    with span("classify.router"):
+        return get_router().route(query_embedder.embed_query(question))
 
 
-def classify_question(question: str) -> str:
+def classify_question_llm(question: str, use_cache: bool = True) -> str:
     """
     Classifies a question using the Ollama chat model.
 
+    Classifications are served from the response cache if possible.
+
     Parameters:
     question (str): The question to be classified.
+    use_cache (bool): If False, the response cache is bypassed, e.g. to measure the latency.
 
     Returns:
     str: The classification result from the Ollama chat model.
     """
-    response = ollama.chat(
-        model="llama3",
-        messages=[
-            {
-                "role": "system",
-                "content": CLASSIFICATION_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": question,
-            },
-        ],
+    if use_cache:
+        question_class = response_cache.get(
+            "classify", question, CLASSIFICATION_PROMPT, CHAT_MODEL
+        )
+        if question_class is not None:
+            return question_class
+    with span("classify.llm", model=CHAT_MODEL):
+        response = ollama.chat(
+            model=CHAT_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": CLASSIFICATION_PROMPT,
+                },
+                {
+                    "role": "user",
+                    "content": question,
+                },
+            ],
+        )
+    question_class = response["message"]["content"]
+    if use_cache:
+        response_cache.put(
+            "classify", question, CLASSIFICATION_PROMPT, CHAT_MODEL, question_class
+        )
+    return question_class
+
+
+def classify_question(question: str) -> str:
+    """
+    Classifies a question as quantitative, qualitative or compound.
+
+    The question is routed by the local router first, only if its confidence margin is below
+    ROUTER_MIN_MARGIN the Ollama chat model classifies the question.
+
+    Parameters:
+    question (str): The question to be classified.
+
+    Returns:
+    str: The class of the question.
+    """
+    with span("classify"):
+        if ROUTER_MIN_MARGIN is not None:
+            question_class, margin = route_question(question)
+            if margin >= ROUTER_MIN_MARGIN:
+                return question_class
+        return classify_question_llm(question)
+
+
+class SpeculativeAnswer(NamedTuple):
+    """
+    The answer of speculative_answer.
+
+    question_class (str): The class of the question in lower case.
+    stream (Iterable[Dict[str, Any]]): The answer stream.
+    context (List[Document]): The retrieved reviews, empty unless the question is qualitative or
+    compound.
+    model_type (str): The type of the stream for stream_parser, 'ollama' or 'langchain'.
+    """
+
+    question_class: str
+    stream: Iterable[Dict[str, Any]]
+    context: List[Document]
+    model_type: str
+
+
+def speculative_answer(question: str) -> SpeculativeAnswer:
+    """
+    Answers a question while classifying it, instead of waiting for the classification first.
+
+    The classification, the retrieval of the nearest reviews and the generation of the quantitative
+    query are started concurrently on a shared thread pool. Once the question is classified, the
+    matching branch continues with the results that are already available and the other tasks are
+    cancelled. Cancellation is best effort, tasks that already started run to completion in the
+    background and their results are discarded, except for the generated query, which still ends
+    up in the response cache.
+
+    Parameters:
+    question (str): The question to be answered.
+
+    Returns:
+    SpeculativeAnswer: The class of the question, the answer stream and the retrieved reviews.
+    """
+    components = get_rag_components()
+    # Every task runs in a copy of the current context to stay in the trace of the request
+    classification = _speculation_executor.submit(
+        copy_context().run, classify_question, question
+    )
+    retrieval = _speculation_executor.submit(
+        copy_context().run, components.retriever.invoke, question
     )
-    return response["message"]["content"]
+    generation = _speculation_executor.submit(
+        copy_context().run, generate_quantitative_query, question
+    )
+
+    question_class = classification.result().strip().lower()
+    if question_class not in ("quantitative", "compound"):
+        # Unknown classes are answered like qualitative questions, as in answer_part
+        question_class = "qualitative"
+    if question_class == "qualitative":
+        generation.cancel()
+        context = retrieval.result()
+        stream = components.answer_chain.stream(
+            {"context": context, "question": question}
+        )
+        return SpeculativeAnswer(question_class, stream, context, "langchain")
+
+    retrieval.cancel()
+    if question_class == "quantitative":
+        stream = quantitative_answer(question, query=generation.result())
+        return SpeculativeAnswer(question_class, stream, [], "ollama")
+    generation.cancel()
+    stream, context = compound_answer(question)
+    return SpeculativeAnswer(question_class, stream, context, "ollama")
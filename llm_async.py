@@ -0,0 +1,527 @@
+import asyncio
+from contextlib import nullcontext
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import ollama
+import redis.asyncio as aioredis
+from langchain_core.documents import Document
+
+from config import (
+    CHAT_MODEL,
+    COMPOUND_MAX_QUESTIONS,
+    EMBEDDING_MODEL,
+    REDIS_INDEX_ALIAS,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_URL,
+    RETRIEVAL_PREFILTER,
+    ROLLUPS_ENABLED,
+    ROUTER_MIN_MARGIN,
+)
+from llm import (
+    get_rag_components,
+    get_rollups,
+    get_router,
+    query_embedder,
+    question_filters,
+    response_cache,
+    schema_fields,
+    schema_sortable,
+)
+from prompts import (
+    CLASSIFICATION_PROMPT,
+    COMPOUND_PROMPT,
+    QUANTITATIVE_PROMPT,
+    QUERY_RETRY_PROMPT,
+    REPHRASE_PROMPT,
+)
+from src.aggregation import (
+    aggregate_answer,
+    aggregate_request,
+    canonical_request,
+    is_plan,
+    parse_plan,
+)
+from src.compound import (
+    SubAnswer,
+    chunk_text,
+    merged_context,
+    parse_sub_questions,
+    part_header,
+)
+from src.numpy_index import NumpyKNNRetriever
+from src.query_parser import QueryError, count_query
+from src.response_cache import async_cache_stream, async_replay_stream
+from src.rollups import rollup_answer
+from src.tracing import span
+from src.vector_index import knn_params, knn_query, to_documents
+
+
+ollama_client = ollama.AsyncClient()
+redis_pool = aioredis.ConnectionPool.from_url(
+    REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS
+)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+rs = redis_client.ft(REDIS_INDEX_ALIAS)
+
+
+def _messages(system: str, user: str) -> List[Dict[str, str]]:
+    return [
+        {
+            "role": "system",
+            "content": system,
+        },
+        {
+            "role": "user",
+            "content": user,
+        },
+    ]
+
+
+async def embed_query(text: str) -> List[float]:
+    """
+    Embeds a question with the Ollama embedding model, like OllamaEmbeddings.embed_query.
+
+    Parameters:
+    text (str): The question.
+
+    Returns:
+    List[float]: The embedding of the question.
+    """
+    response = await ollama_client.embeddings(
+        model=EMBEDDING_MODEL, prompt=f"{query_embedder.query_instruction}{text}"
+    )
+    return response["embedding"]
+
+
+async def search_nearest(
+    vector: List[float], filter_expression: str = "*"
+) -> List[Document]:
+    """
+    Searches the nearest reviews of a question embedding with the settings of the shared RAG
+    retriever. The in-process search of the numpy backend runs in a worker thread.
+
+    Parameters:
+    vector (List[float]): The embedding of the question.
+    filter_expression (str): The filter expression restricting the candidates, '*' for all reviews.
+
+    Returns:
+    List[Document]: The nearest reviews, of all reviews if none passes the filter.
+    """
+    retriever = (await asyncio.to_thread(get_rag_components)).retriever
+    if isinstance(retriever, NumpyKNNRetriever):
+        return await asyncio.to_thread(retriever.search, vector, filter_expression)
+    with span("retrieval.search", k=retriever.k, filter=filter_expression):
+        result = await redis_client.ft(retriever.index_name).search(
+            knn_query(
+                retriever.k,
+                retriever.profile,
+                ["content", *retriever.fields],
+                filter_expression,
+            ),
+            query_params=knn_params(vector, retriever.profile),
+        )
+    if not result.docs and filter_expression != "*":
+        return await search_nearest(vector)
+    return to_documents(result, retriever.fields)
+
+
+async def retrieve(question: str) -> List[Document]:
+    """
+    Retrieves the nearest reviews of a question, restricted to the filters extracted from the
+    question if RETRIEVAL_PREFILTER is set.
+
+    Parameters:
+    question (str): The question.
+
+    Returns:
+    List[Document]: The nearest reviews.
+    """
+    with span("retrieval.embed"):
+        vector = await embed_query(question)
+    filter_expression = "*"
+    if RETRIEVAL_PREFILTER:
+        # The fields of the index are reloaded with a blocking FT.INFO from time to time
+        filter_expression = await asyncio.to_thread(question_filters, question)
+    return await search_nearest(vector, filter_expression)
+
+
+async def count_matches(query: str) -> int:
+    """
+    Counts the reviews matching a RediSearch query without fetching any of them.
+
+    Parameters:
+    query (str): The canonical query.
+
+    Returns:
+    int: The number of matching reviews.
+    """
+    with span("redis.search", query=query):
+        return (await rs.search(count_query(query))).total
+
+
+async def execute_quantitative_query(query: str) -> str:
+    """
+    Executes a query or aggregation plan like llm.execute_quantitative_query.
+
+    Parameters:
+    query (str): The canonical query or aggregation plan.
+
+    Returns:
+    str: The count or the formatted aggregation, or "na" if the query is "na".
+    """
+    if query == "na":
+        return "na"
+    if ROLLUPS_ENABLED:
+        rollups = await asyncio.to_thread(get_rollups)
+        with span("rollups", query=query):
+            answer = rollup_answer(query, rollups, schema_fields)
+        if answer is not None:
+            return answer
+    if is_plan(query):
+        plan = parse_plan(query, schema_fields)
+        with span("redis.aggregate", query=query):
+            result = await rs.aggregate(aggregate_request(plan, schema_sortable))
+        return aggregate_answer(plan, result.rows)
+    return str(await count_matches(query))
+
+
+async def classify_question_llm(question: str) -> str:
+    """
+    Classifies a question using the Ollama chat model.
+
+    Classifications are served from the response cache if possible.
+
+    Parameters:
+    question (str): The question to be classified.
+
+    Returns:
+    str: The classification result from the Ollama chat model.
+    """
+    question_class = await asyncio.to_thread(
+        response_cache.get, "classify", question, CLASSIFICATION_PROMPT, CHAT_MODEL
+    )
+    if question_class is not None:
+        return question_class
+    with span("classify.llm", model=CHAT_MODEL):
+        response = await ollama_client.chat(
+            model=CHAT_MODEL, messages=_messages(CLASSIFICATION_PROMPT, question)
+        )
+    question_class = response["message"]["content"]
+    await asyncio.to_thread(
+        response_cache.put,
+        "classify",
+        question,
+        CLASSIFICATION_PROMPT,
+        CHAT_MODEL,
+        question_class,
+    )
+    return question_class
+
+
+async def classify_question(question: str) -> str:
+    """
+    Classifies a question as quantitative, qualitative or compound.
+
+    The question is routed by the local router first, only if its confidence margin is below
+    ROUTER_MIN_MARGIN the Ollama chat model classifies the question.
+
+    Parameters:
+    question (str): The question to be classified.
+
+    Returns:
+    str: The class of the question.
+    """
+    with span("classify"):
+        if ROUTER_MIN_MARGIN is not None:
+            with span("classify.router"):
+                router = await asyncio.to_thread(get_router)
+                question_class, margin = router.route(await embed_query(question))
+            if margin >= ROUTER_MIN_MARGIN:
+                return question_class
+        return await classify_question_llm(question)
+
+
+async def generate_quantitative_query(question: str) -> str:
+    """
+    Generates the RediSearch query that answers a quantitative question using the Ollama chat model.
+
+    The query or aggregation plan is validated and normalised like in
+    llm.generate_quantitative_query and the chat model is asked once to correct an invalid one. Queries are served from the response cache if
+    possible.
+
+    Parameters:
+    question (str): The question to be answered.
+
+    Returns:
+    str: The canonical query or aggregation plan, or "na" if the question cannot be answered with
+    a query.
+    """
+    cached = await asyncio.to_thread(
+        response_cache.get, "query", question, QUANTITATIVE_PROMPT, CHAT_MODEL
+    )
+    if cached is not None:
+        try:
+            return canonical_request(cached, schema_fields)
+        except QueryError:
+            pass
+    messages = _messages(QUANTITATIVE_PROMPT, question)
+    query = "na"
+    for attempt in range(2):
+        with span("query_generation.llm", model=CHAT_MODEL, attempt=attempt):
+            query_dict = await ollama_client.chat(model=CHAT_MODEL, messages=messages)
+        content = query_dict["message"]["content"]
+        try:
+            query = canonical_request(content, schema_fields)
+            break
+        except QueryError as error:
+            messages += [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": QUERY_RETRY_PROMPT.format(error=error)},
+            ]
+    await asyncio.to_thread(
+        response_cache.put, "query", question, QUANTITATIVE_PROMPT, CHAT_MODEL, query
+    )
+    return query
+
+
+async def rephrase_answer(question: str, answer: Any) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Rephrases a given answer using the Ollama chat model.
+
+    Rephrased answers are served from the response cache if possible and replayed as a stream of a
+    single chunk.
+
+    Parameters:
+    question (str): The original question.
+    answer (Any): The original answer.
+
+    Returns:
+    AsyncIterator[Dict[str, Any]]: The rephrased answer stream from the Ollama chat model.
+    """
+    message = f"Question: {question} Answer: {answer}"
+    cached = await asyncio.to_thread(
+        response_cache.get, "rephrase", message, REPHRASE_PROMPT, CHAT_MODEL
+    )
+    if cached is not None:
+        return async_replay_stream(cached)
+    stream = await ollama_client.chat(
+        model=CHAT_MODEL, stream=True, messages=_messages(REPHRASE_PROMPT, message)
+    )
+    return async_cache_stream(
+        stream, response_cache, "rephrase", message, REPHRASE_PROMPT, CHAT_MODEL
+    )
+
+
+async def quantitative_answer(
+    question: str, query: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Generates a quantitative answer for a given question using the Ollama chat model.
+
+    The query or aggregation plan generated for the question is executed with
+    execute_quantitative_query and its result is rephrased as the answer.
+
+    Parameters:
+    question (str): The question to be answered.
+    query (Optional[str]): The query generated for the question, if already known.
+
+    Returns:
+    AsyncIterator[Dict[str, Any]]: The rephrased answer stream from the Ollama chat model.
+    """
+    if query is None:
+        query = await generate_quantitative_query(question)
+    print(query)
+    answer = await execute_quantitative_query(query)
+    return await rephrase_answer(question, answer)
+
+
+async def decompose_question(question: str) -> List[str]:
+    """
+    Splits a compound question into its sub-questions like llm.decompose_question.
+
+    Parameters:
+    question (str): The compound question.
+
+    Returns:
+    List[str]: At most COMPOUND_MAX_QUESTIONS sub-questions.
+    """
+    response = await asyncio.to_thread(
+        response_cache.get, "decompose", question, COMPOUND_PROMPT, CHAT_MODEL
+    )
+    if response is None:
+        with span("compound.decompose", model=CHAT_MODEL):
+            response = (
+                await ollama_client.chat(
+                    model=CHAT_MODEL, messages=_messages(COMPOUND_PROMPT, question)
+                )
+            )["message"]["content"]
+        await asyncio.to_thread(
+            response_cache.put,
+            "decompose",
+            question,
+            COMPOUND_PROMPT,
+            CHAT_MODEL,
+            response,
+        )
+    return parse_sub_questions(response, question, COMPOUND_MAX_QUESTIONS)
+
+
+async def answer_part(question: str) -> SubAnswer:
+    """
+    Classifies a sub-question of a compound question and starts its answer like
+    llm.answer_part.
+
+    Parameters:
+    question (str): The sub-question.
+
+    Returns:
+    SubAnswer: The class of the sub-question, its answer stream and the retrieved reviews.
+    """
+    question_class = (await classify_question(question)).strip().lower()
+    if question_class == "quantitative":
+        stream = await quantitative_answer(question)
+        return SubAnswer(question, question_class, stream, [], "ollama")
+    context = await retrieve(question)
+    stream = await rag_answer(question, context)
+    return SubAnswer(question, "qualitative", stream, context, "langchain")
+
+
+async def _pump(part: SubAnswer, chunks: asyncio.Queue) -> None:
+    # Reads the answer of a sub-question into a queue, ended by None
+    try:
+        async for chunk in part.stream:
+            text = chunk_text(chunk, part.model_type)
+            if text:
+                await chunks.put(text)
+    except Exception as error:
+        await chunks.put(error)
+    finally:
+        # Stops the generation right away if the task is cancelled
+        if hasattr(part.stream, "aclose"):
+            await part.stream.aclose()
+    await chunks.put(None)
+
+
+async def _run_part(
+    question: str,
+    answer: Callable[[str], Awaitable[SubAnswer]],
+    slot: Optional[Callable[[], AsyncContextManager[None]]],
+    prepared: asyncio.Future,
+    chunks: asyncio.Queue,
+) -> None:
+    # Answers a sub-question, publishes its answer and reads its stream into the queue
+    try:
+        async with nullcontext() if slot is None else slot():
+            part = await answer(question)
+            prepared.set_result(part)
+            await _pump(part, chunks)
+    except Exception as error:
+        if not prepared.done():
+            prepared.set_exception(error)
+
+
+async def answer_concurrently(
+    questions: List[str],
+    answer: Callable[[str], Awaitable[SubAnswer]] = answer_part,
+    slot: Optional[Callable[[], AsyncContextManager[None]]] = None,
+) -> Tuple[AsyncIterator[Dict[str, Any]], List[Document]]:
+    """
+    Answers the sub-questions of a compound question concurrently and merges their answers into a
+    single answer stream like llm.merge_answers.
+
+    Every sub-question is answered and its stream read by a task of its own. If a sub-question
+    cannot be answered, or the merged stream fails or is closed early, the tasks of the other
+    sub-questions are cancelled.
+
+    Parameters:
+    questions (List[str]): The sub-questions.
+    answer (Callable[[str], Awaitable[SubAnswer]]): Starts the answer of a sub-question.
+    slot (Optional[Callable[[], AsyncContextManager[None]]]): Holds a slot of a backend, e.g. of
+    the Ollama backend of server.py, for every sub-question while it is answered.
+
+    Returns:
+    Tuple[AsyncIterator[Dict[str, Any]], List[Document]]: The merged answer stream in the format of
+    the Ollama chat model and the reviews retrieved for the qualitative sub-questions.
+    """
+    loop = asyncio.get_running_loop()
+    prepared = [loop.create_future() for _ in questions]
+    queues = [asyncio.Queue() for _ in questions]
+    tasks = [
+        asyncio.create_task(_run_part(question, answer, slot, future, chunks))
+        for question, future, chunks in zip(questions, prepared, queues)
+    ]
+    try:
+        await asyncio.wait(prepared, return_when=asyncio.FIRST_EXCEPTION)
+        for future in prepared:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        parts = [future.result() for future in prepared]
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    async def stream() -> AsyncIterator[Dict[str, Any]]:
+        try:
+            for position, (part, chunks) in enumerate(zip(parts, queues)):
+                if len(parts) > 1:
+                    yield {"message": {"content": part_header(part.question, position)}}
+                while (text := await chunks.get()) is not None:
+                    if isinstance(text, Exception):
+                        raise text
+                    yield {"message": {"content": text}}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return stream(), merged_context(parts)
+
+
+async def compound_answer(
+    question: str,
+) -> Tuple[AsyncIterator[Dict[str, Any]], List[Document]]:
+    """
+    Answers a compound question by answering its sub-questions concurrently like
+    llm.compound_answer.
+
+    Parameters:
+    question (str): The question to be answered.
+
+    Returns:
+    Tuple[AsyncIterator[Dict[str, Any]], List[Document]]: The merged answer stream in the format of
+    the Ollama chat model and the reviews retrieved for the qualitative sub-questions.
+    """
+    sub_questions = await decompose_question(question)
+    return await answer_concurrently(sub_questions)
+
+
+async def rag_answer(
+    question: str, context: Optional[List[Document]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Answers a qualitative question with the RAG pipeline.
+
+    The stream has the format of the stream of the synchronous RAG pipeline, the first chunk holds
+    the retrieved reviews as 'context' and the following chunks the 'answer'.
+
+    Parameters:
+    question (str): The question to be answered.
+    context (Optional[List[Document]]): The reviews retrieved for the question, if already known.
+
+    Returns:
+    AsyncIterator[Dict[str, Any]]: The answer stream of the RAG pipeline.
+    """
+    if context is None:
+        context = await retrieve(question)
+    answer_chain = (await asyncio.to_thread(get_rag_components)).answer_chain
+    return answer_chain.astream({"context": context, "question": question})
@@ -1,21 +1,232 @@
+import os
+import re
 import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Optional
 
-from llm import create_embeddings
-from src.pipeline import clean, consolidation, read_data
+import pandas as pd
 
+from config import (
+    EMBEDDING_CACHE_DIR,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_MODEL,
+    REDIS_INDEX_ALIAS,
+    REDIS_INDEX_NAME,
+    REDIS_INDEX_PROFILE,
+)
+from llm import create_embeddings, redis_client
+from src.embedding_cache import EmbeddingCache
+from src.incremental import (
+    document_ids,
+    finish_source,
+    is_unchanged,
+    load_manifest,
+    load_watermark,
+    plan_changes,
+    record_upserts,
+)
+from src.pipeline import data_path
+from src.rollups import RollupBuilder, has_rollup, write_rollup
+from src.runner import StageTimer, prepare_chunks, prepare_sources
+from src.vector_index import index_exists, point_alias, resolve_index
+
+
+SOURCES = ["chatgpt", "netflix", "spotify"]
+RUN_OLD_PIPELINE = False
+# Number of reviews embedded and written per batch
+EMBEDDING_BATCH_SIZE = 64
+# Number of batches embedded in parallel, 0 skips the embedding creation
+EMBEDDING_CONCURRENCY = 4
+# Reuse embeddings of unchanged reviews from previous runs
+USE_EMBEDDING_CACHE = True
+# Only write new or changed reviews and delete removed ones
+INCREMENTAL = True
+# Number of CSV rows processed at once, None reads every file as a whole
+CHUNK_SIZE = None
+# Reuse cleaned DataFrames from the Parquet cache while the CSV files are unchanged
+USE_FRAME_CACHE = True
+# Number of processes reading and cleaning sources (or chunks of a source) in parallel
+WORKERS = 3
+
+
+def ingest_source(
+    frames: Iterable[pd.DataFrame],
+    source: str,
+    batch_size: int,
+    concurrency: int,
+    incremental: bool,
+    cache: Optional[EmbeddingCache],
+    timer: StageTimer,
+    index_name: str = REDIS_INDEX_NAME,
+    profile_name: str = REDIS_INDEX_PROFILE,
+) -> int:
+    """
+    Embeds the cleaned frames of a source and writes them to the database.
+
+    In incremental mode only new or changed reviews are embedded, reviews that no longer exist are
+    deleted and the watermark of the source is moved once all frames are written. In both modes the
+    rollup of the source is computed from all of its frames and stored once they are written.
+
+    Parameters:
+    frames (Iterable[pd.DataFrame]): The cleaned DataFrame of the source, or its cleaned chunks.
+    source (str): The name of the source.
+    batch_size (int): The number of reviews embedded and written per batch.
+    concurrency (int): The number of batches embedded in parallel.
+    incremental (bool): If True, only writes the delta since the last run.
+    cache (Optional[EmbeddingCache]): The embedding cache, if any.
+    timer (StageTimer): The timer receiving the duration of the embedding and writing.
+    index_name (str): The name of the physical index the reviews are written to.
+    profile_name (str): The index profile used if the index does not exist yet.
+
+    Returns:
+    int: The number of distinct documents of the source.
+    """
+    manifest = load_manifest(redis_client, index_name, source) if incremental else {}
+    seen_ids = set()
+    rollup = RollupBuilder(source)
+    rows, upserted, max_created_date = 0, 0, None
+    for df in frames:
+        rollup.add(df)
+        if incremental:
+            changes = plan_changes(df, source, manifest)
+            seen_ids.update(changes.ids)
+            df_upserts = changes.upserts
+        else:
+            seen_ids.update(document_ids(df, source))
+            df_upserts = df
+        with timer.stage(source, "embed+write"):
+            create_embeddings(
+                df_upserts,
+                source,
+                batch_size,
+                concurrency,
+                cache=cache,
+                index_name=index_name,
+                profile_name=profile_name,
+            )
+            if incremental:
+                record_upserts(redis_client, index_name, source, changes.fingerprints)
+        rows += len(df)
+        upserted += len(df_upserts)
+        chunk_max = df["created_date"].max()
+        if max_created_date is None or chunk_max > max_created_date:
+            max_created_date = chunk_max
+
+    if incremental:
+        stale_ids = [doc_id for doc_id in manifest if doc_id not in seen_ids]
+        watermark = {
+            "rows": rows,
+            "upserted": upserted,
+            "max_created_date": str(max_created_date),
+        }
+        finish_source(
+            redis_client,
+            index_name,
+            source,
+            stale_ids,
+            watermark,
+            data_path(source),
+        )
+        print(
+            f"{upserted} new or changed and {len(stale_ids)} removed reviews from {source}"
+        )
+    write_rollup(redis_client, index_name, source, rollup.rollup())
+    return len(seen_ids)
 
-if __name__ == "__main__":
-    sources = ["chatgpt", "netflix", "spotify"]
-    RUN_OLD_PIPELINE = False
-    RUN_EMBEDDINGS = True
 
+def run_pipeline(
+    index_name: str, profile_name: str = REDIS_INDEX_PROFILE
+) -> Dict[str, int]:
+    """
+    Reads, cleans, embeds and writes all sources to a physical index.
+
+    The pipeline is configured by the constants of this module. Sources that are unchanged since
+    the last incremental run into the same index are skipped once their rollup is written.
+
+    Parameters:
+    index_name (str): The name of the physical index the reviews are written to.
+    profile_name (str): The index profile used if the index does not exist yet.
+
+    Returns:
+    Dict[str, int]: The number of distinct documents of every ingested source.
+    """
+    cache = None
+    if USE_EMBEDDING_CACHE:
+        # Every embedding model has a cache of its own
+        cache_dir = os.path.join(
+            EMBEDDING_CACHE_DIR, re.sub(r"\W", "_", EMBEDDING_MODEL)
+        )
+        cache = EmbeddingCache(cache_dir, EMBEDDING_CACHE_SIZE)
+
+    timer = StageTimer()
     start = time.time()
-    for source in sources:
-        print(f"Reading data from {source}")
-        df = read_data(source)
-        df = consolidation(df, source)
-        df = clean(df, RUN_OLD_PIPELINE, source)
-        if RUN_EMBEDDINGS:
-            create_embeddings(df)
-        print(f"Data from {source} written to database")
-    print(f"Pipeline completed in {time.time() - start} seconds")
+    pending_sources = []
+    for source in SOURCES:
+        if INCREMENTAL and EMBEDDING_CONCURRENCY > 0:
+            watermark = load_watermark(redis_client, index_name, source)
+            # Sources ingested before rollups existed are read once more to write their rollup
+            if is_unchanged(watermark, data_path(source)) and has_rollup(
+                redis_client, index_name, source
+            ):
+                print(f"Data from {source} unchanged since the last run, skipping")
+                continue
+        pending_sources.append(source)
+
+    counts = {}
+    try:
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            if CHUNK_SIZE:
+                prepared = (
+                    (
+                        source,
+                        prepare_chunks(
+                            executor, source, RUN_OLD_PIPELINE, CHUNK_SIZE, timer
+                        ),
+                    )
+                    for source in pending_sources
+                )
+            else:
+                prepared = (
+                    (source, [df])
+                    for source, df in prepare_sources(
+                        executor,
+                        pending_sources,
+                        RUN_OLD_PIPELINE,
+                        timer,
+                        USE_FRAME_CACHE,
+                    )
+                )
+            for source, frames in prepared:
+                print(f"Processing data from {source}")
+                if EMBEDDING_CONCURRENCY > 0:
+                    counts[source] = ingest_source(
+                        frames,
+                        source,
+                        EMBEDDING_BATCH_SIZE,
+                        EMBEDDING_CONCURRENCY,
+                        INCREMENTAL,
+                        cache,
+                        timer,
+                        index_name,
+                        profile_name,
+                    )
+                    print(f"Data from {source} written to database")
+                else:
+                    for _ in frames:
+                        pass
+    finally:
+        # Keep the embeddings computed so far even if the run fails
+        if cache is not None:
+            cache.flush()
+            print(f"Embedding cache: {cache.stats()}")
+    print(timer.report())
+    print(f"Pipeline completed in {time.time() - start:.2f} seconds")
+    return counts
+
+
+if __name__ == "__main__":
+    # Keep writing to the index behind the alias, reindex.py builds new indices
+    index_name = resolve_index(redis_client, REDIS_INDEX_ALIAS) or REDIS_INDEX_NAME
+    run_pipeline(index_name)
+    if index_exists(redis_client, index_name):
+        point_alias(redis_client, REDIS_INDEX_ALIAS, index_name)
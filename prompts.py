@@ -31,8 +31,13 @@ User:
 
 COMPOUND_PROMPT = """
 You are given a question from a user. This question is a compound question, meaning it contains multiple questions.
-Please tell the user that currently we only support one question at a time and suggest the user how he/she can split the question into multiple single questions.
-Stay with the same questions the user asked and don't change the meaning of the questions. Only write the suggested questions one time.
+Please split it into the single questions it contains, so that every question can be answered on its own.
+Stay with the same questions the user asked and don't change the meaning of the questions. Repeat the app or anything else a question refers to.
+For example "How many Spotify reviews are there and what do users like about it?" becomes:
+How many Spotify reviews are there?
+What do users like about Spotify?
+
+Only reply with the questions, one per line, without numbering or any other text.
 """
 
 QUANTITATIVE_PROMPT = """
@@ -45,22 +50,41 @@ Answer from you: @user:Paul @age:[30 40]
 User question: How many users are named Paul?
 Answer from you:  @user:Paul
 
-The correct syntax for a text and numeric question is the following:
-@text_field:text_value @numeric_field:[value_numeric_field]
+The correct syntax for a text, numeric and tag question is the following:
+@text_field:text_value @numeric_field:[value_numeric_field] @tag_field:{tag_value}
+The source field holds the app of a review (chatgpt, netflix or spotify) and created_timestamp its creation time as Unix timestamp.
+
+If the question asks for an average, a sum, a minimum, a maximum, a count per group or the top entries instead of a single count, return an aggregation as JSON instead of the query.
+"query" selects the rows like above or is * for all rows, "reduce" is one of count, sum, avg, min and max, "field" is the numeric field that is reduced, "group_by" is the field the rows are grouped by, "sort" is asc or desc and "limit" is the number of groups to return. Use null for everything that is not needed.
+Examples are:
+
+User question: What is the average age of users named Paul?
+Answer from you: {"query": "@user:Paul", "reduce": "avg", "field": "age", "group_by": null, "sort": null, "limit": null}
+
+User question: Which 3 cities have the most users?
+Answer from you: {"query": "*", "reduce": "count", "field": null, "group_by": "city", "sort": "desc", "limit": 3}
 
-Please always only return with the query! If you can't come up with a query only return the following two letters: na
+Please always only return with the query or the aggregation! If you can't come up with a query only return the following two letters: na
 
 The database schema is the following:
 numeric:
 - name: score
   no_index: false
-  sortable: false
+  sortable: true
 - name: likes
   no_index: false
-  sortable: false
+  sortable: true
 - name: likes_weighted
+  no_index: false
+  sortable: true
+- name: created_timestamp
   no_index: false
   sortable: false
+tag:
+- name: source
+  no_index: false
+  separator: ','
+  sortable: true
 text:
 - name: created_date
   no_index: false
@@ -71,7 +95,7 @@ text:
 - name: weekday
   no_index: false
   no_stem: false
-  sortable: false
+  sortable: true
   weight: 1
   withsuffixtrie: false
 - name: contains_source_word
@@ -92,3 +116,8 @@ REPHRASE_PROMPT = """
 Your only task is to formulate an answer based on the user question and answer you got:
 Make sure that you are specifically mentioning the number. Only write the answer and do not say that you are now reformulating it!
 """
+
+QUERY_RETRY_PROMPT = """
+Your query is not valid: {error}
+Please only return the corrected query! If you can't come up with a query only return the following two letters: na
+"""
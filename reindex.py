@@ -0,0 +1,85 @@
+"""
+Rebuilds the vector index without downtime.
+
+A new versioned index is built in the background with the pipeline of main.py while the app keeps
+querying the current index through REDIS_INDEX_ALIAS. Once the number of indexed documents matches
+the number of ingested reviews, the alias is swapped atomically to the new index and the old index
+is dropped together with its documents, ingestion state and rollups. The rollups of the new index
+are built by the pipeline and readers reload them once the alias is swapped. If the validation
+fails, the new index is dropped and the alias is left untouched.
+
+Usage (from the repository root):
+python reindex.py --profile hnsw-float16
+"""
+
+import argparse
+import sys
+import time
+
+from config import INDEX_PROFILES, REDIS_INDEX_ALIAS, REDIS_INDEX_PROFILE
+from llm import redis_client
+from main import run_pipeline
+from src.incremental import delete_state
+from src.rollups import invalidate_rollups
+from src.vector_index import (
+    document_count,
+    drop_index,
+    index_exists,
+    point_alias,
+    resolve_index,
+)
+
+
+def drop_index_and_state(index_name: str) -> None:
+    """
+    Drops an index, its documents and the ingestion state of its sources.
+
+    Parameters:
+    index_name (str): The name of the index.
+    """
+    if index_exists(redis_client, index_name):
+        drop_index(redis_client, index_name)
+    delete_state(redis_client, index_name)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--profile", choices=list(INDEX_PROFILES), default=REDIS_INDEX_PROFILE
+    )
+    parser.add_argument(
+        "--keep-old", action="store_true", help="Do not drop the previous index"
+    )
+    args = parser.parse_args()
+
+    old_index = resolve_index(redis_client, REDIS_INDEX_ALIAS)
+    new_index = f"{REDIS_INDEX_ALIAS}-{time.strftime('%Y%m%d%H%M%S')}"
+    print(f"Building {new_index} with profile {args.profile}")
+
+    counts = run_pipeline(new_index, args.profile)
+    expected = sum(counts.values())
+    indexed = (
+        document_count(redis_client, new_index)
+        if index_exists(redis_client, new_index)
+        else 0
+    )
+    if expected == 0 or indexed != expected:
+        print(
+            f"Validation failed: {indexed} documents indexed, {expected} expected. "
+            f"Dropping {new_index}, {REDIS_INDEX_ALIAS} still points to {old_index}"
+        )
+        drop_index_and_state(new_index)
+        return 1
+
+    point_alias(redis_client, REDIS_INDEX_ALIAS, new_index)
+    # The app answers from the rollups of the new index from now on
+    invalidate_rollups(redis_client)
+    print(f"{REDIS_INDEX_ALIAS} now points to {new_index} ({indexed} documents)")
+    if old_index is not None and not args.keep_old:
+        drop_index_and_state(old_index)
+        print(f"Dropped {old_index}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Serves the question router over HTTP for many concurrent users.
+
+POST /ask with a JSON body {"question": "..."} classifies the question and streams the answer as
+newline-delimited JSON: a 'meta' line with the class of the question and the queue wait, a
+'context' line with the retrieved reviews of qualitative questions (and of the qualitative parts of
+compound questions), one 'token' line per chunk of the answer and a final 'done' line. Every
+request holds a slot of the Ollama backend while it is answered, every sub-question of a compound
+question one of its own, and a slot of the Redis backend during every search. If the queue of a
+backend is full, the request is rejected with status 429, the position it would have had in the
+queue and a Retry-After header. GET /metrics returns the load, the queue wait and the service time
+of every backend. If TRACING_ENABLED is set, every request is traced and GET /metrics/prometheus
+returns the latency histograms of all stages.
+
+Usage (from the repository root):
+uvicorn server:app --port 8000
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Tuple
+
+from langchain_core.documents import Document
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.routing import Route
+
+from config import RETRIEVAL_PREFILTER, SERVER_BACKENDS
+from llm_async import (
+    answer_concurrently,
+    classify_question,
+    decompose_question,
+    embed_query,
+    execute_quantitative_query,
+    generate_quantitative_query,
+    question_filters,
+    rag_answer,
+    rephrase_answer,
+    search_nearest,
+)
+from src.admission import Backend, Overloaded
+from src.app_utils import async_stream_parser
+from src.compound import SubAnswer
+from src.tracing import new_trace, prometheus_text, record
+
+
+backends = {
+    name: Backend(name, settings["concurrency"], settings["queue_size"])
+    for name, settings in SERVER_BACKENDS.items()
+}
+
+
+def overloaded_response(error: Overloaded) -> JSONResponse:
+    """
+    Builds the response rejecting a request because a backend is overloaded.
+
+    Parameters:
+    error (Overloaded): The rejection.
+
+    Returns:
+    JSONResponse: The response with status 429.
+    """
+    return JSONResponse(
+        {
+            "error": str(error),
+            "backend": error.backend,
+            "queue_position": error.queue_position,
+            "queue_size": error.queue_size,
+        },
+        status_code=429,
+        headers={"Retry-After": "1"},
+    )
+
+
+async def prepare_branch(question: str, question_class: str) -> SubAnswer:
+    """
+    Starts the answer stream of a quantitative or qualitative question.
+
+    The searches acquire a slot of the Redis backend, every other class is answered as qualitative.
+
+    Parameters:
+    question (str): The question to be answered.
+    question_class (str): The class of the question in lower case.
+
+    Returns:
+    SubAnswer: The class of the question, its answer stream and the retrieved reviews.
+    """
+    if question_class == "quantitative":
+        query = await generate_quantitative_query(question)
+        answer = "na"
+        if query != "na":
+            async with backends["redis"].slot():
+                answer = await execute_quantitative_query(query)
+        stream = await rephrase_answer(question, answer)
+        return SubAnswer(question, question_class, stream, [], "ollama")
+    vector = await embed_query(question)
+    filter_expression = "*"
+    if RETRIEVAL_PREFILTER:
+        # The fields of the index are reloaded with a blocking FT.INFO from time to time
+        filter_expression = await asyncio.to_thread(question_filters, question)
+    async with backends["redis"].slot():
+        context = await search_nearest(vector, filter_expression)
+    stream = await rag_answer(question, context)
+    return SubAnswer(question, "qualitative", stream, context, "langchain")
+
+
+async def prepare_part(question: str) -> SubAnswer:
+    """
+    Classifies a sub-question of a compound question and starts its answer stream.
+
+    Parameters:
+    question (str): The sub-question.
+
+    Returns:
+    SubAnswer: The class of the sub-question, its answer stream and the retrieved reviews.
+    """
+    question_class = (await classify_question(question)).strip().lower()
+    return await prepare_branch(question, question_class)
+
+
+async def prepare_answer(
+    question: str, release: Callable[[], None]
+) -> Tuple[str, AsyncIterator[Dict[str, Any]], List[Document], str]:
+    """
+    Classifies a question and starts the answer stream of its class.
+
+    The caller holds a slot of the Ollama backend, the searches acquire a slot of the Redis backend.
+    Compound questions are split into sub-questions, which are classified and answered
+    concurrently, and their answers are merged into one stream. Every sub-question holds a slot of
+    the Ollama backend of its own while it is answered. The slot of the request is released before,
+    so no request waits for a slot while holding one.
+
+    Parameters:
+    question (str): The question to be answered.
+    release (Callable[[], None]): Releases the slot of the request.
+
+    Returns:
+    Tuple[str, AsyncIterator[Dict[str, Any]], List[Document], str]: The class of the question, the
+    answer stream, the retrieved reviews and the type of the stream for async_stream_parser.
+    """
+    question_class = (await classify_question(question)).strip().lower()
+    if question_class != "compound":
+        # Unknown classes are answered like qualitative questions
+        part = await prepare_branch(question, question_class)
+        return part.question_class, part.stream, part.context, part.model_type
+    sub_questions = await decompose_question(question)
+    release()
+    stream, context = await answer_concurrently(
+        sub_questions, prepare_part, backends["ollama"].slot
+    )
+    return question_class, stream, context, "ollama"
+
+
+def _line(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, default=str) + "\n"
+
+
+async def ask(request: Request) -> Response:
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JSONResponse({"error": "body must be valid JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "body must be a JSON object"}, status_code=400)
+    question = body.get("question")
+    if not isinstance(question, str) or not question.strip():
+        return JSONResponse({"error": "question is required"}, status_code=400)
+    new_trace()
+
+    ollama = backends["ollama"]
+    queue_position = ollama.queue_position()
+    start = time.perf_counter()
+    try:
+        acquired = await ollama.acquire()
+    except Overloaded as error:
+        return overloaded_response(error)
+    queue_wait = acquired - start
+    record("queue_wait.ollama", queue_wait, queue_position=queue_position)
+    released = False
+
+    def release() -> None:
+        # Runs at the end of the stream, or as background task if the stream never started
+        nonlocal released
+        if not released:
+            released = True
+            ollama.release(acquired)
+
+    try:
+        question_class, stream, context, model_type = await prepare_answer(
+            question, release
+        )
+    except Overloaded as error:
+        release()
+        return overloaded_response(error)
+    except BaseException:
+        release()
+        raise
+
+    async def body_stream() -> AsyncIterator[str]:
+        try:
+            yield _line(
+                {
+                    "type": "meta",
+                    "question_class": question_class,
+                    "queue_position": queue_position,
+                    "queue_wait_seconds": queue_wait,
+                }
+            )
+            if context:
+                yield _line(
+                    {
+                        "type": "context",
+                        "documents": [
+                            {"content": doc.page_content, "metadata": doc.metadata}
+                            for doc in context
+                        ],
+                    }
+                )
+            async for token in async_stream_parser(stream, model_type):
+                yield _line({"type": "token", "content": token})
+            yield _line({"type": "done"})
+        finally:
+            release()
+
+    return StreamingResponse(
+        body_stream(),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(release),
+    )
+
+
+async def metrics(request: Request) -> Response:
+    return JSONResponse({name: backend.stats() for name, backend in backends.items()})
+
+
+async def prometheus_metrics(request: Request) -> Response:
+    return PlainTextResponse(prometheus_text())
+
+
+async def health(request: Request) -> Response:
+    return JSONResponse({"status": "ok"})
+
+
+app = Starlette(
+    routes=[
+        Route("/ask", ask, methods=["POST"]),
+        Route("/metrics", metrics),
+        Route("/metrics/prometheus", prometheus_metrics),
+        Route("/health", health),
+    ]
+)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Dict
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot even be queued for a backend.
+
+    backend (str): The name of the backend.
+    queue_position (int): The position the request would have had in the queue.
+    queue_size (int): The maximum number of waiting requests of the backend.
+    """
+
+    def __init__(self, backend: str, queue_position: int, queue_size: int):
+        super().__init__(
+            f"{backend} is overloaded ({queue_position - 1} of {queue_size} queued)"
+        )
+        self.backend = backend
+        self.queue_position = queue_position
+        self.queue_size = queue_size
+
+
+class Backend:
+    """
+    Admission control for a backend like Ollama or Redis.
+
+    At most concurrency requests are served by the backend at the same time and at most queue_size
+    requests wait for a free slot, further requests are rejected right away with Overloaded instead
+    of making every queued request slower. The time requests wait in the queue and the time they
+    hold a slot are recorded separately. The methods must be called from a single event loop.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.waiting = 0
+        self.in_service = 0
+        self.counts = {"admitted": 0, "rejected": 0}
+        self.seconds = {"queue_wait": [0, 0.0, 0.0], "service": [0, 0.0, 0.0]}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _record(self, metric: str, seconds: float) -> None:
+        count, total, maximum = self.seconds[metric]
+        self.seconds[metric] = [count + 1, total + seconds, max(maximum, seconds)]
+
+    def queue_position(self) -> int:
+        """
+        Returns the position a new request would get in the queue.
+
+        Returns:
+        int: The position, 0 if a slot is free.
+        """
+        return self.waiting + 1 if self._semaphore.locked() else 0
+
+    async def acquire(self) -> float:
+        """
+        Waits for a free slot of the backend.
+
+        Returns:
+        float: The time the slot was acquired, to be passed to release.
+        """
+        position = self.queue_position()
+        if position > self.queue_size:
+            self.counts["rejected"] += 1
+            raise Overloaded(self.name, position, self.queue_size)
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        acquired = time.perf_counter()
+        self._record("queue_wait", acquired - start)
+        self.counts["admitted"] += 1
+        self.in_service += 1
+        return acquired
+
+    def release(self, acquired: float) -> None:
+        """
+        Releases a slot of the backend.
+
+        Parameters:
+        acquired (float): The time the slot was acquired, as returned by acquire.
+        """
+        self.in_service -= 1
+        self._semaphore.release()
+        self._record("service", time.perf_counter() - acquired)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncGenerator[None, None]:
+        """
+        Holds a slot of the backend for the enclosed block.
+        """
+        acquired = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(acquired)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the current load and the queue wait and service time statistics of the backend.
+
+        Returns:
+        Dict[str, float]: The statistics.
+        """
+        stats = {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "in_service": self.in_service,
+            "waiting": self.waiting,
+            **self.counts,
+        }
+        for metric, (count, total, maximum) in self.seconds.items():
+            stats[f"{metric}_count"] = count
+            stats[f"{metric}_seconds_total"] = round(total, 6)
+            stats[f"{metric}_seconds_max"] = round(maximum, 6)
+        return stats
@@ -0,0 +1,251 @@
+import json
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
+from redis.commands.search import reducers
+from redis.commands.search.aggregation import AggregateRequest, Asc, Desc
+
+from src.query_parser import QueryError, parse_query
+
+
+REDUCERS = {
+    "count": reducers.count,
+    "sum": reducers.sum,
+    "avg": reducers.avg,
+    "min": reducers.min,
+    "max": reducers.max,
+}
+
+VALUE = "value"
+
+
+class AggregationPlan(NamedTuple):
+    """
+    An aggregation over the reviews matching a query, computed by FT.AGGREGATE.
+
+    query (str): The canonical query selecting the reviews, '*' for all reviews.
+    reduce (str): The reducer, one of REDUCERS.
+    field (Optional[str]): The numeric field that is reduced, None for 'count'.
+    group_by (Optional[str]): The field the reviews are grouped by, None for a single value.
+    sort (Optional[str]): 'asc' or 'desc' to sort the groups by their value.
+    limit (Optional[int]): The maximum number of groups, e.g. for top-N questions.
+    """
+
+    query: str
+    reduce: str
+    field: Optional[str] = None
+    group_by: Optional[str] = None
+    sort: Optional[str] = None
+    limit: Optional[int] = None
+
+
+def is_plan(text: str) -> bool:
+    """
+    Returns whether a response of the chat model is an aggregation plan rather than a query.
+
+    Parameters:
+    text (str): The response.
+
+    Returns:
+    bool: True if the response is a JSON object.
+    """
+    return re.sub(r"^`*(json)?\s*", "", text.strip()).startswith("{")
+
+
+def parse_plan(text: str, fields: Dict[str, str]) -> AggregationPlan:
+    """
+    Validates an aggregation plan written as JSON by the chat model.
+
+    Parameters:
+    text (str): The JSON object, optionally in a code block.
+    fields (Dict[str, str]): The queryable fields as returned by query_fields.
+
+    Returns:
+    AggregationPlan: The plan with a canonical query.
+    """
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    try:
+        plan = json.loads(match.group(0) if match else text)
+    except json.JSONDecodeError as e:
+        raise QueryError(f"the aggregation is not valid JSON ({e})") from None
+    if not isinstance(plan, dict):
+        raise QueryError("the aggregation must be a JSON object")
+    unknown = set(plan) - set(AggregationPlan._fields)
+    if unknown:
+        raise QueryError(
+            f"unknown keys {', '.join(sorted(unknown))} in the aggregation"
+        )
+
+    query = str(plan.get("query") or "*").strip()
+    query = "*" if query == "*" else parse_query(query, fields)
+    if query == "na":
+        raise QueryError("the query of the aggregation is 'na'")
+
+    reduce = str(plan.get("reduce") or "count").lower()
+    if reduce not in REDUCERS:
+        raise QueryError(
+            f"unknown reducer '{reduce}', the reducers are {', '.join(REDUCERS)}"
+        )
+    field = plan.get("field") or None
+    if reduce == "count":
+        field = None
+    elif not isinstance(field, str) or fields.get(field) != "numeric":
+        raise QueryError(f"{reduce} needs a numeric field, not '{field}'")
+
+    group_by = plan.get("group_by") or None
+    if group_by is not None and (
+        not isinstance(group_by, str) or group_by not in fields
+    ):
+        raise QueryError(f"cannot group by unknown field '{group_by}'")
+
+    sort = plan.get("sort") or None
+    if sort is not None:
+        sort = str(sort).lower()
+        if sort not in ("asc", "desc"):
+            raise QueryError("sort must be 'asc' or 'desc'")
+
+    limit = plan.get("limit")
+    if limit is not None:
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            raise QueryError("limit must be a positive integer")
+        # The top-N groups are the largest ones unless asked otherwise
+        sort = sort or "desc"
+
+    if group_by is None:
+        sort, limit = None, None
+    return AggregationPlan(query, reduce, field, group_by, sort, limit)
+
+
+def plan_json(plan: AggregationPlan) -> str:
+    """
+    Serialises an aggregation plan in its canonical form, so equivalent plans share a cache entry.
+
+    Parameters:
+    plan (AggregationPlan): The plan.
+
+    Returns:
+    str: The plan as JSON with sorted keys.
+    """
+    return json.dumps(plan._asdict(), sort_keys=True)
+
+
+def canonical_request(text: str, fields: Dict[str, str]) -> str:
+    """
+    Validates the response of the chat model to a quantitative question and returns its canonical
+    form, either the canonical query of a count or the canonical JSON of an aggregation plan.
+
+    Parameters:
+    text (str): The response.
+    fields (Dict[str, str]): The queryable fields as returned by query_fields.
+
+    Returns:
+    str: The canonical query or plan, or "na".
+    """
+    if is_plan(text):
+        return plan_json(parse_plan(text, fields))
+    return parse_query(text, fields)
+
+
+def sortable_fields(schema: Dict[str, Any]) -> Set[str]:
+    """
+    Returns the names of the sortable fields of the schema, whose values FT.AGGREGATE reads from
+    the index instead of loading them from the documents.
+
+    Parameters:
+    schema (Dict[str, Any]): The index schema as returned by load_schema.
+
+    Returns:
+    Set[str]: The names of the sortable fields.
+    """
+    return {
+        field["name"]
+        for field_type in ("text", "numeric", "tag")
+        for field in schema.get(field_type, [])
+        if field.get("sortable", False)
+    }
+
+
+def aggregate_request(plan: AggregationPlan, sortable: Set[str]) -> AggregateRequest:
+    """
+    Builds the FT.AGGREGATE request of an aggregation plan.
+
+    Parameters:
+    plan (AggregationPlan): The plan.
+    sortable (Set[str]): The sortable fields, all other fields of the plan are loaded.
+
+    Returns:
+    AggregateRequest: The request.
+    """
+    request = AggregateRequest(plan.query)
+    load = [
+        f"@{field}"
+        for field in dict.fromkeys((plan.group_by, plan.field))
+        if field is not None and field not in sortable
+    ]
+    if load:
+        request.load(*load)
+    reducer = REDUCERS[plan.reduce]
+    reducer = reducer() if plan.field is None else reducer(f"@{plan.field}")
+    group_by = [] if plan.group_by is None else [f"@{plan.group_by}"]
+    request.group_by(group_by, reducer.alias(VALUE))
+    if plan.sort is not None:
+        order = Desc if plan.sort == "desc" else Asc
+        request.sort_by(order(f"@{VALUE}"), max=plan.limit or 0)
+    if plan.limit is not None:
+        request.limit(0, plan.limit)
+    return request
+
+
+def _decode(value: Any) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.2f}"
+
+
+def format_aggregate(plan: AggregationPlan, values: Dict[Optional[str], float]) -> str:
+    """
+    Formats the values of an aggregation as the answer to be rephrased.
+
+    The groups are sorted and limited as the plan asks for, otherwise sorted by name.
+
+    Parameters:
+    plan (AggregationPlan): The plan of the aggregation.
+    values (Dict[Optional[str], float]): The value of every group, keyed by None without groups.
+
+    Returns:
+    str: The value, or one 'group: value' entry per group.
+    """
+    if plan.group_by is None:
+        if None not in values:
+            return "0" if plan.reduce in ("count", "sum") else "na"
+        return _format_value(values[None])
+    if not values:
+        return "no reviews"
+    groups = sorted(values.items(), key=lambda item: str(item[0]))
+    if plan.sort is not None:
+        groups.sort(key=lambda item: item[1], reverse=plan.sort == "desc")
+    if plan.limit is not None:
+        groups = groups[: plan.limit]
+    return "; ".join(f"{group}: {_format_value(value)}" for group, value in groups)
+
+
+def aggregate_answer(plan: AggregationPlan, rows: List[List[Any]]) -> str:
+    """
+    Formats the rows returned by FT.AGGREGATE as the answer to be rephrased.
+
+    Parameters:
+    plan (AggregationPlan): The plan of the aggregation.
+    rows (List[List[Any]]): The rows of the result, each a flat list of names and values.
+
+    Returns:
+    str: The value, or one 'group: value' entry per group.
+    """
+    values = {}
+    for row in rows:
+        record = dict(zip(map(_decode, row[::2]), map(_decode, row[1::2])))
+        values[record.get(plan.group_by, "none") if plan.group_by else None] = float(
+            record[VALUE]
+        )
+    return format_aggregate(plan, values)
@@ -1,7 +1,17 @@
-from typing import Any, Dict, Generator, Iterable
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Generator,
+    Iterable,
+)
 import uuid
 import streamlit as st
 
+from src.tracing import is_enabled, observe_tokens, observe_tokens_async
+
 
 def stream_parser(
     stream: Iterable[Dict[str, Any]], model_type: str
@@ -14,6 +24,9 @@ def stream_parser(
     the key 'answer' and if so, yields the value associated with this key. If the model type is neither
     'ollama' nor 'langchain', it raises a NotImplementedError.
 
+    If the tracing is enabled, the time to first token and the tokens per second of the stream are
+    recorded.
+
     Parameters:
     stream (Iterable[Dict[str, Any]]): The stream of dictionaries to parse.
     model_type (str): The type of model that generated the stream.
@@ -21,6 +34,15 @@ def stream_parser(
     Returns:
     Generator[str, None, None]: A generator that yields the parsed content from the stream.
     """
+    if is_enabled():
+        yield from observe_tokens(_parse_stream(stream, model_type))
+    else:
+        yield from _parse_stream(stream, model_type)
+
+
+def _parse_stream(
+    stream: Iterable[Dict[str, Any]], model_type: str
+) -> Generator[str, None, None]:
     if model_type == "ollama":
         for chunk in stream:
             yield chunk["message"]["content"]
@@ -101,3 +123,52 @@ def get_context(stream: Iterable[Dict[str, Any]]) -> Any:
     for chunk in stream:
         if "context" in chunk.keys():
             return chunk["context"]
+
+
+async def async_stream_parser(
+    stream: AsyncIterable[Dict[str, Any]], model_type: str
+) -> AsyncGenerator[str, None]:
+    """
+    Parses an asynchronous stream of dictionaries based on the model type, like stream_parser.
+
+    Parameters:
+    stream (AsyncIterable[Dict[str, Any]]): The stream of dictionaries to parse.
+    model_type (str): The type of model that generated the stream.
+
+    Returns:
+    AsyncGenerator[str, None]: An async generator that yields the parsed content from the stream.
+    """
+    tokens = _parse_stream_async(stream, model_type)
+    if is_enabled():
+        tokens = observe_tokens_async(tokens)
+    async for token in tokens:
+        yield token
+
+
+async def _parse_stream_async(
+    stream: AsyncIterable[Dict[str, Any]], model_type: str
+) -> AsyncGenerator[str, None]:
+    if model_type == "ollama":
+        async for chunk in stream:
+            yield chunk["message"]["content"]
+    elif model_type == "langchain":
+        async for chunk in stream:
+            if "answer" in chunk.keys():
+                yield chunk["answer"]
+    else:
+        raise NotImplementedError
+
+
+async def async_get_context(stream: AsyncIterator[Dict[str, Any]]) -> Any:
+    """
+    Extracts the 'context' from an asynchronous stream of dictionaries, like get_context.
+
+    Parameters:
+    stream (AsyncIterator[Dict[str, Any]]): The stream of dictionaries to search for the 'context'.
+
+    Returns:
+    Any: The value associated with the 'context' key, or None if no such key is found.
+    """
+    async for chunk in stream:
+        if "context" in chunk.keys():
+            return chunk["context"]
@@ -0,0 +1,95 @@
+import re
+from typing import Any, Dict, List, NamedTuple
+
+from langchain_core.documents import Document
+
+
+# Numbering or bullets the chat model puts in front of the sub-questions
+ENUMERATION = re.compile(r"^\s*(?:[-*•]|\d+[.)]|q\d+\s*[:.)])\s*", re.IGNORECASE)
+
+
+class SubAnswer(NamedTuple):
+    """
+    The answer of one sub-question of a compound question.
+
+    question (str): The sub-question.
+    question_class (str): The class of the sub-question, 'quantitative' or 'qualitative'.
+    stream (Any): The answer stream, synchronous or asynchronous.
+    context (List[Document]): The retrieved reviews, empty unless the sub-question is qualitative.
+    model_type (str): The type of the stream, 'ollama' or 'langchain'.
+    """
+
+    question: str
+    question_class: str
+    stream: Any
+    context: List[Document]
+    model_type: str
+
+
+def parse_sub_questions(text: str, question: str, max_questions: int) -> List[str]:
+    """
+    Parses the sub-questions the chat model split a compound question into.
+
+    Parameters:
+    text (str): The response of the chat model, one sub-question per line.
+    question (str): The compound question, used if the response contains no sub-question.
+    max_questions (int): The maximum number of sub-questions.
+
+    Returns:
+    List[str]: The distinct sub-questions in their order.
+    """
+    questions: Dict[str, str] = {}
+    for line in text.splitlines():
+        line = ENUMERATION.sub("", line).strip().strip("\"'").strip()
+        # Introductions like 'Here are the questions:' are no questions
+        if not line or line.endswith(":"):
+            continue
+        questions.setdefault(line.lower(), line)
+    return list(questions.values())[:max_questions] or [question]
+
+
+def chunk_text(chunk: Dict[str, Any], model_type: str) -> str:
+    """
+    Returns the text of a chunk of an answer stream.
+
+    Parameters:
+    chunk (Dict[str, Any]): The chunk.
+    model_type (str): The type of the stream, 'ollama' or 'langchain'.
+
+    Returns:
+    str: The text of the chunk, empty for chunks without answer like the context of the RAG pipeline.
+    """
+    if model_type == "ollama":
+        return chunk["message"]["content"]
+    return chunk.get("answer", "")
+
+
+def part_header(question: str, position: int) -> str:
+    """
+    Returns the heading that introduces the answer of a sub-question in the merged answer.
+
+    Parameters:
+    question (str): The sub-question.
+    position (int): The position of the sub-question, starting at 0.
+
+    Returns:
+    str: The sub-question in bold, separated from the previous answer.
+    """
+    return ("" if position == 0 else "\n\n") + f"**{question}**\n\n"
+
+
+def merged_context(parts: List[SubAnswer]) -> List[Document]:
+    """
+    Collects the reviews retrieved for all sub-questions, every review once.
+
+    Parameters:
+    parts (List[SubAnswer]): The answers of the sub-questions.
+
+    Returns:
+    List[Document]: The retrieved reviews in the order of the sub-questions.
+    """
+    documents: Dict[Any, Document] = {}
+    for part in parts:
+        for document in part.context:
+            documents.setdefault(document.metadata.get("id", id(document)), document)
+    return list(documents.values())
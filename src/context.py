@@ -0,0 +1,163 @@
+import re
+from typing import Dict, FrozenSet, List, Tuple
+
+from langchain_core.documents import Document
+
+
+# Word pieces of at most four characters and single punctuation marks, which is close to the number
+# of tokens the llama3 tokenizer produces for English reviews
+TOKEN = re.compile(r"\w{1,4}|[^\w\s]")
+
+ELLIPSIS = " ..."
+
+# Documents are not cut shorter than this, the rest of the budget stays unused instead
+MIN_DOC_TOKENS = 16
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text without loading the tokenizer of the chat model.
+
+    Parameters:
+    text (str): The text.
+
+    Returns:
+    int: The estimated number of tokens.
+    """
+    return len(TOKEN.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncates a text to an estimated number of tokens, marking the cut with an ellipsis.
+
+    Parameters:
+    text (str): The text.
+    max_tokens (int): The maximum number of tokens.
+
+    Returns:
+    str: The text, or its beginning if it is longer than max_tokens.
+    """
+    matches = list(TOKEN.finditer(text))
+    if len(matches) <= max_tokens:
+        return text
+    keep = max(max_tokens - estimate_tokens(ELLIPSIS), 1)
+    return text[: matches[keep - 1].end()].rstrip() + ELLIPSIS
+
+
+def _shingles(text: str) -> FrozenSet[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return frozenset(words)
+    return frozenset(" ".join(words[i : i + 3]) for i in range(len(words) - 2))
+
+
+def _jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _relevance(docs: List[Document]) -> List[float]:
+    # The cosine distance of the KNN search if present, otherwise the rank
+    return [
+        1.0 - float(doc.metadata.get("vector_distance", i / len(docs)))
+        for i, doc in enumerate(docs)
+    ]
+
+
+def remove_near_duplicates(docs: List[Document], threshold: float) -> List[Document]:
+    """
+    Removes documents whose word trigrams overlap with those of a more relevant document by at
+    least the threshold (Jaccard similarity), e.g. reposted or copy-pasted reviews.
+
+    Parameters:
+    docs (List[Document]): The documents, ordered by relevance.
+    threshold (float): The similarity from which a document is a near-duplicate.
+
+    Returns:
+    List[Document]: The documents without near-duplicates, in their original order.
+    """
+    kept: List[Tuple[Document, FrozenSet[str]]] = []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        if all(_jaccard(shingles, other) < threshold for _, other in kept):
+            kept.append((doc, shingles))
+    return [doc for doc, _ in kept]
+
+
+def mmr_order(docs: List[Document], diversity: float) -> List[Document]:
+    """
+    Orders documents by maximal marginal relevance, so each next document is relevant to the
+    question but unlike the documents before it.
+
+    The relevance is taken from the vector distance of the KNN search and the similarity between
+    documents is the overlap of their words, so no embeddings are needed.
+
+    Parameters:
+    docs (List[Document]): The documents, ordered by relevance.
+    diversity (float): The weight of the dissimilarity, 0 keeps the order of relevance.
+
+    Returns:
+    List[Document]: The documents in MMR order.
+    """
+    relevance = _relevance(docs)
+    words = [frozenset(re.findall(r"\w+", doc.page_content.lower())) for doc in docs]
+    remaining = list(range(len(docs)))
+    order: List[int] = []
+    while remaining:
+        best = max(
+            remaining,
+            key=lambda i: (1 - diversity) * relevance[i]
+            - diversity
+            * max((_jaccard(words[i], words[j]) for j in order), default=0.0),
+        )
+        order.append(best)
+        remaining.remove(best)
+    return [docs[i] for i in order]
+
+
+def assemble_context(
+    docs: List[Document],
+    token_budget: int,
+    max_doc_tokens: int,
+    duplicate_threshold: float,
+    diversity: float,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    Assembles the context of the RAG prompt from the retrieved documents.
+
+    Near-duplicates are removed, the rest is ordered by maximal marginal relevance and added until
+    the token budget is spent. Every document is truncated to max_doc_tokens and to the rest of the
+    budget, documents that would be cut to less than MIN_DOC_TOKENS are skipped.
+
+    Parameters:
+    docs (List[Document]): The retrieved documents, ordered by relevance.
+    token_budget (int): The maximum number of tokens of the context.
+    max_doc_tokens (int): The maximum number of tokens of a single document.
+    duplicate_threshold (float): The similarity from which a document is a near-duplicate.
+    diversity (float): The weight of the dissimilarity in the MMR order.
+
+    Returns:
+    Tuple[str, Dict[str, int]]: The context and the number of documents and tokens before and after
+    the assembly.
+    """
+    stats = {
+        "docs_in": len(docs),
+        "tokens_in": sum(estimate_tokens(doc.page_content) for doc in docs),
+    }
+    candidates = mmr_order(remove_near_duplicates(docs, duplicate_threshold), diversity)
+
+    parts: List[str] = []
+    tokens = 0
+    for doc in candidates:
+        remaining = min(max_doc_tokens, token_budget - tokens)
+        doc_tokens = estimate_tokens(doc.page_content)
+        # Shorter documents may still fit completely after a long one was skipped
+        if doc_tokens > remaining and remaining < MIN_DOC_TOKENS:
+            continue
+        text = truncate_tokens(doc.page_content, remaining)
+        parts.append(text)
+        tokens += min(doc_tokens, estimate_tokens(text))
+    stats.update(docs_out=len(parts), tokens_out=tokens)
+    return "\n\n".join(parts), stats
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache for document embeddings.
+
+    Every entry is keyed by a 16 byte BLAKE2 digest of the model name and the text. The vectors
+    are stored in a memory-mapped float32 matrix with one row per slot, the keys and the last
+    access of every slot are kept in a compact index next to it. Once all slots are in use the
+    least recently used entries are evicted. The index is written before evicted slots are reused,
+    so after a crash no key points to the vector of another text. Embeddings with a different
+    number of dimensions, e.g. of a new embedding model, replace all entries of the cache.
+
+    Parameters:
+    path (str): The directory in which the matrix and the index are stored.
+    capacity (int): The maximum number of embeddings kept in the cache.
+    """
+
+    EVICTION_FRACTION = 0.01
+
+    def __init__(self, path: str, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.path = path
+        self.capacity = capacity
+        self.dim = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._slots: Dict[bytes, int] = {}
+        self._keys = np.zeros((capacity, 16), dtype=np.uint8)
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        self._clock = 0
+        self._free: List[int] = list(range(capacity - 1, -1, -1))
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.path, "index.npz")
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        """
+        Returns the content address of a text embedded with a given model.
+
+        Parameters:
+        model (str): The name of the embedding model.
+        text (str): The embedded text.
+
+        Returns:
+        bytes: The 16 byte digest of the model name and the text.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.digest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Looks up the embeddings of the given texts.
+
+        Parameters:
+        model (str): The name of the embedding model.
+        texts (List[str]): The texts to look up.
+
+        Returns:
+        List[Optional[List[float]]]: The cached embedding of every text, or None for cache misses.
+        """
+        keys = [self.key(model, text) for text in texts]
+        with self._lock:
+            results = []
+            for key in keys:
+                slot = self._slots.get(key)
+                if slot is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self._clock += 1
+                self._last_used[slot] = self._clock
+                results.append(self._vectors[slot].tolist())
+            return results
+
+    def put_many(
+        self, model: str, texts: List[str], vectors: List[List[float]]
+    ) -> None:
+        """
+        Stores the embeddings of the given texts, evicting the least recently used entries if needed.
+
+        Parameters:
+        model (str): The name of the embedding model.
+        texts (List[str]): The embedded texts.
+        vectors (List[List[float]]): The embeddings of the texts.
+        """
+        if not texts:
+            return
+        with self._lock:
+            if self.dim != len(vectors[0]):
+                self._reset(len(vectors[0]))
+            for text, vector in zip(texts, vectors):
+                if len(vector) != self.dim:
+                    raise ValueError(
+                        f"Expected an embedding with {self.dim} dimensions, got {len(vector)}"
+                    )
+                key = self.key(model, text)
+                slot = self._slots.get(key)
+                if slot is None:
+                    if not self._free:
+                        self._evict()
+                    slot = self._free.pop()
+                    self._slots[key] = slot
+                    self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+                self._clock += 1
+                self._last_used[slot] = self._clock
+                self._vectors[slot] = vector
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit/miss statistics and the fill level of the cache.
+
+        Returns:
+        Dict[str, float]: The hits, misses, hit rate, evictions and number of cached entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size": len(self._slots),
+            "capacity": self.capacity,
+        }
+
+    def flush(self) -> None:
+        """
+        Writes the vectors and the key index to disk.
+        """
+        with self._lock:
+            if self._vectors is not None:
+                self._write_index()
+
+    def _write_index(self) -> None:
+        # The vectors are on disk before the index points to them
+        self._vectors.flush()
+        used = np.zeros(self.capacity, dtype=bool)
+        used[list(self._slots.values())] = True
+        tmp_path = self._index_path + ".tmp.npz"
+        np.savez(tmp_path, keys=self._keys, last_used=self._last_used, used=used)
+        os.replace(tmp_path, self._index_path)
+        with open(self._meta_path, "w") as f:
+            json.dump({"dim": self.dim, "capacity": self.capacity}, f)
+
+    def _open_vectors(self, dim: int, mode: str) -> None:
+        self.dim = dim
+        self._vectors = np.memmap(
+            self._vectors_path,
+            dtype=np.float32,
+            mode=mode,
+            shape=(self.capacity, dim),
+        )
+
+    def _reset(self, dim: int) -> None:
+        # Entries of another dimension cannot be reused, the cache starts empty
+        if os.path.exists(self._meta_path):
+            os.remove(self._meta_path)
+        self._vectors = None
+        self._slots = {}
+        self._keys[:] = 0
+        self._last_used[:] = 0
+        self._clock = 0
+        self._free = list(range(self.capacity - 1, -1, -1))
+        self._open_vectors(dim, mode="w+")
+
+    def _load(self) -> None:
+        if not (
+            os.path.exists(self._meta_path)
+            and os.path.exists(self._index_path)
+            and os.path.exists(self._vectors_path)
+        ):
+            return
+        with open(self._meta_path) as f:
+            meta = json.load(f)
+        if meta["capacity"] != self.capacity:
+            # A resized cache starts empty instead of remapping every slot
+            return
+        self._open_vectors(meta["dim"], mode="r+")
+        index = np.load(self._index_path)
+        self._keys = index["keys"]
+        self._last_used = index["last_used"]
+        used = index["used"]
+        self._slots = {
+            self._keys[slot].tobytes(): int(slot) for slot in np.flatnonzero(used)
+        }
+        self._free = [int(slot) for slot in np.flatnonzero(~used)[::-1]]
+        self._clock = int(self._last_used.max(initial=0))
+
+    def _evict(self) -> None:
+        count = max(1, int(self.capacity * self.EVICTION_FRACTION))
+        slots = np.argpartition(self._last_used, count - 1)[:count]
+        for slot in slots:
+            del self._slots[self._keys[slot].tobytes()]
+            self._last_used[slot] = 0
+            self._free.append(int(slot))
+        self.evictions += count
+        # The index on disk must not point to the evicted slots once they are overwritten
+        self._write_index()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that serve documents from an EmbeddingCache and only embed cache misses.
+
+    Parameters:
+    embedder (Embeddings): The embedding model used for cache misses and queries.
+    cache (EmbeddingCache): The cache holding previously computed document embeddings.
+    model (str): The name of the embedding model, part of every cache key.
+    """
+
+    def __init__(self, embedder: Embeddings, cache: EmbeddingCache, model: str):
+        self.embedder = embedder
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(self.model, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embedder.embed_documents([texts[i] for i in missing])
+            self.cache.put_many(self.model, [texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedder.embed_query(text)
@@ -0,0 +1,181 @@
+import re
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.query_parser import QueryError, parse_query
+
+
+SOURCE_ALIASES = {
+    "chatgpt": ("chatgpt", "chat gpt", "openai"),
+    "netflix": ("netflix",),
+    "spotify": ("spotify",),
+}
+
+WEEKDAYS = (
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+)
+
+MONTHS = (
+    "january",
+    "february",
+    "march",
+    "april",
+    "may",
+    "june",
+    "july",
+    "august",
+    "september",
+    "october",
+    "november",
+    "december",
+)
+
+NUMBERS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+
+_STAR = r"([1-5]|one|two|three|four|five)"
+_STARS = rf"{_STAR}(?:[- ]stars?|\s*/\s*5)"
+_DATE = rf"(?:({'|'.join(MONTHS)})\s+)?((?:19|20)\d\d)"
+
+
+def _star(text: str) -> int:
+    return NUMBERS.get(text) or int(text)
+
+
+def _timestamp(year: int, month: int = 1) -> int:
+    if month > 12:
+        year, month = year + 1, 1
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp())
+
+
+def _period(month: Optional[str], year: str) -> Tuple[int, int]:
+    # The first second of the month or year and the first second after it
+    if month is None:
+        return _timestamp(int(year)), _timestamp(int(year) + 1)
+    number = MONTHS.index(month) + 1
+    return _timestamp(int(year), number), _timestamp(int(year), number + 1)
+
+
+def _sources(text: str) -> List[str]:
+    return [
+        source
+        for source, aliases in SOURCE_ALIASES.items()
+        if any(re.search(rf"\b{re.escape(alias)}\b", text) for alias in aliases)
+    ]
+
+
+def _score(text: str) -> Optional[Tuple[int, int]]:
+    match = re.search(rf"(?:between )?{_STAR} (?:and|or|to) {_STARS}", text)
+    if match:
+        low, high = sorted((_star(match.group(1)), _star(match.group(2))))
+        return low, high
+    match = re.search(rf"(at least|at most|minimum|maximum)\s+{_STARS}", text)
+    if match:
+        stars = _star(match.group(2))
+        return (stars, 5) if match.group(1) in ("at least", "minimum") else (1, stars)
+    match = re.search(
+        rf"(?:(?:rated|rating of|score of)\s+([1-5])\b|{_STARS})(?:\s+\w+)?\s+or\s+"
+        r"(more|higher|better|above|less|lower|worse|below)",
+        text,
+    )
+    if match:
+        stars = _star(match.group(1) or match.group(2))
+        return (
+            (stars, 5)
+            if match.group(3) in ("more", "higher", "better", "above")
+            else (1, stars)
+        )
+    match = re.search(rf"(?:rated|rating of|score of)\s+([1-5])\b|{_STARS}", text)
+    if match:
+        stars = _star(match.group(1) or match.group(2))
+        return stars, stars
+    return None
+
+
+def _weekdays(text: str) -> List[str]:
+    days = [day for day in WEEKDAYS if re.search(rf"\b{day}s?\b", text)]
+    if re.search(r"\bweekends?\b", text):
+        days += ["saturday", "sunday"]
+    if re.search(r"\b(on|during) (weekdays|workdays|working days)\b", text):
+        days += WEEKDAYS[:5]
+    return sorted(set(days), key=WEEKDAYS.index)
+
+
+def _dates(text: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    match = re.search(rf"between {_DATE} and {_DATE}", text)
+    if match:
+        start, _ = _period(match.group(1), match.group(2))
+        _, end = _period(match.group(3), match.group(4))
+        return start, end
+    match = re.search(
+        rf"\b(since|after|from|before|until|till|in|during)\s+{_DATE}", text
+    )
+    if not match:
+        return None
+    start, end = _period(match.group(2), match.group(3))
+    if match.group(1) in ("since", "from"):
+        return start, None
+    if match.group(1) == "after":
+        return end, None
+    if match.group(1) == "before":
+        return None, start
+    if match.group(1) in ("until", "till"):
+        return None, end
+    return start, end
+
+
+def _clauses(question: str, fields: Dict[str, str], date_field: str) -> Iterable[str]:
+    text = question.lower()
+    if fields.get("source") == "tag":
+        sources = _sources(text)
+        if sources:
+            yield "@source:{" + "|".join(sources) + "}"
+    if fields.get("score") == "numeric":
+        score = _score(text)
+        if score is not None:
+            yield f"@score:[{score[0]} {score[1]}]"
+    if fields.get("weekday") == "text":
+        days = _weekdays(text)
+        if days and len(days) < len(WEEKDAYS):
+            yield "@weekday:(" + "|".join(days) + ")"
+    if fields.get(date_field) == "numeric":
+        dates = _dates(text)
+        if dates is not None:
+            start, end = dates
+            # The end of a period is exclusive
+            low = "-inf" if start is None else start
+            high = "+inf" if end is None else f"({end}"
+            yield f"@{date_field}:[{low} {high}]"
+
+
+def extract_filters(
+    question: str, fields: Dict[str, str], date_field: str = "created_timestamp"
+) -> str:
+    """
+    Extracts the metadata filters a question asks for, to restrict the candidates of the KNN search.
+
+    The filters are found by rules instead of the chat model, so they cost no round-trip: the names
+    of the sources, star ratings like '1-star', 'at least 4 stars' or '1 or 2 stars',
+    weekdays, weekends and years or months like 'in May 2023', 'since 2022' or 'between 2021 and
+    2022'. Filters on fields missing from the schema are skipped.
+
+    Parameters:
+    question (str): The question.
+    fields (Dict[str, str]): The queryable fields as returned by query_fields.
+    date_field (str): The numeric field holding the creation time as a Unix timestamp.
+
+    Returns:
+    str: The canonical filter expression, '*' if the question asks for no filter.
+    """
+    clauses = list(_clauses(question, fields, date_field))
+    if not clauses:
+        return "*"
+    try:
+        return parse_query(" ".join(clauses), fields)
+    except QueryError:
+        return "*"
@@ -0,0 +1,79 @@
+import glob
+import hashlib
+import os
+from typing import Optional
+
+import pandas as pd
+
+from config import FRAME_CACHE_DIR
+from src.pipeline import CLEANING_VERSION
+
+
+def input_fingerprint(path: str, run_old_pipeline: bool) -> str:
+    """
+    Fingerprints a CSV file together with the version of the cleaning code.
+
+    The fingerprint covers the size, the modification time and a SHA-256 hash of the contents of
+    the file, the cleaning version and the selected cleaning path.
+
+    Parameters:
+    path (str): The path of the CSV file.
+    run_old_pipeline (bool): If True, the old pipeline is used for cleaning.
+
+    Returns:
+    str: The hexadecimal fingerprint.
+    """
+    stat = os.stat(path)
+    content = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            content.update(block)
+    fingerprint = hashlib.sha256()
+    fingerprint.update(
+        f"{stat.st_size}:{stat.st_mtime_ns}:{content.hexdigest()}:"
+        f"{CLEANING_VERSION}:{run_old_pipeline}".encode("utf-8")
+    )
+    return fingerprint.hexdigest()[:32]
+
+
+def _cache_path(source: str, fingerprint: str) -> str:
+    return os.path.join(FRAME_CACHE_DIR, f"{source}-{fingerprint}.parquet")
+
+
+def load_frame(source: str, fingerprint: str) -> Optional[pd.DataFrame]:
+    """
+    Loads the cleaned DataFrame of a source if it was cached for the given fingerprint.
+
+    Parameters:
+    source (str): The name of the source.
+    fingerprint (str): The fingerprint of the CSV file as returned by input_fingerprint.
+
+    Returns:
+    Optional[pd.DataFrame]: The cleaned DataFrame, or None if it is not cached.
+    """
+    path = _cache_path(source, fingerprint)
+    if not os.path.exists(path):
+        return None
+    df = pd.read_parquet(path)
+    # Parquet does not record the storage of string columns, restore the Arrow-backed strings
+    strings = df.select_dtypes("string").columns
+    return df.astype({column: "string[pyarrow]" for column in strings})
+
+
+def store_frame(source: str, fingerprint: str, df: pd.DataFrame) -> None:
+    """
+    Caches the cleaned DataFrame of a source and removes its outdated cache files.
+
+    Parameters:
+    source (str): The name of the source.
+    fingerprint (str): The fingerprint of the CSV file as returned by input_fingerprint.
+    df (pd.DataFrame): The cleaned DataFrame.
+    """
+    os.makedirs(FRAME_CACHE_DIR, exist_ok=True)
+    path = _cache_path(source, fingerprint)
+    tmp_path = path + ".tmp"
+    df.to_parquet(tmp_path, engine="pyarrow")
+    os.replace(tmp_path, path)
+    for outdated in glob.glob(os.path.join(FRAME_CACHE_DIR, f"{source}-*.parquet")):
+        if outdated != path:
+            os.remove(outdated)
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import pandas as pd
+import redis
+
+from src.vector_index import key_prefix
+
+
+class ChangeSet(NamedTuple):
+    """
+    The difference between a cleaned DataFrame and the documents already ingested for its source.
+
+    upserts (pd.DataFrame): The rows that are new or changed since the last ingestion.
+    fingerprints (Dict[str, str]): The fingerprint of every upserted row, keyed by document id.
+    ids (List[str]): The ids of all rows of the DataFrame.
+    """
+
+    upserts: pd.DataFrame
+    fingerprints: Dict[str, str]
+    ids: List[str]
+
+
+def document_id(source: str, content: str, created_date: Any) -> str:
+    """
+    Derives the stable id of a review from its source, content and creation date.
+
+    Parameters:
+    source (str): The source of the review.
+    content (str): The content of the review.
+    created_date (Any): The creation date of the review.
+
+    Returns:
+    str: The document id in the format '{source}:{hash}'.
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(content.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(str(created_date).encode("utf-8"))
+    return f"{source}:{digest.hexdigest()}"
+
+
+def document_ids(df: pd.DataFrame, source: str) -> List[str]:
+    """
+    Derives the stable ids of all reviews in a DataFrame.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame with 'content' and 'created_date' columns.
+    source (str): The source of the reviews.
+
+    Returns:
+    List[str]: The document id of every row.
+    """
+    return [
+        document_id(source, content, created_date)
+        for content, created_date in zip(df["content"], df["created_date"])
+    ]
+
+
+def document_key(index_name: str, doc_id: str) -> str:
+    """
+    Returns the Redis key under which a document of an index is stored.
+
+    Parameters:
+    index_name (str): The name of the index.
+    doc_id (str): The id of the document.
+
+    Returns:
+    str: The Redis key of the document.
+    """
+    return f"{key_prefix(index_name)}{doc_id}"
+
+
+def _manifest_key(index_name: str, source: str) -> str:
+    return f"ingest:{index_name}:{source}:rows"
+
+
+def _watermark_key(index_name: str) -> str:
+    return f"ingest:{index_name}:watermarks"
+
+
+def file_fingerprint(path: str) -> Dict[str, int]:
+    """
+    Returns the size and modification time of a file.
+
+    Parameters:
+    path (str): The path of the file.
+
+    Returns:
+    Dict[str, int]: The size in bytes and the modification time in nanoseconds.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_watermark(
+    client: redis.Redis, index_name: str, source: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Loads the watermark recorded by the last ingestion of a source.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+
+    Returns:
+    Optional[Dict[str, Any]]: The watermark, or None if the source was never ingested.
+    """
+    watermark = client.hget(_watermark_key(index_name), source)
+    if watermark is None:
+        return None
+    return json.loads(watermark)
+
+
+def is_unchanged(watermark: Optional[Dict[str, Any]], path: str) -> bool:
+    """
+    Checks whether a source file is unchanged since the ingestion that recorded the watermark.
+
+    Parameters:
+    watermark (Optional[Dict[str, Any]]): The watermark of the last ingestion.
+    path (str): The path of the source file.
+
+    Returns:
+    bool: True if the size and modification time of the file match the watermark.
+    """
+    if watermark is None:
+        return False
+    return watermark.get("file") == file_fingerprint(path)
+
+
+def load_manifest(client: redis.Redis, index_name: str, source: str) -> Dict[str, str]:
+    """
+    Loads the fingerprints of all documents ingested for a source.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+
+    Returns:
+    Dict[str, str]: The fingerprint of every ingested document, keyed by document id.
+    """
+    return {
+        doc_id.decode(): fingerprint.decode()
+        for doc_id, fingerprint in client.hgetall(
+            _manifest_key(index_name, source)
+        ).items()
+    }
+
+
+def plan_changes(df: pd.DataFrame, source: str, manifest: Dict[str, str]) -> ChangeSet:
+    """
+    Compares a cleaned DataFrame with the documents already ingested for its source.
+
+    Every row gets a stable document id and a fingerprint of all its values. Rows whose id is not in
+    the manifest or whose fingerprint differs from the recorded one are upserts.
+
+    Parameters:
+    df (pd.DataFrame): The cleaned DataFrame, or a chunk of it.
+    source (str): The source of the reviews.
+    manifest (Dict[str, str]): The manifest of the source as returned by load_manifest.
+
+    Returns:
+    ChangeSet: The rows to upsert.
+    """
+    ids = pd.Series(document_ids(df, source), index=df.index)
+    fingerprints = pd.util.hash_pandas_object(df, index=False).map("{:016x}".format)
+    latest = ~ids.duplicated(keep="last")
+    ids, fingerprints = ids[latest], fingerprints[latest]
+    changed = [
+        manifest.get(doc_id) != fingerprint
+        for doc_id, fingerprint in zip(ids, fingerprints)
+    ]
+    return ChangeSet(
+        upserts=df.loc[ids.index[changed]],
+        fingerprints=dict(zip(ids[changed], fingerprints[changed])),
+        ids=ids.tolist(),
+    )
+
+
+def record_upserts(
+    client: redis.Redis, index_name: str, source: str, fingerprints: Dict[str, str]
+) -> None:
+    """
+    Records the fingerprints of written documents in the manifest of their source.
+
+    This must be called after the documents were written, so an interrupted run is repeated instead
+    of being skipped by the next one.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+    fingerprints (Dict[str, str]): The fingerprint of every written document, keyed by document id.
+    """
+    if fingerprints:
+        client.hset(_manifest_key(index_name, source), mapping=fingerprints)
+
+
+def finish_source(
+    client: redis.Redis,
+    index_name: str,
+    source: str,
+    stale_ids: List[str],
+    watermark: Dict[str, Any],
+    path: str,
+) -> None:
+    """
+    Deletes stale documents of a source and moves its watermark.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+    stale_ids (List[str]): The ids of documents whose row no longer exists.
+    watermark (Dict[str, Any]): Statistics of the ingestion, e.g. rows and newest created_date.
+    path (str): The path of the source file.
+    """
+    manifest_key = _manifest_key(index_name, source)
+    pipeline = client.pipeline(transaction=False)
+    for start in range(0, len(stale_ids), 1000):
+        batch = stale_ids[start : start + 1000]
+        pipeline.delete(*[document_key(index_name, doc_id) for doc_id in batch])
+        pipeline.hdel(manifest_key, *batch)
+    watermark = {
+        **watermark,
+        "file": file_fingerprint(path),
+        "deleted": len(stale_ids),
+        "updated_at": time.time(),
+    }
+    pipeline.hset(_watermark_key(index_name), source, json.dumps(watermark))
+    pipeline.execute()
+
+
+def delete_state(client: redis.Redis, index_name: str) -> None:
+    """
+    Deletes the manifests and watermarks of all sources of an index.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    """
+    keys = list(client.scan_iter(match=f"ingest:{index_name}:*", count=1000))
+    if keys:
+        client.delete(*keys)
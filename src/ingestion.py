@@ -0,0 +1,117 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Generator, Iterable, List, Tuple
+
+import pandas as pd
+from langchain_core.embeddings import Embeddings
+
+
+def iter_batches(
+    df: pd.DataFrame, batch_size: int
+) -> Generator[pd.DataFrame, None, None]:
+    """
+    Splits a DataFrame into consecutive batches of at most batch_size rows.
+
+    The batches are positional views on the DataFrame, so no copy of the full frame is made.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame to split.
+    batch_size (int): The maximum number of rows per batch.
+
+    Returns:
+    Generator[pd.DataFrame, None, None]: A generator that yields the batches in order.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    for start in range(0, len(df), batch_size):
+        yield df.iloc[start : start + batch_size]
+
+
+def embed_batches(
+    batches: Iterable[pd.DataFrame], embedder: Embeddings, concurrency: int
+) -> Generator[Tuple[pd.DataFrame, List[List[float]]], None, None]:
+    """
+    Embeds the 'content' column of each batch on a bounded pool of worker threads.
+
+    At most two batches per worker are in flight at any time, so the number of texts and vectors held
+    in memory depends on the batch size and the concurrency but not on the size of the corpus. Batches
+    are yielded in completion order together with their embeddings, which lets the caller write each
+    batch to the database while the workers keep embedding the next ones.
+
+    Parameters:
+    batches (Iterable[pd.DataFrame]): The batches to embed, each containing a 'content' column.
+    embedder (Embeddings): The embedding model used for the documents.
+    concurrency (int): The number of batches embedded in parallel.
+
+    Returns:
+    Generator[Tuple[pd.DataFrame, List[List[float]]], None, None]: A generator that yields each batch
+    together with the embeddings of its contents.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    max_pending = 2 * concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for batch in batches:
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            future = executor.submit(
+                embedder.embed_documents, batch["content"].tolist()
+            )
+            pending[future] = batch
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+
+def redis_values(series: pd.Series) -> List[Any]:
+    """
+    Converts a metadata column to the Python values stored in the Redis hash fields.
+
+    Dates, booleans and categoricals become strings, numbers become Python ints and floats and
+    missing values become None, which is stored as an empty string.
+
+    Parameters:
+    series (pd.Series): The metadata column.
+
+    Returns:
+    List[Any]: The converted values.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = series.astype(str).tolist()
+    elif pd.api.types.is_bool_dtype(series):
+        values = series.map({True: "True", False: "False"}).tolist()
+    elif pd.api.types.is_numeric_dtype(series):
+        values = series.tolist()
+    else:
+        values = series.astype(str).tolist()
+    missing = series.isna().tolist()
+    return [None if is_missing else value for value, is_missing in zip(values, missing)]
+
+
+def metadata_records(batch: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    Converts the metadata of a batch (all columns except 'content') to Redis field values.
+
+    Only the batch is converted, so the cleaned DataFrame keeps its compact types and no copy of
+    the metadata of the whole corpus is made. The 'created_date' is additionally stored as Unix
+    timestamp in 'created_timestamp', so it can be filtered by range.
+
+    Parameters:
+    batch (pd.DataFrame): The batch of reviews.
+
+    Returns:
+    List[Dict[str, Any]]: The metadata of every review in the batch.
+    """
+    columns = [column for column in batch.columns if column != "content"]
+    values = [redis_values(batch[column]) for column in columns]
+    if "created_date" in batch.columns:
+        columns.append("created_timestamp")
+        values.append(
+            redis_values(
+                (batch["created_date"] - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+            )
+        )
+    return [dict(zip(columns, row)) for row in zip(*values)]
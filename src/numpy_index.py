@@ -0,0 +1,402 @@
+import json
+import os
+import re
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import redis
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from src.query_parser import NUMBER, QueryError, query_clauses
+from src.tracing import span
+from src.vector_index import DISTANCE_FIELD, VECTOR_DTYPES, index_profile, key_prefix
+
+
+# Rows multiplied with the queries at once, bounds the memory of a search to rows x queries scores
+BLOCK_ROWS = 32_768
+
+# Filter masks kept per index, the prefilter produces few distinct expressions
+MASK_CACHE_SIZE = 64
+
+
+def _paths(directory: str) -> Tuple[str, str, str]:
+    return (
+        os.path.join(directory, "vectors.bin"),
+        os.path.join(directory, "documents.parquet"),
+        os.path.join(directory, "meta.json"),
+    )
+
+
+def _decode(value: Optional[bytes]) -> Optional[str]:
+    return None if value is None else value.decode("utf-8")
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scales vectors to unit length, so their dot product is their cosine similarity.
+
+    Parameters:
+    vectors (np.ndarray): The vectors as rows of a matrix.
+
+    Returns:
+    np.ndarray: The normalised vectors as float32 matrix, zero vectors are left as they are.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def export_index(
+    client: redis.Redis,
+    index_name: str,
+    directory: str,
+    fields: List[str],
+    dtype: str = "float32",
+    batch_size: int = 1000,
+) -> int:
+    """
+    Exports the documents of a Redis index for the in-process NumPy search.
+
+    The vectors are normalised and written as raw matrix in the given dtype, which is read as
+    memory map, and the ids, contents and metadata as Parquet file. The files of a previous
+    export are only replaced once the export is complete.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index (or its alias).
+    directory (str): The directory of the exported index.
+    fields (List[str]): The metadata fields to export.
+    dtype (str): The dtype of the exported vectors, 'float32' or 'float16'.
+    batch_size (int): The number of documents read per Redis pipeline.
+
+    Returns:
+    int: The number of exported documents.
+    """
+    profile = index_profile(client, index_name)
+    source_dtype = VECTOR_DTYPES[profile["datatype"]]
+    os.makedirs(directory, exist_ok=True)
+    vectors_path, documents_path, meta_path = _paths(directory)
+
+    records: List[Dict[str, Optional[str]]] = []
+    dims = None
+    keys = list(client.scan_iter(match=f"{key_prefix(index_name)}*", count=batch_size))
+    with open(vectors_path + ".tmp", "wb") as f:
+        for offset in range(0, len(keys), batch_size):
+            batch = keys[offset : offset + batch_size]
+            pipeline = client.pipeline(transaction=False)
+            for key in batch:
+                pipeline.hgetall(key)
+            vectors = []
+            for key, document in zip(batch, pipeline.execute()):
+                vector = document.get(b"content_vector")
+                if vector is None:
+                    continue
+                vectors.append(np.frombuffer(vector, dtype=source_dtype))
+                record = {
+                    "id": _decode(key),
+                    "content": _decode(document.get(b"content")),
+                }
+                record.update({f: _decode(document.get(f.encode())) for f in fields})
+                records.append(record)
+            if not vectors:
+                continue
+            matrix = normalise(np.vstack(vectors))
+            dims = matrix.shape[1]
+            f.write(matrix.astype(dtype).tobytes())
+
+    frame = pd.DataFrame.from_records(records, columns=["id", "content", *fields])
+    frame.to_parquet(documents_path + ".tmp", engine="pyarrow")
+    meta = {
+        "index_name": index_name,
+        "profile": profile,
+        "count": len(records),
+        "dims": dims,
+        "dtype": dtype,
+        "exported_at": time.time(),
+    }
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(vectors_path + ".tmp", vectors_path)
+    os.replace(documents_path + ".tmp", documents_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    return len(records)
+
+
+def _text_pattern(value: str) -> str:
+    # Words, prefixes and phrases of a canonical text value, matched on word boundaries
+    if value.startswith("("):
+        alternatives = re.findall(r'"[^"]*"|[^|]+', value[1:-1])
+    else:
+        alternatives = [value]
+    patterns = []
+    for alternative in alternatives:
+        words = alternative.strip('"').split()
+        suffix = "" if words[-1].endswith("*") else r"\b"
+        words = [re.escape(word.rstrip("*")) for word in words]
+        patterns.append(r"\b" + r"\W+".join(words) + suffix)
+    return "|".join(patterns)
+
+
+def snapshot_version(directory: str) -> Optional[float]:
+    """
+    Returns the time an index was exported to a directory, which changes with every export.
+
+    Parameters:
+    directory (str): The directory of the exported index.
+
+    Returns:
+    Optional[float]: The 'exported_at' time of the export, None if there is no export.
+    """
+    meta_path = _paths(directory)[2]
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f).get("exported_at")
+
+
+def exported_fields(directory: str) -> List[str]:
+    """
+    Returns the metadata fields of an exported index, read from the schema of its Parquet file.
+
+    Parameters:
+    directory (str): The directory of the exported index.
+
+    Returns:
+    List[str]: The names of the exported metadata fields, without 'id' and 'content'.
+    """
+    names = pq.read_schema(_paths(directory)[1]).names
+    # A non-default index of the DataFrame is stored as extra column
+    return [
+        name
+        for name in names
+        if name not in ("id", "content") and not name.startswith("__index_level_")
+    ]
+
+
+class NumpyVectorIndex:
+    """
+    An exported index searched in-process, see export_index.
+
+    The vectors are memory-mapped, so only the pages touched by a search are read from disk, and
+    are scanned in blocks of BLOCK_ROWS. Filter expressions in the query syntax of RediSearch are
+    evaluated on the metadata with pandas: numeric ranges, tags and words, prefixes and phrases of
+    text fields. Like in RediSearch, words and tags are matched regardless of case, but words are
+    matched without stemming.
+    """
+
+    def __init__(self, directory: str):
+        vectors_path, documents_path, meta_path = _paths(directory)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(
+                f"No exported index in {directory}, run python export_index.py first"
+            )
+        with open(meta_path) as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        self.documents = pd.read_parquet(documents_path)
+        self.vectors = np.memmap(
+            vectors_path,
+            dtype=self.meta["dtype"],
+            mode="r",
+            shape=(self.meta["count"], self.meta["dims"] or 0),
+        )
+        self._columns: Dict[Tuple[str, str], pd.Series] = {}
+        self.mask = lru_cache(maxsize=MASK_CACHE_SIZE)(self._mask)
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def _column(self, field: str, kind: str) -> pd.Series:
+        # Numeric columns as floats and text columns lower-cased, converted once per field
+        key = (field, kind)
+        if key not in self._columns:
+            values = self.documents[field]
+            if kind == "numeric":
+                values = pd.to_numeric(values, errors="coerce")
+            else:
+                values = values.fillna("").str.lower()
+            self._columns[key] = values
+        return self._columns[key]
+
+    def _clause_mask(self, field: Optional[str], value: str) -> np.ndarray:
+        if field is not None and field not in self.documents.columns:
+            raise QueryError(f"unknown field @{field}")
+        if value.startswith("["):
+            (low, low_exclusive), (high, high_exclusive) = [
+                (float(match["number"]), bool(match["exclusive"]))
+                for match in map(NUMBER.fullmatch, value[1:-1].split())
+            ]
+            values = self._column(field, "numeric").to_numpy()
+            with np.errstate(invalid="ignore"):
+                above = values > low if low_exclusive else values >= low
+                below = values < high if high_exclusive else values <= high
+            return above & below
+        if value.startswith("{"):
+            tags = {
+                tag.replace("\\", "").strip().lower() for tag in value[1:-1].split("|")
+            }
+            values = self._column(field, "text").str.split(",")
+            return values.map(lambda v: any(t.strip() in tags for t in v)).to_numpy()
+        pattern = _text_pattern(value)
+        # Plain words are matched against the content of the review
+        column = self._column("content" if field is None else field, "text")
+        return column.str.contains(pattern, case=False).to_numpy()
+
+    def _mask(self, filter_expression: str) -> Optional[np.ndarray]:
+        if filter_expression == "*":
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        for negated, field, value in query_clauses(filter_expression):
+            clause = self._clause_mask(field, value)
+            mask &= ~clause if negated else clause
+        mask.setflags(write=False)
+        return mask
+
+    def search(
+        self, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k rows with the highest cosine similarity to every query.
+
+        Parameters:
+        queries (np.ndarray): The query embeddings, one per row, or a single embedding.
+        k (int): The number of rows per query.
+        mask (Optional[np.ndarray]): The rows that are candidates, all rows if None.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: The row numbers and similarities of the nearest rows of every
+        query, ordered by decreasing similarity, with fewer than k columns if there are fewer
+        candidates.
+        """
+        queries = normalise(queries)
+        # Selective filters read only the candidate rows instead of scanning the whole matrix
+        candidates = None if mask is None else np.flatnonzero(mask)
+        total = len(self) if candidates is None else len(candidates)
+        best_rows = np.empty((0, len(queries)), dtype=np.int64)
+        best_scores = np.empty((0, len(queries)), dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, total)
+            if candidates is None:
+                rows = np.arange(start, end)
+                block = self.vectors[start:end]
+            else:
+                rows = candidates[start:end]
+                block = self.vectors[rows]
+            scores = np.asarray(block, dtype=np.float32) @ queries.T
+            rows = np.broadcast_to(rows[:, None], scores.shape)
+            scores = np.concatenate([best_scores, scores])
+            rows = np.concatenate([best_rows, rows])
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                scores = np.take_along_axis(scores, top, axis=0)
+                rows = np.take_along_axis(rows, top, axis=0)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=0, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=0)
+        best_rows = np.take_along_axis(best_rows, order, axis=0)
+        return best_rows.T, best_scores.T
+
+    def to_documents(
+        self, rows: np.ndarray, scores: np.ndarray, fields: List[str]
+    ) -> List[Document]:
+        """
+        Converts search results to documents like the ones of the Redis retriever.
+
+        Parameters:
+        rows (np.ndarray): The row numbers of one query.
+        scores (np.ndarray): Their cosine similarities.
+        fields (List[str]): The metadata fields to copy to the documents.
+
+        Returns:
+        List[Document]: The documents with their metadata, id and cosine distance.
+        """
+        documents = []
+        records = self.documents.iloc[rows].to_dict("records")
+        for record, score in zip(records, scores):
+            metadata = {
+                field: record[field]
+                for field in fields
+                if record.get(field) is not None
+            }
+            metadata["id"] = record["id"]
+            metadata[DISTANCE_FIELD] = float(1 - score)
+            documents.append(
+                Document(page_content=record["content"] or "", metadata=metadata)
+            )
+        return documents
+
+
+class NumpyKNNRetriever(BaseRetriever):
+    """
+    Retrieves the k nearest reviews of a question from an exported index in the memory of the
+    process, with the same prefilter and the same documents as RedisKNNRetriever.
+    """
+
+    index: Any
+    embedder: Embeddings
+    fields: List[str]
+    k: int = 10
+    prefilter: Optional[Callable[[str], str]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: Optional[CallbackManagerForRetrieverRun] = None,
+    ) -> List[Document]:
+        with span("retrieval.embed"):
+            vector = self.embedder.embed_query(query)
+        filter_expression = "*" if self.prefilter is None else self.prefilter(query)
+        return self.search(vector, filter_expression)
+
+    def search(
+        self, vector: List[float], filter_expression: str = "*"
+    ) -> List[Document]:
+        """
+        Searches the nearest reviews of an embedding among the reviews passing a filter.
+
+        Parameters:
+        vector (List[float]): The embedding of the question.
+        filter_expression (str): The filter expression, '*' for all reviews.
+
+        Returns:
+        List[Document]: The nearest reviews, of all reviews if none passes the filter.
+        """
+        return self.batch_search([vector], filter_expression)[0]
+
+    def batch_search(
+        self, vectors: List[List[float]], filter_expression: str = "*"
+    ) -> List[List[Document]]:
+        """
+        Searches the nearest reviews of several embeddings with a single scan of the vectors.
+
+        Parameters:
+        vectors (List[List[float]]): The embeddings of the questions.
+        filter_expression (str): The filter expression, '*' for all reviews.
+
+        Returns:
+        List[List[Document]]: The nearest reviews of every embedding, of all reviews if none passes
+        the filter.
+        """
+        with span(
+            "retrieval.search", k=self.k, filter=filter_expression, backend="numpy"
+        ):
+            try:
+                mask = self.index.mask(filter_expression)
+            except QueryError:
+                mask = None
+            if mask is not None and not mask.any():
+                mask = None
+            rows, scores = self.index.search(np.asarray(vectors), self.k, mask)
+        return [
+            self.index.to_documents(r, s, self.fields) for r, s in zip(rows, scores)
+        ]
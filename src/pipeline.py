@@ -1,8 +1,25 @@
+from typing import Generator, Iterator
+
+import numpy as np
 import pandas as pd
 
 from config import DATA_ROOT, MAPPINGS
 
 
+# Bump whenever the output of consolidation or clean changes, this invalidates cached frames
+CLEANING_VERSION = 2
+
+WEEKDAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+
+
 def consolidation(df: pd.DataFrame, source: str) -> pd.DataFrame:
     """
     Renames the columns of a DataFrame based on a provided mapping.
@@ -19,6 +36,19 @@ def consolidation(df: pd.DataFrame, source: str) -> pd.DataFrame:
     return df
 
 
+def data_path(source: str) -> str:
+    """
+    Returns the path of the CSV file of a specified source.
+
+    Parameters:
+    source (str): The name of the CSV file (without the .csv extension).
+
+    Returns:
+    str: The path of the CSV file.
+    """
+    return f"./{DATA_ROOT}/{source}_reviews.csv"
+
+
 def read_data(source: str):
     """
     Reads a CSV file from a specified source and returns it as a pandas DataFrame.
@@ -29,7 +59,7 @@ def read_data(source: str):
     Returns:
     pd.DataFrame: The data from the CSV file as a pandas DataFrame.
     """
-    df = pd.read_csv(f"./{DATA_ROOT}/{source}_reviews.csv")
+    df = pd.read_csv(data_path(source))
     return df
 
 
@@ -80,34 +110,57 @@ def weigth_likes(likes: str, mean: str):
         return likes
 
 
-def clean(df: pd.DataFrame, run_old_pipeline: bool, source: str) -> pd.DataFrame:
+def format_columns(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Cleans the DataFrame by removing duplicates, formatting dates, handling null values,
-    adding weekday information, checking if source word is in content, and weighting likes.
+    Formats the dates, removes reviews without content and converts the likes to floats.
 
     Parameters:
-    df (pd.DataFrame): The DataFrame to be cleaned.
-    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
-    source (str): The source word to check in content.
+    df (pd.DataFrame): The DataFrame to be formatted.
 
     Returns:
-    pd.DataFrame: The cleaned DataFrame.
+    pd.DataFrame: The formatted DataFrame.
     """
-    # Remove duplicates
-    df = df.drop_duplicates().reset_index(drop=True)
     # Date format
     df["created_date"] = pd.to_datetime(df["created_date"])
     # Null Values
     df = df.dropna(subset=["content"])
     # Change dtype
     df["likes"] = df["likes"].astype(float)
+    return df
 
-    # Get weekday
+
+def add_weekday(df: pd.DataFrame, run_old_pipeline: bool) -> pd.DataFrame:
+    """
+    Adds the weekday of the creation date.
+
+    Parameters:
+    df (pd.DataFrame): The formatted DataFrame.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+
+    Returns:
+    pd.DataFrame: The DataFrame with the 'weekday' column.
+    """
     if run_old_pipeline:
         df["weekday"] = df["created_date"].apply(get_weekday)
     else:
         df["weekday"] = df["created_date"].dt.day_name()
-    # Check if source word in content
+    return df
+
+
+def add_contains_source_word(
+    df: pd.DataFrame, run_old_pipeline: bool, source: str
+) -> pd.DataFrame:
+    """
+    Adds whether the source word is in the content.
+
+    Parameters:
+    df (pd.DataFrame): The formatted DataFrame.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    source (str): The source word to check in content.
+
+    Returns:
+    pd.DataFrame: The DataFrame with the 'contains_source_word' column.
+    """
     if run_old_pipeline:
         df["contains_source_word"] = df["content"].apply(
             contains_source_word,
@@ -115,16 +168,276 @@ def clean(df: pd.DataFrame, run_old_pipeline: bool, source: str) -> pd.DataFrame
         )
     else:
         df["contains_source_word"] = df["content"].str.lower().str.contains(source)
+    return df
 
-    # Check if number of likes is greater than the mean and IF than weight it with 0.5
+
+def add_likes_weighted(
+    df: pd.DataFrame, run_old_pipeline: bool, likes_mean: float
+) -> pd.DataFrame:
+    """
+    Adds the likes weighted with 0.5 if they are greater than the mean.
+
+    Parameters:
+    df (pd.DataFrame): The formatted DataFrame.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    likes_mean (float): The mean number of likes above which likes are weighted with 0.5.
+
+    Returns:
+    pd.DataFrame: The DataFrame with the 'likes_weighted' column.
+    """
     if run_old_pipeline:
-        df["likes_weighted"] = df["likes"].apply(
-            weigth_likes, args=[df["likes"].mean()]
-        )
+        df["likes_weighted"] = df["likes"].apply(weigth_likes, args=[likes_mean])
     else:
         df["likes_weighted"] = df["likes"]
-        df.loc[df["likes"] > df["likes"].mean(), "likes_weighted"] = (
-            df["likes_weighted"] * 0.5
-        )
+        df.loc[df["likes"] > likes_mean, "likes_weighted"] = df["likes_weighted"] * 0.5
+    return df
+
+
+def add_features(
+    df: pd.DataFrame, run_old_pipeline: bool, source: str, likes_mean: float
+) -> pd.DataFrame:
+    """
+    Adds the weekday, whether the source word is in the content and the weighted likes.
+
+    Parameters:
+    df (pd.DataFrame): The formatted DataFrame.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    source (str): The source word to check in content.
+    likes_mean (float): The mean number of likes above which likes are weighted with 0.5.
+
+    Returns:
+    pd.DataFrame: The DataFrame with the additional columns.
+    """
+    # Get weekday
+    df = add_weekday(df, run_old_pipeline)
+    # Check if source word in content
+    df = add_contains_source_word(df, run_old_pipeline, source)
+    # Check if number of likes is greater than the mean and IF than weight it with 0.5
+    return add_likes_weighted(df, run_old_pipeline, likes_mean)
+
+
+def _compact_integer(series: pd.Series, dtype: str) -> pd.Series:
+    """
+    Converts a numeric Series to a nullable integer dtype if all its values are whole numbers.
+
+    Parameters:
+    series (pd.Series): The numeric Series.
+    dtype (str): The nullable integer dtype, e.g. 'Int8' or 'Int32'.
+
+    Returns:
+    pd.Series: The converted Series, or a float32 Series if it contains fractions.
+    """
+    values = series.dropna()
+    if (values % 1 == 0).all():
+        return series.astype(dtype)
+    return series.astype("float32")
+
+
+def compact_types(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    """
+    Converts a cleaned DataFrame to a memory-compact schema and adds the source column.
+
+    The weekday and the source become categoricals, the score and the likes nullable small integers,
+    the weighted likes float32, the flag a nullable boolean and the texts Arrow-backed strings.
+
+    Parameters:
+    df (pd.DataFrame): The cleaned DataFrame.
+    source (str): The name of the source.
 
+    Returns:
+    pd.DataFrame: The DataFrame with the compact schema.
+    """
+    df = df.assign(
+        source=pd.Categorical([source] * len(df), categories=list(MAPPINGS)),
+        weekday=pd.Categorical(df["weekday"], categories=WEEKDAYS),
+        contains_source_word=df["contains_source_word"].astype("boolean"),
+        score=_compact_integer(df["score"], "Int8"),
+        likes=_compact_integer(df["likes"], "Int32"),
+        likes_weighted=df["likes_weighted"].astype("float32"),
+        content=df["content"].astype("string[pyarrow]"),
+    )
+    if "name" in df.columns:
+        df["name"] = df["name"].astype("string[pyarrow]")
     return df
+
+
+def memory_footprint(df: pd.DataFrame) -> int:
+    """
+    Returns the memory used by a DataFrame including the contents of its strings.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame.
+
+    Returns:
+    int: The memory footprint in bytes.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def clean(df: pd.DataFrame, run_old_pipeline: bool, source: str) -> pd.DataFrame:
+    """
+    Cleans the DataFrame by removing duplicates, formatting dates, handling null values,
+    adding weekday information, checking if source word is in content, and weighting likes.
+    The result is converted to the compact schema of compact_types.
+
+    Parameters:
+    df (pd.DataFrame): The DataFrame to be cleaned.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    source (str): The source word to check in content.
+
+    Returns:
+    pd.DataFrame: The cleaned DataFrame.
+    """
+    # Remove duplicates
+    df = df.drop_duplicates().reset_index(drop=True)
+    df = format_columns(df)
+    df = add_features(df, run_old_pipeline, source, df["likes"].mean())
+    return compact_types(df, source)
+
+
+def read_data_chunks(source: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    Reads a CSV file from a specified source in chunks.
+
+    Parameters:
+    source (str): The name of the CSV file (without the .csv extension).
+    chunksize (int): The maximum number of rows per chunk.
+
+    Returns:
+    Iterator[pd.DataFrame]: An iterator over the chunks of the CSV file.
+    """
+    return pd.read_csv(data_path(source), chunksize=chunksize)
+
+
+class SeenHashes:
+    """
+    The 8 byte hashes of the rows seen so far, kept in a sorted array.
+
+    Unlike a set of Python integers, which takes about 70 bytes per entry, the array takes 8 bytes
+    per unique row, and twice that for a moment while the hashes of a new chunk are merged into it.
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Adds the hashes of a chunk.
+
+        Parameters:
+        hashes (np.ndarray): The hashes of the rows of the chunk.
+
+        Returns:
+        np.ndarray: A boolean mask, True for the first row of every hash not seen before.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        positions = np.searchsorted(self.hashes, hashes)
+        known = positions < len(self.hashes)
+        known[known] = self.hashes[positions[known]] == hashes[known]
+        new = np.zeros(len(hashes), dtype=bool)
+        new[np.unique(hashes, return_index=True)[1]] = True
+        new &= ~known
+        added = np.sort(hashes[new])
+        self.hashes = np.insert(self.hashes, np.searchsorted(self.hashes, added), added)
+        return new
+
+
+def _canonical(df: pd.DataFrame) -> pd.DataFrame:
+    # The dtypes pandas infers differ per chunk, e.g. int64 or float64 if a chunk has missing likes,
+    # equal rows must hash the same in every chunk
+    return pd.DataFrame(
+        {
+            column: (
+                values.astype("float64")
+                if pd.api.types.is_numeric_dtype(values)
+                else values.astype(str)
+            )
+            for column, values in df.items()
+        }
+    )
+
+
+def drop_seen_duplicates(df: pd.DataFrame, seen: SeenHashes) -> pd.DataFrame:
+    """
+    Removes rows that already appeared in this or an earlier chunk.
+
+    Parameters:
+    df (pd.DataFrame): The chunk to deduplicate.
+    seen (SeenHashes): The hashes of all rows of earlier chunks, updated in place.
+
+    Returns:
+    pd.DataFrame: The rows of the chunk that were not seen before.
+    """
+    hashes = pd.util.hash_pandas_object(_canonical(df), index=False).to_numpy()
+    return df[seen.add(hashes)].reset_index(drop=True)
+
+
+def likes_mean_of_chunks(source: str, chunksize: int) -> float:
+    """
+    Computes the mean number of likes of the unique reviews with content of a source in chunks.
+
+    Parameters:
+    source (str): The name of the source.
+    chunksize (int): The maximum number of rows per chunk.
+
+    Returns:
+    float: The mean number of likes, NaN if there are no reviews.
+    """
+    seen = SeenHashes()
+    likes_sum, likes_count = 0.0, 0
+    for df in read_data_chunks(source, chunksize):
+        df = drop_seen_duplicates(consolidation(df, source), seen)
+        likes = df.loc[df["content"].notna(), "likes"].astype(float)
+        likes_sum += likes.sum()
+        likes_count += likes.count()
+    return likes_sum / likes_count if likes_count else float("nan")
+
+
+def clean_chunk(
+    df: pd.DataFrame, run_old_pipeline: bool, source: str, likes_mean: float
+) -> pd.DataFrame:
+    """
+    Cleans a deduplicated chunk with the likes mean of the whole source.
+
+    Parameters:
+    df (pd.DataFrame): The consolidated and deduplicated chunk.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    source (str): The source word to check in content.
+    likes_mean (float): The mean number of likes of the whole source.
+
+    Returns:
+    pd.DataFrame: The cleaned chunk.
+    """
+    df = format_columns(df)
+    df = add_features(df, run_old_pipeline, source, likes_mean)
+    return compact_types(df, source)
+
+
+def clean_chunks(
+    source: str, run_old_pipeline: bool, chunksize: int
+) -> Generator[pd.DataFrame, None, None]:
+    """
+    Reads, consolidates and cleans the CSV file of a source in bounded chunks.
+
+    The file is read twice. The first pass only computes the mean number of likes of the unique
+    reviews with content, the second pass cleans every chunk with this mean and yields it. Duplicates
+    are detected across chunks by hashing every row, so the output matches clean on the whole file
+    while the memory is bounded by the chunk size plus a sorted array of one 8 byte hash per unique
+    row, see SeenHashes.
+
+    Parameters:
+    source (str): The name of the source.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    chunksize (int): The maximum number of rows per chunk.
+
+    Returns:
+    Generator[pd.DataFrame, None, None]: A generator that yields the cleaned chunks.
+    """
+    likes_mean = likes_mean_of_chunks(source, chunksize)
+    seen = SeenHashes()
+    for df in read_data_chunks(source, chunksize):
+        df = drop_seen_duplicates(consolidation(df, source), seen)
+        yield clean_chunk(df, run_old_pipeline, source, likes_mean)
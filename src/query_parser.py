@@ -0,0 +1,308 @@
+import math
+import re
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from redis.commands.search.query import Query
+
+
+CLAUSE = re.compile(
+    r"""
+    (?P<negated>-)?
+    (?:
+        @(?P<field>\w+)\s*:\s*
+        (?P<value>\[[^\]]*\]|\([^)]*\)|\{[^}]*\}|"[^"]*"|[<>]=?\s*[^\s@|()]+|[^\s@|()]+)
+        |
+        (?P<term>"[^"]*"|[^\s@"|()]+)
+    )
+    """,
+    re.VERBOSE,
+)
+
+# A group of alternatives, optionally negated, its end and the separator of the alternatives
+GROUP = re.compile(r"\s*(-)?\(")
+GROUP_END = re.compile(r"\s*\)")
+UNION = re.compile(r"\s*\|")
+
+NUMBER = re.compile(r"(?P<exclusive>\()?(?P<number>[-+]?(?:inf|[0-9.]+(?:e[-+]?\d+)?))")
+
+# Everything but word characters separates tokens when RediSearch indexes text, * marks a prefix
+SEPARATOR = re.compile(r"[^\w*]+")
+
+
+class QueryError(ValueError):
+    """
+    Raised when a generated query is not a valid query over the fields of the index.
+    """
+
+
+def query_fields(schema: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Returns the fields of the schema that can be used in a query, together with their type.
+
+    Parameters:
+    schema (Dict[str, Any]): The index schema as returned by load_schema.
+
+    Returns:
+    Dict[str, str]: The type ('text', 'numeric' or 'tag') of every queryable field.
+    """
+    return {
+        field["name"]: field_type
+        for field_type in ("text", "numeric", "tag")
+        for field in schema.get(field_type, [])
+        if not field.get("no_index", False)
+    }
+
+
+def _clean(query: str) -> str:
+    lines = [line.strip() for line in query.strip().strip("`").splitlines()]
+    query = next((line for line in lines if line), "")
+    query = re.sub(r"^(answer from you|query)\s*:\s*", "", query, flags=re.IGNORECASE)
+    if len(query) > 1 and query[0] == query[-1] and query[0] in "'`":
+        query = query[1:-1].strip()
+    return query
+
+
+def _number(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        raise QueryError(f"'{text}' is not a number") from None
+
+
+def _format_number(value: float) -> str:
+    if math.isinf(value):
+        return "+inf" if value > 0 else "-inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _numeric(field: str, value: str) -> str:
+    comparison = re.fullmatch(r"([<>]=?)\s*(\S+)", value)
+    if comparison:
+        operator, number = comparison.groups()
+        bound = _format_number(_number(number))
+        exclusive = "" if operator.endswith("=") else "("
+        if operator.startswith(">"):
+            return f"[{exclusive}{bound} +inf]"
+        return f"[-inf {exclusive}{bound}]"
+
+    # The model writes ranges in parentheses as often as in brackets, both are read as inclusive
+    if value[0] in "[(" and value[-1] in "])":
+        value = value[1:-1]
+    parts = value.replace(",", " ").split()
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2:
+        raise QueryError(f"the range of @{field} needs a lower and an upper bound")
+
+    bounds: List[Tuple[float, str]] = []
+    for part in parts:
+        match = NUMBER.fullmatch(part.lower())
+        if not match:
+            raise QueryError(f"'{part}' is not a bound of @{field}")
+        number = _number(match["number"])
+        bounds.append((number, f"{match['exclusive'] or ''}{_format_number(number)}"))
+    if bounds[0][0] > bounds[1][0]:
+        raise QueryError(f"the lower bound of @{field} is above its upper bound")
+    return f"[{bounds[0][1]} {bounds[1][1]}]"
+
+
+def _text_alternative(text: str) -> str:
+    phrase = text.startswith('"')
+    tokens = [token for token in SEPARATOR.split(text.lower()) if token]
+    # A wildcard is only allowed as suffix of a single word
+    if any("*" in token for token in tokens) and (
+        phrase or len(tokens) > 1 or not re.fullmatch(r"\w+\*", tokens[0])
+    ):
+        raise QueryError(f"'{text}' is not a valid prefix search")
+    if not tokens:
+        raise QueryError(f"'{text}' contains no words")
+    if len(tokens) == 1:
+        return tokens[0]
+    return '"' + " ".join(tokens) + '"'
+
+
+def _text(value: str) -> str:
+    if value.startswith("(") and value.endswith(")"):
+        alternatives = re.findall(r'"[^"]*"|[^|]+', value[1:-1])
+    else:
+        alternatives = [value]
+    alternatives = sorted(
+        {_text_alternative(alt.strip()) for alt in alternatives if alt.strip()}
+    )
+    if not alternatives:
+        raise QueryError(f"'{value}' contains no words")
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return "(" + "|".join(alternatives) + ")"
+
+
+def _tag(value: str) -> str:
+    if value.startswith("{") and value.endswith("}"):
+        value = value[1:-1]
+    tags = sorted({tag.strip().lower() for tag in value.split("|") if tag.strip()})
+    if not tags:
+        raise QueryError(f"'{value}' contains no tags")
+    return "{" + "|".join(re.sub(r"(\W)", r"\\\1", tag) for tag in tags) + "}"
+
+
+def query_clauses(query: str) -> Iterator[Tuple[bool, Optional[str], str]]:
+    """
+    Splits a conjunction of clauses into its clauses without validating their values.
+
+    Parameters:
+    query (str): The query, without alternatives separated by '|' outside of field values.
+
+    Returns:
+    Iterator[Tuple[bool, Optional[str], str]]: Whether every clause is negated, its field (None
+    for plain words) and its value.
+    """
+    position = 0
+    while position < len(query):
+        if query[position].isspace():
+            position += 1
+            continue
+        match = CLAUSE.match(query, position)
+        if not match:
+            raise QueryError(f"cannot parse '{query[position:]}'")
+        position = match.end()
+        if match["field"] is None:
+            yield bool(match["negated"]), None, match["term"]
+        else:
+            yield bool(match["negated"]), match["field"], match["value"].strip()
+
+
+def _clause(match: re.Match, fields: Dict[str, str]) -> str:
+    prefix = "-" if match["negated"] else ""
+    field = match["field"]
+    if field is None:
+        return f"{prefix}{_text(match['term'])}"
+    value = match["value"].strip()
+    field_type = fields.get(field)
+    if field_type is None:
+        raise QueryError(
+            f"unknown field @{field}, the fields are {', '.join(sorted(fields))}"
+        )
+    if field_type == "numeric":
+        value = _numeric(field, value)
+    elif field_type == "tag":
+        value = _tag(value)
+    else:
+        value = _text(value)
+    return f"{prefix}@{field}:{value}"
+
+
+def _conjunction(clauses: Set[str]) -> str:
+    return " ".join(sorted(clauses, key=lambda clause: (clause.lstrip("-"), clause)))
+
+
+def _union(alternatives: List[Set[str]]) -> List[str]:
+    # Conjunctions are put in parentheses, RediSearch dialects differ in the precedence of '|'
+    return sorted(
+        {
+            _conjunction(clauses) if len(clauses) == 1 else f"({_conjunction(clauses)})"
+            for clauses in alternatives
+        }
+    )
+
+
+def _parse_union(
+    query: str, position: int, fields: Dict[str, str]
+) -> Tuple[List[Set[str]], int]:
+    alternatives = []
+    while True:
+        clauses, position = _parse_conjunction(query, position, fields)
+        alternatives.append(clauses)
+        match = UNION.match(query, position)
+        if not match:
+            return alternatives, position
+        position = match.end()
+
+
+def _parse_conjunction(
+    query: str, position: int, fields: Dict[str, str]
+) -> Tuple[Set[str], int]:
+    clauses: Set[str] = set()
+    while True:
+        while position < len(query) and query[position].isspace():
+            position += 1
+        if position == len(query) or query[position] in "|)":
+            break
+        group = GROUP.match(query, position)
+        if group:
+            alternatives, position = _parse_union(query, group.end(), fields)
+            end = GROUP_END.match(query, position)
+            if not end:
+                raise QueryError(f"missing ')' in '{query}'")
+            position = end.end()
+            union = _union(alternatives)
+            if len(union) > 1:
+                clauses.add(f"{group[1] or ''}({'|'.join(union)})")
+            elif not group[1]:
+                clauses.update(alternatives[0])
+            elif len(alternatives[0]) == 1 and not union[0].startswith("-"):
+                clauses.add(f"-{union[0]}")
+            else:
+                clauses.add(f"-({_conjunction(alternatives[0])})")
+            continue
+        match = CLAUSE.match(query, position)
+        if not match:
+            raise QueryError(f"cannot parse '{query[position:]}'")
+        clauses.add(_clause(match, fields))
+        position = match.end()
+    if not clauses:
+        raise QueryError(f"'{query}' contains an empty alternative")
+    return clauses, position
+
+
+def parse_query(query: str, fields: Dict[str, str]) -> str:
+    """
+    Validates a query generated by the chat model and returns its canonical form.
+
+    The query must be a conjunction of clauses of the form @field:value, optionally negated with a
+    leading '-', or of plain words. Alternatives are separated by '|' and can be grouped in
+    parentheses, e.g. @weekday:saturday | @weekday:sunday. Numeric values are ranges in brackets
+    or parentheses, single numbers or comparisons like >3, text values are words, phrases in
+    quotes, prefixes like spot* or alternatives like (spotify|netflix) and tag values are tags in
+    braces. In the canonical form, words are lower-cased, ranges are written in brackets and
+    clauses and alternatives are deduplicated and sorted, so equivalent queries are written the
+    same way. The canonical form of "na" is "na" and the query "*" matching all reviews is kept.
+
+    Parameters:
+    query (str): The query, e.g. as returned by the chat model.
+    fields (Dict[str, str]): The queryable fields as returned by query_fields.
+
+    Returns:
+    str: The canonical query.
+    """
+    query = _clean(query)
+    if query.lower() in ("na", "n/a"):
+        return "na"
+    if not query:
+        raise QueryError("the query is empty")
+    if query == "*":
+        return "*"
+
+    alternatives, position = _parse_union(query, 0, fields)
+    if position < len(query):
+        raise QueryError(f"cannot parse '{query[position:]}'")
+    if any(
+        all(clause.startswith("-") for clause in clauses) for clauses in alternatives
+    ):
+        raise QueryError("the query only excludes reviews")
+    union = _union(alternatives)
+    if len(union) == 1:
+        return _conjunction(alternatives[0])
+    return "|".join(union)
+
+
+def count_query(query: str) -> Query:
+    """
+    Builds a search that only counts the reviews matching a query, without returning any of them.
+
+    Parameters:
+    query (str): The canonical query.
+
+    Returns:
+    Query: The search with LIMIT 0 0.
+    """
+    return Query(query).no_content().paging(0, 0)
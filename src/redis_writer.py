@@ -0,0 +1,120 @@
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import redis
+
+from src.vector_index import VECTOR_DTYPES, key_prefix
+
+
+RETRYABLE_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+
+class BulkWriter:
+    """
+    Writes the documents of an index to Redis in pipelined batches.
+
+    Documents are buffered and sent as one non-transactional pipeline of HSETs per batch_size
+    documents, so the number of round-trips does not depend on the embedding batch size. The
+    vectors of a batch are packed as raw bytes in the datatype of the index profile in one step.
+    Since HSET is idempotent, a batch that fails with a connection error or timeout is sent again
+    after an exponential backoff. The client should be backed by a connection pool, so a retried
+    batch gets a fresh connection.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        index_name: str,
+        profile: Dict[str, Any],
+        batch_size: int = 500,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.client = client
+        self.prefix = key_prefix(index_name)
+        self.dtype = VECTOR_DTYPES[profile["datatype"]]
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self._buffer: List[Dict[str, Any]] = []
+        self._keys: List[str] = []
+
+    def add(
+        self,
+        keys: List[str],
+        texts: List[str],
+        vectors: List[List[float]],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """
+        Buffers documents and writes every full batch.
+
+        Metadata values that are None are left out, so missing values are not indexed.
+
+        Parameters:
+        keys (List[str]): The document ids.
+        texts (List[str]): The contents of the documents.
+        vectors (List[List[float]]): The embeddings of the contents.
+        metadatas (List[Dict[str, Any]]): The metadata of the documents.
+        """
+        packed = np.asarray(vectors, dtype=self.dtype)
+        for key, text, vector, metadata in zip(keys, texts, packed, metadatas):
+            mapping = {
+                name: value for name, value in metadata.items() if value is not None
+            }
+            mapping["content"] = text
+            mapping["content_vector"] = vector.tobytes()
+            self._keys.append(f"{self.prefix}{key}")
+            self._buffer.append(mapping)
+            if len(self._buffer) >= self.batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes all buffered documents, raising the last error if the batch still fails after
+        max_retries retries.
+        """
+        if not self._buffer:
+            return
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            pipeline = self.client.pipeline(transaction=False)
+            for key, mapping in zip(self._keys, self._buffer):
+                pipeline.hset(key, mapping=mapping)
+            try:
+                pipeline.execute()
+                break
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                time.sleep(self.backoff * 2**attempt)
+        self.seconds += time.perf_counter() - start
+        self.written += len(self._buffer)
+        self.batches += 1
+        self._buffer, self._keys = [], []
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the statistics of all batches written so far.
+
+        Returns:
+        Dict[str, float]: The number of written documents, batches and retries, the seconds spent
+        writing and the write throughput in documents per second.
+        """
+        return {
+            "written": self.written,
+            "batches": self.batches,
+            "retries": self.retries,
+            "seconds": round(self.seconds, 3),
+            "docs_per_sec": (
+                round(self.written / self.seconds, 1) if self.seconds else 0.0
+            ),
+        }
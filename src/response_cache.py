@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
+import redis
+from langchain_core.embeddings import Embeddings
+
+
+TIERS = ("memory", "redis", "semantic")
+
+
+def normalise_question(question: str) -> str:
+    """
+    Normalises a question, so trivially different spellings share a cache entry.
+
+    The question is lower-cased, runs of whitespace are collapsed and trailing punctuation is
+    removed.
+
+    Parameters:
+    question (str): The question.
+
+    Returns:
+    str: The normalised question.
+    """
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?!. ")
+
+
+def prompt_version(prompt: str) -> str:
+    """
+    Derives a short version of a prompt from its text, so editing a prompt invalidates its entries.
+
+    Parameters:
+    prompt (str): The system prompt.
+
+    Returns:
+    str: The version of the prompt.
+    """
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=6).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caches the responses of the chat model in three tiers.
+
+    Entries are keyed on the kind of request, the normalised question, the version of the prompt and
+    the model. Lookups go to an in-process LRU first, then to Redis, where entries are shared between
+    processes, expire after ttl seconds and are bounded to max_entries per kind by evicting the oldest
+    ones. Errors of Redis are counted and treated as misses and skipped writes, so the cache never fails
+    a request. If an embedder and a similarity threshold are given, a miss of one of the semantic_kinds falls
+    back to the entry of the most similar question asked recently in this process, provided the
+    cosine similarity of their embeddings reaches the threshold. Only kinds whose answer does not
+    hinge on small details of the question, like the classification, should be semantic kinds. All
+    methods are thread-safe.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        capacity: int = 1024,
+        ttl: int = 86400,
+        max_entries: int = 10_000,
+        embedder: Optional[Embeddings] = None,
+        similarity_threshold: Optional[float] = None,
+        semantic_kinds: Tuple[str, ...] = ("classify",),
+        namespace: str = "response-cache",
+    ):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.client = client
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embedder = embedder if similarity_threshold is not None else None
+        self.similarity_threshold = similarity_threshold
+        self.semantic_kinds = semantic_kinds
+        self.namespace = namespace
+        self._memory: OrderedDict = OrderedDict()
+        self._vectors: Dict[str, Tuple[List[str], Optional[np.ndarray]]] = {}
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def key(self, kind: str, question: str, prompt: str, model: str) -> str:
+        """
+        Returns the cache key of a request.
+
+        Parameters:
+        kind (str): The kind of request, e.g. 'classify'.
+        question (str): The question, or the user message sent to the model.
+        prompt (str): The system prompt.
+        model (str): The name of the chat model.
+
+        Returns:
+        str: The Redis key of the entry.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (normalise_question(question), prompt_version(prompt), model):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return f"{self.namespace}:{kind}:{digest.hexdigest()}"
+
+    def _lookup(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key], "memory"
+        try:
+            value = self.client.get(key)
+        except redis.RedisError:
+            return None, "error"
+        if value is None:
+            return None, None
+        value = value.decode("utf-8")
+        self._remember(key, value)
+        return value, "redis"
+
+    def _remember(self, key: str, value: str) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+
+    def _is_semantic(self, kind: str) -> bool:
+        return self.embedder is not None and kind in self.semantic_kinds
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(
+            self.embedder.embed_query(normalise_question(question)), dtype=np.float32
+        )
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _nearest(self, kind: str, vector: np.ndarray) -> Optional[str]:
+        with self._lock:
+            keys, matrix = self._vectors.get(kind, ([], None))
+            if matrix is None:
+                return None
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            return keys[best]
+
+    def _add_vector(self, kind: str, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            keys, matrix = self._vectors.get(kind, ([], None))
+            if key in keys:
+                return
+            keys = (keys + [key])[-self.capacity :]
+            matrix = vector[None] if matrix is None else np.vstack([matrix, vector])
+            self._vectors[kind] = (keys, matrix[-self.capacity :])
+
+    def get(self, kind: str, question: str, prompt: str, model: str) -> Optional[str]:
+        """
+        Looks up the cached response of a request in all tiers.
+
+        Parameters:
+        kind (str): The kind of request, e.g. 'classify'.
+        question (str): The question, or the user message sent to the model.
+        prompt (str): The system prompt.
+        model (str): The name of the chat model.
+
+        Returns:
+        Optional[str]: The cached response, or None on a miss.
+        """
+        value, tier = self._lookup(self.key(kind, question, prompt, model))
+        errors = int(tier == "error")
+        if value is None and self._is_semantic(kind):
+            similar_key = self._nearest(kind, self._embed(question))
+            if similar_key is not None:
+                value, similar_tier = self._lookup(similar_key)
+                errors += int(similar_tier == "error")
+                tier = "semantic" if value is not None else None
+        with self._lock:
+            self._counts[(kind, tier if value is not None else "miss")] += 1
+            self._counts[(kind, "error")] += errors
+        return value
+
+    def _store(self, kind: str, key: str, value: str) -> None:
+        entries_key = f"{self.namespace}:{kind}:entries"
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(key, value, ex=self.ttl)
+        pipeline.zadd(entries_key, {key: time.time()})
+        pipeline.zremrangebyscore(entries_key, "-inf", time.time() - self.ttl)
+        pipeline.zcard(entries_key)
+        size = pipeline.execute()[-1]
+        if size > self.max_entries:
+            evicted = [
+                member
+                for member, _ in self.client.zpopmin(
+                    entries_key, size - self.max_entries
+                )
+            ]
+            if evicted:
+                self.client.delete(*evicted)
+
+    def put(
+        self, kind: str, question: str, prompt: str, model: str, value: str
+    ) -> None:
+        """
+        Stores the response of a request in all tiers.
+
+        Parameters:
+        kind (str): The kind of request, e.g. 'classify'.
+        question (str): The question, or the user message sent to the model.
+        prompt (str): The system prompt.
+        model (str): The name of the chat model.
+        value (str): The response of the model.
+        """
+        key = self.key(kind, question, prompt, model)
+        self._remember(key, value)
+        try:
+            self._store(kind, key, value)
+        except redis.RedisError:
+            # The entry stays in memory, Redis only misses the copy shared with other processes
+            with self._lock:
+                self._counts[(kind, "error")] += 1
+        if self._is_semantic(kind):
+            self._add_vector(kind, key, self._embed(question))
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the hits per tier, the misses, the errors of Redis and the hit rate of every kind of
+        request.
+
+        Returns:
+        Dict[str, Dict[str, float]]: The statistics, keyed by kind.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        stats = {}
+        for kind in sorted({kind for kind, _ in counts}):
+            kind_stats = {
+                tier: counts.get((kind, tier), 0) for tier in (*TIERS, "miss")
+            }
+            lookups = sum(kind_stats.values())
+            kind_stats["error"] = counts.get((kind, "error"), 0)
+            kind_stats["hit_rate"] = (
+                round(1 - kind_stats["miss"] / lookups, 3) if lookups else 0.0
+            )
+            stats[kind] = kind_stats
+        return stats
+
+
+def replay_stream(text: str) -> Generator[Dict[str, Any], None, None]:
+    """
+    Replays a cached response as a stream in the format of the Ollama chat API.
+
+    Parameters:
+    text (str): The cached response.
+
+    Returns:
+    Generator[Dict[str, Any], None, None]: A generator that yields the response as a single chunk.
+    """
+    yield {"message": {"role": "assistant", "content": text}, "done": True}
+
+
+def cache_stream(
+    stream: Iterable[Dict[str, Any]],
+    cache: ResponseCache,
+    kind: str,
+    question: str,
+    prompt: str,
+    model: str,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Passes through a stream of the Ollama chat API and caches the full response once it is consumed.
+
+    Parameters:
+    stream (Iterable[Dict[str, Any]]): The stream of the chat model.
+    cache (ResponseCache): The response cache.
+    kind (str): The kind of request, e.g. 'rephrase'.
+    question (str): The question, or the user message sent to the model.
+    prompt (str): The system prompt.
+    model (str): The name of the chat model.
+
+    Returns:
+    Generator[Dict[str, Any], None, None]: A generator that yields the chunks of the stream.
+    """
+    parts = []
+    for chunk in stream:
+        parts.append(chunk["message"]["content"])
+        yield chunk
+    cache.put(kind, question, prompt, model, "".join(parts))
+
+
+async def async_replay_stream(text: str) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Replays a cached response as an asynchronous stream in the format of the Ollama chat API.
+
+    Parameters:
+    text (str): The cached response.
+
+    Returns:
+    AsyncGenerator[Dict[str, Any], None]: An async generator that yields the response as a single
+    chunk.
+    """
+    yield {"message": {"role": "assistant", "content": text}, "done": True}
+
+
+async def async_cache_stream(
+    stream: AsyncIterable[Dict[str, Any]],
+    cache: ResponseCache,
+    kind: str,
+    question: str,
+    prompt: str,
+    model: str,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Passes through an asynchronous stream of the Ollama chat API and caches the full response once
+    it is consumed.
+
+    Parameters:
+    stream (AsyncIterable[Dict[str, Any]]): The stream of the chat model.
+    cache (ResponseCache): The response cache.
+    kind (str): The kind of request, e.g. 'rephrase'.
+    question (str): The question, or the user message sent to the model.
+    prompt (str): The system prompt.
+    model (str): The name of the chat model.
+
+    Returns:
+    AsyncGenerator[Dict[str, Any], None]: An async generator that yields the chunks of the stream.
+    """
+    parts = []
+    async for chunk in stream:
+        parts.append(chunk["message"]["content"])
+        yield chunk
+    await asyncio.to_thread(cache.put, kind, question, prompt, model, "".join(parts))
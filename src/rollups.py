@@ -0,0 +1,381 @@
+import json
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import redis
+
+from src.aggregation import AggregationPlan, format_aggregate, is_plan, parse_plan
+from src.incremental import document_ids
+from src.ingestion import redis_values
+from src.query_parser import NUMBER, QueryError, query_clauses
+
+
+# Fields whose reviews are counted per value
+COUNT_FIELDS = ("score", "weekday", "contains_source_word")
+# Fields whose reviews are counted per year, month and day
+DATE_FIELDS = {"created_date": ("%Y", "%Y-%m", "%Y-%m-%d")}
+# Numeric fields whose count, sum, minimum and maximum are recorded
+STAT_FIELDS = ("score", "likes", "likes_weighted")
+# The tag field holding the source of a review, rollups are recorded per source
+SOURCE_FIELD = "source"
+# Incremented whenever rollups are written or the alias is pointed to another index
+ROLLUPS_VERSION_KEY = "rollups:version"
+
+
+def _rollups_key(index_name: str) -> str:
+    return f"ingest:{index_name}:rollups"
+
+
+class RollupBuilder:
+    """
+    Computes the rollup of a source from its cleaned frames.
+
+    The rollup holds the number of reviews, the number of reviews per value of the COUNT_FIELDS and
+    per date bucket of the DATE_FIELDS, both keyed by the value stored in Redis, and the count, sum,
+    minimum and maximum of the STAT_FIELDS. Reviews with the same document id are counted once,
+    like they are stored once, also if they appear in several chunks. A review repeated in a later
+    chunk is counted with the values of its first chunk.
+
+    Parameters:
+    source (str): The source of the reviews, part of every document id.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.reviews = 0
+        self._ids: Set[str] = set()
+        self.counts: Dict[str, Counter] = {
+            field: Counter() for field in (*COUNT_FIELDS, *DATE_FIELDS)
+        }
+        self.stats: Dict[str, List[float]] = {}
+
+    def add(self, df: pd.DataFrame) -> None:
+        """
+        Adds a cleaned frame of the source to the rollup.
+
+        Parameters:
+        df (pd.DataFrame): The cleaned DataFrame, or a chunk of it.
+        """
+        ids = pd.Series(document_ids(df, self.source), index=df.index)
+        seen = np.fromiter((doc_id in self._ids for doc_id in ids), bool, len(ids))
+        latest = ~ids.duplicated(keep="last") & ~seen
+        df = df[latest.to_numpy()]
+        self._ids.update(ids[latest])
+        self.reviews += len(df)
+        for field in COUNT_FIELDS:
+            counts = df[field].value_counts(dropna=True)
+            counts = counts[counts > 0]
+            values = redis_values(pd.Series(counts.index, dtype=df[field].dtype))
+            self.counts[field].update(dict(zip(values, counts.tolist())))
+        for field, formats in DATE_FIELDS.items():
+            dates = df[field].dropna()
+            for date_format in formats:
+                self.counts[field].update(
+                    dates.dt.strftime(date_format).value_counts().to_dict()
+                )
+        for field in STAT_FIELDS:
+            values = df[field].dropna().astype("float64")
+            if values.empty:
+                continue
+            count, total, minimum, maximum = self.stats.get(
+                field, [0, 0.0, float("inf"), float("-inf")]
+            )
+            self.stats[field] = [
+                count + len(values),
+                total + float(values.sum()),
+                min(minimum, float(values.min())),
+                max(maximum, float(values.max())),
+            ]
+
+    def rollup(self) -> Dict[str, Any]:
+        """
+        Returns the rollup of everything added so far.
+
+        Returns:
+        Dict[str, Any]: The number of 'reviews', the 'counts' per field and value and the 'stats'
+        [count, sum, min, max] per field.
+        """
+        return {
+            "reviews": self.reviews,
+            "counts": {field: dict(counts) for field, counts in self.counts.items()},
+            "stats": self.stats,
+        }
+
+
+def write_rollup(
+    client: redis.Redis, index_name: str, source: str, rollup: Dict[str, Any]
+) -> None:
+    """
+    Stores the rollup of a source, replacing the one of the previous ingestion.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+    rollup (Dict[str, Any]): The rollup as returned by RollupBuilder.rollup.
+    """
+    pipeline = client.pipeline()
+    pipeline.hset(_rollups_key(index_name), source, json.dumps(rollup))
+    pipeline.incr(ROLLUPS_VERSION_KEY)
+    pipeline.execute()
+
+
+def invalidate_rollups(client: redis.Redis) -> None:
+    """
+    Makes readers reload the rollups, e.g. after the alias was pointed to another index.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    """
+    client.incr(ROLLUPS_VERSION_KEY)
+
+
+def rollups_version(client: redis.Redis) -> int:
+    """
+    Returns the version of the rollups, which changes whenever readers have to reload them.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+
+    Returns:
+    int: The version, 0 if no rollup was written yet.
+    """
+    return int(client.get(ROLLUPS_VERSION_KEY) or 0)
+
+
+def load_rollups(client: redis.Redis, index_name: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Loads the rollups of all sources of an index.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+
+    Returns:
+    Dict[str, Dict[str, Any]]: The rollup of every source, keyed by source.
+    """
+    return {
+        source.decode(): json.loads(rollup)
+        for source, rollup in client.hgetall(_rollups_key(index_name)).items()
+    }
+
+
+def has_rollup(client: redis.Redis, index_name: str, source: str) -> bool:
+    """
+    Checks whether the rollup of a source of an index was written.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    source (str): The source of the reviews.
+
+    Returns:
+    bool: True if the source has a rollup.
+    """
+    return bool(client.hexists(_rollups_key(index_name), source))
+
+
+def missing_sources(
+    client: redis.Redis, index_name: str, rollups: Dict[str, Dict[str, Any]]
+) -> Set[str]:
+    """
+    Returns the sources of the reviews in an index that have no rollup, e.g. sources skipped as
+    unchanged by an incremental run before rollups were written.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    rollups (Dict[str, Dict[str, Any]]): The rollups as returned by load_rollups.
+
+    Returns:
+    Set[str]: The sources without rollup, empty if the index has no SOURCE_FIELD.
+    """
+    try:
+        values = client.ft(index_name).tagvals(SOURCE_FIELD)
+    except redis.ResponseError:
+        return set()
+    sources = {v.decode() if isinstance(v, bytes) else v for v in values}
+    return sources - set(rollups)
+
+
+def _tokens(value: str) -> str:
+    return " ".join(token for token in re.split(r"\W+", value.lower()) if token)
+
+
+def _sources(
+    clauses: List[Tuple[bool, Optional[str], str]], rollups: Dict[str, Any]
+) -> Optional[Set[str]]:
+    # Selects the sources of a tag clause on SOURCE_FIELD, all sources without one
+    sources = set(rollups)
+    for negated, field, value in clauses:
+        if field != SOURCE_FIELD:
+            continue
+        if negated or not value.startswith("{"):
+            return None
+        tags = {tag.replace("\\", "") for tag in value[1:-1].split("|")}
+        # A source without rollup is left to the search index instead of being counted as 0
+        if not tags <= set(rollups):
+            return None
+        sources &= tags
+    return sources
+
+
+def _range_count(counts: Dict[str, int], value: str) -> Optional[int]:
+    bounds = []
+    for part in value[1:-1].split():
+        match = NUMBER.fullmatch(part)
+        if not match:
+            return None
+        bounds.append((float(match["number"]), bool(match["exclusive"])))
+    (low, low_exclusive), (high, high_exclusive) = bounds
+    total = 0
+    for stored, count in counts.items():
+        number = float(stored)
+        if number < low or (low_exclusive and number == low):
+            continue
+        if number > high or (high_exclusive and number == high):
+            continue
+        total += count
+    return total
+
+
+def _text_count(
+    counts: Dict[str, int], value: str, dates: bool, vocabulary: Set[str]
+) -> Optional[int]:
+    if value.startswith("("):
+        alternatives = re.findall(r'"[^"]*"|[^|]+', value[1:-1])
+    else:
+        alternatives = [value]
+    # Date buckets of different granularity overlap
+    if dates and len(alternatives) > 1:
+        return None
+    by_tokens = {_tokens(stored): count for stored, count in counts.items()}
+    total = 0
+    for alternative in alternatives:
+        alternative = alternative.strip('"')
+        # Words that are no value of any source might still match through stemming or prefixes
+        if alternative not in vocabulary:
+            return None
+        total += by_tokens.get(alternative, 0)
+    return total
+
+
+def _count(query: str, rollups: Dict[str, Any]) -> Optional[str]:
+    clauses = [] if query == "*" else list(query_clauses(query))
+    sources = _sources(clauses, rollups)
+    clauses = [clause for clause in clauses if clause[1] != SOURCE_FIELD]
+    if sources is None or len(clauses) > 1:
+        return None
+    selected = [rollups[source] for source in sources]
+    if not clauses:
+        return str(sum(rollup["reviews"] for rollup in selected))
+
+    negated, field, value = clauses[0]
+    if negated or field not in (*COUNT_FIELDS, *DATE_FIELDS):
+        return None
+    vocabulary = {
+        _tokens(stored)
+        for rollup in rollups.values()
+        for stored in rollup["counts"][field]
+    }
+    total = 0
+    for rollup in selected:
+        counts = rollup["counts"][field]
+        if value.startswith("["):
+            count = _range_count(counts, value)
+        else:
+            count = _text_count(counts, value, field in DATE_FIELDS, vocabulary)
+        if count is None:
+            return None
+        total += count
+    return str(total)
+
+
+def _aggregate(plan: AggregationPlan, rollups: Dict[str, Any]) -> Optional[str]:
+    if plan.reduce == "count" and plan.group_by is None and plan.query != "*":
+        return _count(plan.query, rollups)
+    clauses = [] if plan.query == "*" else list(query_clauses(plan.query))
+    sources = _sources(clauses, rollups)
+    if sources is None or any(field != SOURCE_FIELD for _, field, _ in clauses):
+        return None
+    if plan.reduce != "count" and plan.field not in STAT_FIELDS:
+        return None
+
+    # Every group is a list of (rollup, count field value) pairs, the value None selects all
+    groups: Dict[Optional[str], List[Tuple[Dict[str, Any], Optional[str]]]] = {}
+    if plan.group_by is None:
+        groups[None] = [(rollups[source], None) for source in sources]
+    elif plan.group_by == SOURCE_FIELD:
+        for source in sources:
+            groups[source] = [(rollups[source], None)]
+    elif plan.group_by in COUNT_FIELDS and plan.reduce == "count":
+        for source in sources:
+            for value in rollups[source]["counts"][plan.group_by]:
+                groups.setdefault(value, []).append((rollups[source], value))
+    else:
+        return None
+
+    values = {}
+    for group, members in groups.items():
+        if plan.reduce == "count":
+            values[group] = sum(
+                (
+                    rollup["reviews"]
+                    if value is None
+                    else rollup["counts"][plan.group_by][value]
+                )
+                for rollup, value in members
+            )
+            continue
+        stats = [
+            rollup["stats"][plan.field]
+            for rollup, _ in members
+            if plan.field in rollup["stats"]
+        ]
+        if not stats:
+            continue
+        count = sum(stat[0] for stat in stats)
+        total = sum(stat[1] for stat in stats)
+        values[group] = {
+            "sum": total,
+            "avg": total / count,
+            "min": min(stat[2] for stat in stats),
+            "max": max(stat[3] for stat in stats),
+        }[plan.reduce]
+    return format_aggregate(plan, values)
+
+
+def rollup_answer(
+    query: str, rollups: Dict[str, Dict[str, Any]], fields: Dict[str, str]
+) -> Optional[str]:
+    """
+    Answers a query or aggregation plan from the rollups if it only depends on what they record.
+
+    Counts of all reviews, of the reviews of some sources and of the reviews with one value (or one
+    range of values, or one date bucket) of a rolled-up field, counts grouped by a rolled-up field
+    or by source and the sum, mean, minimum and maximum of a numeric field over all reviews or per
+    source are answered in constant time. Everything else, e.g. queries combining two fields, is
+    left to the search index.
+
+    Parameters:
+    query (str): The canonical query or aggregation plan, as returned by
+    generate_quantitative_query.
+    rollups (Dict[str, Dict[str, Any]]): The rollups as returned by load_rollups.
+    fields (Dict[str, str]): The queryable fields as returned by query_fields.
+
+    Returns:
+    Optional[str]: The answer formatted like the one of the search index, or None if the rollups
+    cannot answer the query.
+    """
+    if query == "na" or not rollups:
+        return None
+    try:
+        if is_plan(query):
+            return _aggregate(parse_plan(query, fields), rollups)
+        return _count(query, rollups)
+    except QueryError:
+        # Alternatives separated by '|' are left to the search index
+        return None
@@ -0,0 +1,130 @@
+import hashlib
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import yaml
+from langchain_core.embeddings import Embeddings
+
+
+def load_examples(path: str, split: str) -> List[Tuple[str, str]]:
+    """
+    Loads the labelled questions of a split from the router examples file.
+
+    Parameters:
+    path (str): The path of the YAML file.
+    split (str): The split, 'train' or 'eval'.
+
+    Returns:
+    List[Tuple[str, str]]: The questions together with their label.
+    """
+    with open(path) as f:
+        examples = yaml.safe_load(f)[split]
+    return [
+        (question, label)
+        for label, questions in examples.items()
+        for question in questions
+    ]
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class CentroidRouter:
+    """
+    Routes questions to a question class by their nearest centroid in the embedding space.
+
+    The centroid of a class is the mean of the normalised embeddings of its labelled examples. A
+    question gets the class with the highest cosine similarity, and the margin to the second best
+    class serves as confidence, so callers can fall back to the LLM classifier for questions that
+    are close to two classes.
+    """
+
+    def __init__(self, labels: List[str], centroids: np.ndarray):
+        self.labels = labels
+        self.centroids = _normalise(centroids)
+
+    @classmethod
+    def fit(
+        cls, embedder: Embeddings, examples: List[Tuple[str, str]]
+    ) -> "CentroidRouter":
+        """
+        Computes the centroids of all classes from labelled examples.
+
+        Parameters:
+        embedder (Embeddings): The embedding model used for the questions.
+        examples (List[Tuple[str, str]]): The questions together with their label.
+
+        Returns:
+        CentroidRouter: The router.
+        """
+        questions, labels = zip(*examples)
+        vectors = _normalise(
+            np.asarray(embedder.embed_documents(list(questions)), dtype=np.float32)
+        )
+        classes = sorted(set(labels))
+        centroids = np.vstack(
+            [vectors[[label == c for label in labels]].mean(axis=0) for c in classes]
+        )
+        return cls(classes, centroids)
+
+    @classmethod
+    def load_or_fit(
+        cls,
+        embedder: Embeddings,
+        examples: List[Tuple[str, str]],
+        cache_dir: str,
+        model: str,
+    ) -> "CentroidRouter":
+        """
+        Loads the centroids fitted on the same examples with the same model, or fits and stores them.
+
+        Parameters:
+        embedder (Embeddings): The embedding model used for the questions.
+        examples (List[Tuple[str, str]]): The questions together with their label.
+        cache_dir (str): The directory the centroids are stored in.
+        model (str): The name of the embedding model.
+
+        Returns:
+        CentroidRouter: The router.
+        """
+        digest = hashlib.blake2b(digest_size=12)
+        digest.update(model.encode("utf-8"))
+        for question, label in examples:
+            digest.update(f"\0{label}\0{question}".encode("utf-8"))
+        path = os.path.join(cache_dir, f"centroids-{digest.hexdigest()}.npz")
+        if os.path.exists(path):
+            stored = np.load(path)
+            return cls(stored["labels"].tolist(), stored["centroids"])
+        router = cls.fit(embedder, examples)
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, labels=np.array(router.labels), centroids=router.centroids)
+        return router
+
+    def scores(self, vector: List[float]) -> Dict[str, float]:
+        """
+        Returns the cosine similarity of a question embedding to every centroid.
+
+        Parameters:
+        vector (List[float]): The embedding of the question.
+
+        Returns:
+        Dict[str, float]: The similarity per class.
+        """
+        similarities = self.centroids @ _normalise(np.asarray(vector, dtype=np.float32))
+        return dict(zip(self.labels, similarities.tolist()))
+
+    def route(self, vector: List[float]) -> Tuple[str, float]:
+        """
+        Routes a question embedding to the class of its nearest centroid.
+
+        Parameters:
+        vector (List[float]): The embedding of the question.
+
+        Returns:
+        Tuple[str, float]: The class and the margin of its similarity over the second best class.
+        """
+        ranked = sorted(self.scores(vector).items(), key=lambda item: -item[1])
+        return ranked[0][0], ranked[0][1] - ranked[1][1]
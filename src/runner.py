@@ -0,0 +1,252 @@
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Generator, Iterable, List, Tuple
+
+import pandas as pd
+
+from src.frame_cache import input_fingerprint, load_frame, store_frame
+from src.pipeline import (
+    SeenHashes,
+    clean,
+    clean_chunk,
+    consolidation,
+    data_path,
+    drop_seen_duplicates,
+    likes_mean_of_chunks,
+    memory_footprint,
+    read_data,
+    read_data_chunks,
+)
+
+
+class StageTimer:
+    """
+    Collects the wall-clock time spent per source and pipeline stage.
+
+    Stages running in other processes report their durations with add, stages running in this
+    process are measured with the stage context manager. Next to the durations, the largest memory
+    footprint of a cleaned frame is recorded per source. All methods are thread-safe.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self.memory: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, source: str, stage: str, seconds: float) -> None:
+        """
+        Adds a duration to a stage of a source.
+
+        Parameters:
+        source (str): The name of the source.
+        stage (str): The name of the stage.
+        seconds (float): The duration in seconds.
+        """
+        with self._lock:
+            self.timings[source][stage] += seconds
+
+    def add_memory(self, source: str, df: pd.DataFrame) -> None:
+        """
+        Records the memory footprint of a cleaned frame of a source, keeping the largest one.
+
+        Parameters:
+        source (str): The name of the source.
+        df (pd.DataFrame): The cleaned DataFrame or chunk.
+        """
+        nbytes = memory_footprint(df)
+        with self._lock:
+            self.memory[source] = max(self.memory[source], nbytes)
+
+    @contextmanager
+    def stage(self, source: str, stage: str) -> Generator[None, None, None]:
+        """
+        Measures the duration of the enclosed block and adds it to a stage of a source.
+
+        Parameters:
+        source (str): The name of the source.
+        stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(source, stage, time.perf_counter() - start)
+
+    def report(self) -> str:
+        """
+        Formats the collected durations as a table with one row per source and one column per stage,
+        followed by the largest memory footprint of a cleaned frame in MiB.
+
+        Returns:
+        str: The formatted table.
+        """
+        with self._lock:
+            stages: List[str] = []
+            for timings in self.timings.values():
+                stages.extend(stage for stage in timings if stage not in stages)
+            header = (
+                f"{'source':<12}"
+                + "".join(f"{stage:>14}" for stage in stages)
+                + f"{'memory':>14}"
+            )
+            lines = [header, "-" * len(header)]
+            for source, timings in self.timings.items():
+                lines.append(
+                    f"{source:<12}"
+                    + "".join(f"{timings.get(stage, 0.0):>13.2f}s" for stage in stages)
+                    + f"{self.memory.get(source, 0) / 2**20:>10.1f} MiB"
+                )
+        return "\n".join(lines)
+
+
+def prepare_source(
+    source: str, run_old_pipeline: bool, use_cache: bool = False
+) -> Tuple[pd.DataFrame, Dict[str, float]]:
+    """
+    Reads, consolidates and cleans a source and measures every stage.
+
+    If use_cache is True, the cleaned DataFrame is loaded from the Parquet frame cache when the
+    fingerprint of the CSV file and the cleaning code match, and stored in it otherwise.
+
+    This function runs in a worker process, so it returns the durations instead of recording them.
+
+    Parameters:
+    source (str): The name of the source.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    use_cache (bool): If True, uses the Parquet frame cache.
+
+    Returns:
+    Tuple[pd.DataFrame, Dict[str, float]]: The cleaned DataFrame and the duration of every stage.
+    """
+    timings = {}
+    if use_cache:
+        start = time.perf_counter()
+        fingerprint = input_fingerprint(data_path(source), run_old_pipeline)
+        df = load_frame(source, fingerprint)
+        timings["cache"] = time.perf_counter() - start
+        if df is not None:
+            return df, timings
+
+    start = time.perf_counter()
+    df = read_data(source)
+    timings["read"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df = consolidation(df, source)
+    timings["consolidation"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df = clean(df, run_old_pipeline, source)
+    timings["clean"] = time.perf_counter() - start
+
+    if use_cache:
+        start = time.perf_counter()
+        store_frame(source, fingerprint, df)
+        timings["cache"] += time.perf_counter() - start
+    return df, timings
+
+
+def _clean_chunk_timed(
+    df: pd.DataFrame, run_old_pipeline: bool, source: str, likes_mean: float
+) -> Tuple[pd.DataFrame, float]:
+    start = time.perf_counter()
+    df = clean_chunk(df, run_old_pipeline, source, likes_mean)
+    return df, time.perf_counter() - start
+
+
+def prepare_sources(
+    executor: Executor,
+    sources: Iterable[str],
+    run_old_pipeline: bool,
+    timer: StageTimer,
+    use_cache: bool = False,
+) -> Generator[Tuple[str, pd.DataFrame], None, None]:
+    """
+    Prepares all sources in parallel and yields them as soon as they are cleaned.
+
+    While the caller embeds and writes one source, the remaining sources keep being cleaned by
+    the executor.
+
+    Parameters:
+    executor (Executor): The executor, usually a process pool.
+    sources (Iterable[str]): The names of the sources.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    timer (StageTimer): The timer receiving the durations of every stage.
+    use_cache (bool): If True, uses the Parquet frame cache.
+
+    Returns:
+    Generator[Tuple[str, pd.DataFrame], None, None]: A generator that yields every source together
+    with its cleaned DataFrame in completion order.
+    """
+    futures = {
+        executor.submit(prepare_source, source, run_old_pipeline, use_cache): source
+        for source in sources
+    }
+    for future in as_completed(futures):
+        source = futures[future]
+        df, timings = future.result()
+        for stage, seconds in timings.items():
+            timer.add(source, stage, seconds)
+        timer.add_memory(source, df)
+        yield source, df
+
+
+def prepare_chunks(
+    executor: Executor,
+    source: str,
+    run_old_pipeline: bool,
+    chunksize: int,
+    timer: StageTimer,
+    max_pending: int = 4,
+) -> Generator[pd.DataFrame, None, None]:
+    """
+    Cleans the chunks of a large source in parallel and yields them in order.
+
+    The likes mean and the deduplication across chunks are computed in this process, the cleaning
+    of the deduplicated chunks runs on the executor. At most max_pending chunks are in flight, so
+    the memory is bounded by the chunk size plus the 8 byte hash of every unique row.
+
+    Parameters:
+    executor (Executor): The executor, usually a process pool.
+    source (str): The name of the source.
+    run_old_pipeline (bool): If True, runs the old pipeline, else runs the new pipeline.
+    chunksize (int): The maximum number of rows per chunk.
+    timer (StageTimer): The timer receiving the durations of every stage.
+    max_pending (int): The maximum number of chunks being cleaned at the same time.
+
+    Returns:
+    Generator[pd.DataFrame, None, None]: A generator that yields the cleaned chunks.
+    """
+    with timer.stage(source, "likes mean"):
+        likes_mean = likes_mean_of_chunks(source, chunksize)
+
+    seen = SeenHashes()
+    pending = deque()
+    chunks = iter(read_data_chunks(source, chunksize))
+    while True:
+        with timer.stage(source, "read"):
+            df = next(chunks, None)
+        if df is None:
+            break
+        with timer.stage(source, "consolidation"):
+            df = drop_seen_duplicates(consolidation(df, source), seen)
+        pending.append(
+            executor.submit(
+                _clean_chunk_timed, df, run_old_pipeline, source, likes_mean
+            )
+        )
+        if len(pending) >= max_pending:
+            df, seconds = pending.popleft().result()
+            timer.add(source, "clean", seconds)
+            timer.add_memory(source, df)
+            yield df
+    while pending:
+        df, seconds = pending.popleft().result()
+        timer.add(source, "clean", seconds)
+        timer.add_memory(source, df)
+        yield df
@@ -0,0 +1,259 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    ContextManager,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from config import TRACING_ENABLED
+
+
+BUCKETS = {
+    "seconds": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    "tokens_per_second": (1, 2, 5, 10, 20, 50, 100, 200),
+}
+
+METRIC_PREFIX = "two_agent"
+
+logger = logging.getLogger("two_agent.tracing")
+
+_enabled = False
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+_trace_start: ContextVar[Optional[float]] = ContextVar("trace_start", default=None)
+_histograms: Dict[Tuple[str, str], List[float]] = {}
+_lock = threading.Lock()
+_NOOP = nullcontext()
+
+
+def enable(enabled: bool = True) -> None:
+    """
+    Enables or disables the tracing. While disabled, spans and records cost a single flag check.
+
+    Spans are logged as one JSON object per line to stderr, unless the 'two_agent.tracing' logger
+    is configured otherwise.
+
+    Parameters:
+    enabled (bool): If True, spans are recorded and logged.
+    """
+    global _enabled
+    _enabled = enabled
+    if enabled and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def is_enabled() -> bool:
+    """
+    Returns whether the tracing is enabled.
+
+    Returns:
+    bool: True if spans are recorded.
+    """
+    return _enabled
+
+
+def new_trace() -> Optional[str]:
+    """
+    Starts a new trace for the current request, every span recorded in the same thread or task
+    afterwards belongs to it.
+
+    Returns:
+    Optional[str]: The id of the trace, or None if the tracing is disabled.
+    """
+    if not _enabled:
+        return None
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    _trace_start.set(time.perf_counter())
+    return trace_id
+
+
+def _observe(metric: str, stage: str, value: float) -> None:
+    buckets = BUCKETS[metric]
+    with _lock:
+        # One count per bound, one for +Inf, the number and the sum of the values
+        histogram = _histograms.setdefault((metric, stage), [0.0] * (len(buckets) + 3))
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+def record(stage: str, seconds: float, **attributes: Any) -> None:
+    """
+    Records the duration of a stage that was measured by the caller.
+
+    Parameters:
+    stage (str): The name of the stage.
+    seconds (float): The duration in seconds.
+    attributes (Any): Additional fields of the log line.
+    """
+    if not _enabled:
+        return
+    _observe("seconds", stage, seconds)
+    logger.info(
+        json.dumps(
+            {
+                "ts": time.time(),
+                "trace_id": _trace_id.get(),
+                "span": stage,
+                "duration_ms": round(1000 * seconds, 3),
+                **attributes,
+            },
+            default=str,
+        )
+    )
+
+
+@contextmanager
+def _span(stage: str, attributes: Dict[str, Any]) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if error is not None:
+            attributes["error"] = error
+        record(stage, time.perf_counter() - start, **attributes)
+
+
+def span(stage: str, **attributes: Any) -> ContextManager[None]:
+    """
+    Measures the duration of the enclosed block as a stage of the current trace.
+
+    Parameters:
+    stage (str): The name of the stage, e.g. 'classify'.
+    attributes (Any): Additional fields of the log line.
+
+    Returns:
+    ContextManager[None]: The span, a shared no-op context manager if the tracing is disabled.
+    """
+    if not _enabled:
+        return _NOOP
+    return _span(stage, attributes)
+
+
+class _TokenStats:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.tokens = 0
+
+    def token(self) -> None:
+        if self.first is None:
+            self.first = time.perf_counter()
+        self.tokens += 1
+
+    def finish(self) -> None:
+        end = time.perf_counter()
+        if self.first is not None:
+            origin = _trace_start.get() or self.start
+            record(f"{self.stage}.ttft", self.first - origin)
+        generation = end - (self.first or end)
+        tokens_per_second = self.tokens / generation if generation > 0 else 0.0
+        if self.tokens > 1:
+            _observe("tokens_per_second", self.stage, tokens_per_second)
+        record(
+            self.stage,
+            end - self.start,
+            tokens=self.tokens,
+            tokens_per_second=round(tokens_per_second, 2),
+        )
+
+
+def observe_tokens(
+    tokens: Iterable[str], stage: str = "generation"
+) -> Generator[str, None, None]:
+    """
+    Passes through a stream of tokens and records its time to first token and tokens per second.
+
+    The time to first token is measured from the start of the current trace, or from the start of
+    the stream if there is none. Every chunk of a stream counts as one token.
+
+    Parameters:
+    tokens (Iterable[str]): The tokens.
+    stage (str): The name of the stage.
+
+    Returns:
+    Generator[str, None, None]: A generator that yields the tokens.
+    """
+    stats = _TokenStats(stage)
+    try:
+        for token in tokens:
+            stats.token()
+            yield token
+    finally:
+        stats.finish()
+
+
+async def observe_tokens_async(
+    tokens: AsyncIterable[str], stage: str = "generation"
+) -> AsyncGenerator[str, None]:
+    """
+    Passes through an asynchronous stream of tokens and records its time to first token and tokens
+    per second, like observe_tokens.
+
+    Parameters:
+    tokens (AsyncIterable[str]): The tokens.
+    stage (str): The name of the stage.
+
+    Returns:
+    AsyncGenerator[str, None]: An async generator that yields the tokens.
+    """
+    stats = _TokenStats(stage)
+    try:
+        async for token in tokens:
+            stats.token()
+            yield token
+    finally:
+        stats.finish()
+
+
+def prometheus_text() -> str:
+    """
+    Exports the recorded stages as Prometheus histograms in the text exposition format.
+
+    Returns:
+    str: The metrics.
+    """
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+    lines = []
+    for metric, buckets in BUCKETS.items():
+        name = f"{METRIC_PREFIX}_stage_{metric}"
+        lines.append(f"# TYPE {name} histogram")
+        for (family, stage), values in sorted(histograms.items()):
+            if family != metric:
+                continue
+            cumulative = 0.0
+            for bound, count in zip((*buckets, "+Inf"), values[:-2]):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative:g}'
+                )
+            lines.append(f'{name}_sum{{stage="{stage}"}} {values[-1]:g}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {values[-2]:g}')
+    return "\n".join(lines) + "\n"
+
+
+enable(TRACING_ENABLED)
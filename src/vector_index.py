@@ -0,0 +1,448 @@
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import numpy as np
+import redis
+import yaml
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from redis.commands.search.field import NumericField, TagField, TextField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+from config import INDEX_PROFILES, REDIS_INDEX_PROFILE
+from src.tracing import span
+
+
+VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16}
+
+PROFILES_KEY = "index-profiles"
+
+DISTANCE_FIELD = "vector_distance"
+
+
+def load_schema(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Loads the index schema from a YAML file.
+
+    Parameters:
+    path (str): The path of the schema file.
+
+    Returns:
+    Dict[str, List[Dict[str, Any]]]: The fields of the schema, grouped by field type.
+    """
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def vector_field(schema: Dict[str, Any], profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the definition of the vector field with the settings of an index profile applied.
+
+    Parameters:
+    schema (Dict[str, Any]): The index schema as returned by load_schema.
+    profile (Dict[str, Any]): The index profile, e.g. an entry of INDEX_PROFILES.
+
+    Returns:
+    Dict[str, Any]: The vector field of the schema, updated with the profile.
+    """
+    return {**schema["vector"][0], **profile}
+
+
+def metadata_fields(schema: Dict[str, Any]) -> List[str]:
+    """
+    Returns the names of all non-vector fields of the schema except 'content'.
+
+    Parameters:
+    schema (Dict[str, Any]): The index schema as returned by load_schema.
+
+    Returns:
+    List[str]: The names of the metadata fields.
+    """
+    return [
+        field["name"]
+        for field_type in ("text", "numeric", "tag")
+        for field in schema.get(field_type, [])
+        if field["name"] != "content"
+    ]
+
+
+def index_fields(schema: Dict[str, Any], profile: Dict[str, Any]) -> List[Any]:
+    """
+    Builds the RediSearch fields of the schema with the vector settings of an index profile.
+
+    Parameters:
+    schema (Dict[str, Any]): The index schema as returned by load_schema.
+    profile (Dict[str, Any]): The index profile.
+
+    Returns:
+    List[Any]: The fields passed to FT.CREATE.
+    """
+    fields = []
+    for field in schema.get("text", []):
+        fields.append(
+            TextField(
+                field["name"],
+                weight=field.get("weight", 1),
+                no_stem=field.get("no_stem", False),
+                sortable=field.get("sortable", False),
+            )
+        )
+    for field in schema.get("numeric", []):
+        fields.append(
+            NumericField(field["name"], sortable=field.get("sortable", False))
+        )
+    for field in schema.get("tag", []):
+        fields.append(
+            TagField(
+                field["name"],
+                separator=field.get("separator", ","),
+                sortable=field.get("sortable", False),
+            )
+        )
+
+    vector = vector_field(schema, profile)
+    attributes = {
+        "TYPE": vector["datatype"],
+        "DIM": vector["dims"],
+        "DISTANCE_METRIC": vector["distance_metric"],
+    }
+    if vector["algorithm"] == "HNSW":
+        attributes["M"] = vector["m"]
+        attributes["EF_CONSTRUCTION"] = vector["ef_construction"]
+        attributes["EF_RUNTIME"] = vector["ef_runtime"]
+    fields.append(VectorField(vector["name"], vector["algorithm"], attributes))
+    return fields
+
+
+def key_prefix(index_name: str) -> str:
+    """
+    Returns the prefix of the keys of all documents of an index.
+
+    Parameters:
+    index_name (str): The name of the index.
+
+    Returns:
+    str: The key prefix.
+    """
+    return f"doc:{index_name}:"
+
+
+def index_exists(client: redis.Redis, index_name: str) -> bool:
+    """
+    Checks whether an index exists.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+
+    Returns:
+    bool: True if the index exists.
+    """
+    try:
+        client.ft(index_name).info()
+    except redis.ResponseError:
+        return False
+    return True
+
+
+def create_index(
+    client: redis.Redis, index_name: str, schema_path: str, profile_name: str
+) -> None:
+    """
+    Creates an index over the document hashes of the index if it does not exist yet.
+
+    The name of the profile is recorded with the index, so readers use the vector settings the
+    index was built with.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    schema_path (str): The path of the schema file.
+    profile_name (str): The name of the index profile in INDEX_PROFILES.
+    """
+    if index_exists(client, index_name):
+        return
+    schema = load_schema(schema_path)
+    client.ft(index_name).create_index(
+        index_fields(schema, INDEX_PROFILES[profile_name]),
+        definition=IndexDefinition(
+            prefix=[key_prefix(index_name)], index_type=IndexType.HASH
+        ),
+    )
+    client.hset(PROFILES_KEY, index_name, profile_name)
+
+
+def resolve_index(client: redis.Redis, name: str) -> Optional[str]:
+    """
+    Resolves an index alias (or an index name) to the name of the index behind it.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the alias or index.
+
+    Returns:
+    Optional[str]: The name of the index, or None if neither an alias nor an index exists.
+    """
+    try:
+        index_name = client.ft(name).info()["index_name"]
+    except redis.ResponseError:
+        return None
+    return index_name.decode() if isinstance(index_name, bytes) else index_name
+
+
+def indexed_fields(client: redis.Redis, name: str) -> Set[str]:
+    """
+    Returns the names of the fields an index (or the index behind an alias) was created with.
+
+    create_index keeps existing indices, so fields added to the schema later are missing from
+    indices created before, until they are rebuilt with reindex.py.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the alias or index.
+
+    Returns:
+    Set[str]: The names of the indexed fields.
+    """
+    fields = set()
+    for attribute in client.ft(name).info()["attributes"]:
+        values = [v.decode() if isinstance(v, bytes) else v for v in attribute]
+        fields.add(values[values.index("attribute") + 1])
+    return fields
+
+
+def index_profile(client: redis.Redis, name: str) -> Dict[str, Any]:
+    """
+    Returns the profile an index (or the index behind an alias) was created with.
+
+    Indices created before profiles were recorded fall back to REDIS_INDEX_PROFILE.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the alias or index.
+
+    Returns:
+    Dict[str, Any]: The index profile.
+    """
+    index_name = resolve_index(client, name) or name
+    profile_name = client.hget(PROFILES_KEY, index_name)
+    if profile_name is None:
+        return INDEX_PROFILES[REDIS_INDEX_PROFILE]
+    return INDEX_PROFILES[profile_name.decode()]
+
+
+def point_alias(client: redis.Redis, alias: str, index_name: str) -> None:
+    """
+    Atomically points an alias to an index, adding the alias if it does not exist.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    alias (str): The name of the alias.
+    index_name (str): The name of the index.
+    """
+    client.ft(index_name).aliasupdate(alias)
+
+
+def document_count(client: redis.Redis, name: str) -> int:
+    """
+    Returns the number of documents of an index once all of them are indexed.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    name (str): The name of the alias or index.
+
+    Returns:
+    int: The number of indexed documents.
+    """
+    while float(client.ft(name).info()["percent_indexed"]) < 1:
+        time.sleep(0.1)
+    return int(client.ft(name).info()["num_docs"])
+
+
+def drop_index(client: redis.Redis, index_name: str) -> None:
+    """
+    Drops an index together with its documents and its recorded profile.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    """
+    client.ft(index_name).dropindex(delete_documents=True)
+    client.hdel(PROFILES_KEY, index_name)
+
+
+def pack_vector(vector: List[float], profile: Dict[str, Any]) -> bytes:
+    """
+    Packs a vector as raw bytes in the datatype of an index profile.
+
+    Parameters:
+    vector (List[float]): The vector.
+    profile (Dict[str, Any]): The index profile.
+
+    Returns:
+    bytes: The packed vector.
+    """
+    return np.asarray(vector, dtype=VECTOR_DTYPES[profile["datatype"]]).tobytes()
+
+
+def write_documents(
+    client: redis.Redis,
+    index_name: str,
+    profile: Dict[str, Any],
+    keys: List[str],
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[Dict[str, Any]],
+) -> None:
+    """
+    Writes documents as hashes that are indexed by the index.
+
+    Metadata values that are None are left out, so missing values are not indexed.
+
+    Parameters:
+    client (redis.Redis): The Redis client.
+    index_name (str): The name of the index.
+    profile (Dict[str, Any]): The index profile, which defines the datatype of the vectors.
+    keys (List[str]): The document ids.
+    texts (List[str]): The contents of the documents.
+    vectors (List[List[float]]): The embeddings of the contents.
+    metadatas (List[Dict[str, Any]]): The metadata of the documents.
+    """
+    pipeline = client.pipeline(transaction=False)
+    for key, text, vector, metadata in zip(keys, texts, vectors, metadatas):
+        mapping = {name: value for name, value in metadata.items() if value is not None}
+        mapping["content"] = text
+        mapping["content_vector"] = pack_vector(vector, profile)
+        pipeline.hset(f"{key_prefix(index_name)}{key}", mapping=mapping)
+    pipeline.execute()
+
+
+def knn_query(
+    k: int,
+    profile: Dict[str, Any],
+    return_fields: List[str],
+    filter_expression: str = "*",
+) -> Query:
+    """
+    Builds a KNN query over the vector field, honouring the EF_RUNTIME of HNSW profiles.
+
+    Parameters:
+    k (int): The number of nearest neighbours.
+    profile (Dict[str, Any]): The index profile.
+    return_fields (List[str]): The fields returned for every document.
+    filter_expression (str): A query expression restricting the candidates.
+
+    Returns:
+    Query: The query, to be executed with the packed query vector as parameter 'vector'.
+    """
+    runtime = " EF_RUNTIME $ef_runtime" if profile["algorithm"] == "HNSW" else ""
+    return (
+        Query(
+            f"({filter_expression})=>[KNN {k} @content_vector $vector{runtime} "
+            f"AS {DISTANCE_FIELD}]"
+        )
+        .return_fields(*return_fields, DISTANCE_FIELD)
+        .sort_by(DISTANCE_FIELD)
+        .paging(0, k)
+        .dialect(2)
+    )
+
+
+def knn_params(vector: List[float], profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the query parameters of a KNN query built by knn_query.
+
+    Parameters:
+    vector (List[float]): The query vector.
+    profile (Dict[str, Any]): The index profile.
+
+    Returns:
+    Dict[str, Any]: The query parameters.
+    """
+    params = {"vector": pack_vector(vector, profile)}
+    if profile["algorithm"] == "HNSW":
+        params["ef_runtime"] = profile["ef_runtime"]
+    return params
+
+
+def to_documents(result: Any, fields: List[str]) -> List[Document]:
+    """
+    Converts the result of a KNN query to documents.
+
+    Parameters:
+    result (Any): The search result.
+    fields (List[str]): The metadata fields to copy to the documents.
+
+    Returns:
+    List[Document]: The documents with their metadata, id and vector distance.
+    """
+    documents = []
+    for doc in result.docs:
+        metadata = {
+            field: getattr(doc, field) for field in fields if hasattr(doc, field)
+        }
+        metadata["id"] = doc.id
+        metadata[DISTANCE_FIELD] = float(getattr(doc, DISTANCE_FIELD))
+        documents.append(Document(page_content=doc.content, metadata=metadata))
+    return documents
+
+
+class RedisKNNRetriever(BaseRetriever):
+    """
+    Retrieves the k nearest reviews of a question from a RediSearch vector index.
+
+    Unlike the langchain Redis vector store, the vectors are packed in the datatype of the index
+    profile, so FLOAT16 indices are supported, and HNSW queries use the EF_RUNTIME of the profile.
+    If a prefilter is given, it maps the question to a filter expression restricting the candidates
+    of the KNN search, e.g. to the reviews of the app the question asks about. If no review passes
+    the filter, the search is repeated without it.
+    """
+
+    client: Any
+    index_name: str
+    embedder: Embeddings
+    profile: Dict[str, Any]
+    fields: List[str]
+    k: int = 10
+    prefilter: Optional[Callable[[str], str]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: Optional[CallbackManagerForRetrieverRun] = None,
+    ) -> List[Document]:
+        with span("retrieval.embed"):
+            vector = self.embedder.embed_query(query)
+        filter_expression = "*" if self.prefilter is None else self.prefilter(query)
+        return self.search(vector, filter_expression)
+
+    def search(
+        self, vector: List[float], filter_expression: str = "*"
+    ) -> List[Document]:
+        """
+        Searches the nearest reviews of an embedding among the reviews passing a filter.
+
+        Parameters:
+        vector (List[float]): The embedding of the question.
+        filter_expression (str): The filter expression, '*' for all reviews.
+
+        Returns:
+        List[Document]: The nearest reviews, of all reviews if none passes the filter.
+        """
+        with span("retrieval.search", k=self.k, filter=filter_expression):
+            result = self.client.ft(self.index_name).search(
+                knn_query(
+                    self.k, self.profile, ["content", *self.fields], filter_expression
+                ),
+                query_params=knn_params(vector, self.profile),
+            )
+        if not result.docs and filter_expression != "*":
+            return self.search(vector)
+        return to_documents(result, self.fields)
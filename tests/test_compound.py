@@ -0,0 +1,79 @@
+import threading
+from types import SimpleNamespace
+
+from langchain_core.documents import Document
+
+import llm
+from src.compound import SubAnswer
+
+
+def _stream(tokens, threads, closed, name):
+    try:
+        for token in tokens:
+            threads.add(threading.current_thread().name)
+            yield {"message": {"content": token}}
+    finally:
+        closed.append(name)
+
+
+def _parts(threads, closed):
+    return [
+        SubAnswer(
+            question,
+            "quantitative",
+            _stream(tokens, threads[question], closed, question),
+            [],
+            "ollama",
+        )
+        for question, tokens in (
+            ("How many?", ["There are", " 42."]),
+            ("Why?", ["Users like", " playlists."]),
+        )
+    ]
+
+
+def test_merges_the_answers_in_order():
+    threads = {"How many?": set(), "Why?": set()}
+    closed = []
+
+    text = "".join(
+        chunk["message"]["content"]
+        for chunk in llm.merge_answers(_parts(threads, closed))
+    )
+
+    assert text == "**How many?**\n\nThere are 42.\n\n**Why?**\n\nUsers like playlists."
+    # The first answer is read by the consumer, the others on the pump threads
+    assert threads["How many?"] == {threading.current_thread().name}
+    assert all(name.startswith("compound-pump") for name in threads["Why?"])
+    assert sorted(closed) == ["How many?", "Why?"]
+
+
+def test_closing_the_merged_stream_closes_the_answers():
+    threads = {"How many?": set(), "Why?": set()}
+    closed = []
+    stream = llm.merge_answers(_parts(threads, closed))
+
+    next(stream)
+    next(stream)
+    stream.close()
+
+    assert "How many?" in closed
+
+
+def test_speculative_answer_treats_unknown_classes_as_qualitative(monkeypatch):
+    context = [Document(page_content="Great playlists", metadata={"id": "doc:1"})]
+    components = SimpleNamespace(
+        retriever=SimpleNamespace(invoke=lambda question: context),
+        answer_chain=SimpleNamespace(stream=lambda inputs: iter([{"answer": "Yes"}])),
+    )
+    monkeypatch.setattr(llm, "get_rag_components", lambda: components)
+    monkeypatch.setattr(llm, "classify_question", lambda question: "I am not sure.")
+    monkeypatch.setattr(llm, "generate_quantitative_query", lambda question: "na")
+    monkeypatch.setattr(llm, "compound_answer", None)
+
+    answer = llm.speculative_answer("Is it good?")
+
+    assert answer.question_class == "qualitative"
+    assert answer.model_type == "langchain"
+    assert answer.context == context
+    assert list(answer.stream) == [{"answer": "Yes"}]
@@ -0,0 +1,53 @@
+import pytest
+
+from src.embedding_cache import EmbeddingCache
+
+
+def _vector(value, dim=3):
+    return [float(value)] * dim
+
+
+def test_entries_survive_a_flush(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), capacity=4)
+    cache.put_many("model", ["a", "b"], [_vector(1), _vector(2)])
+    cache.flush()
+
+    reopened = EmbeddingCache(str(tmp_path), capacity=4)
+
+    assert reopened.get_many("model", ["a", "b", "c"]) == [_vector(1), _vector(2), None]
+
+
+def test_new_dimension_replaces_the_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), capacity=4)
+    cache.put_many("small", ["a"], [_vector(1)])
+    cache.flush()
+
+    reopened = EmbeddingCache(str(tmp_path), capacity=4)
+    reopened.put_many("large", ["a"], [_vector(2, dim=5)])
+    reopened.flush()
+
+    assert reopened.get_many("small", ["a"]) == [None]
+    assert reopened.get_many("large", ["a"]) == [_vector(2, dim=5)]
+    assert EmbeddingCache(str(tmp_path), capacity=4).dim == 5
+
+
+def test_evicted_slots_are_not_served_after_a_crash(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), capacity=2)
+    cache.put_many("model", ["a", "b"], [_vector(1), _vector(2)])
+    cache.flush()
+    # Evicts "a" and overwrites its slot, then the process ends without a flush
+    cache.put_many("model", ["c"], [_vector(3)])
+
+    reopened = EmbeddingCache(str(tmp_path), capacity=2)
+    cached = reopened.get_many("model", ["a", "b", "c"])
+
+    assert cached[0] is None
+    assert cached[1] == _vector(2)
+    assert cached[2] in (None, _vector(3))
+
+
+def test_rejects_vectors_of_mixed_dimensions(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), capacity=4)
+
+    with pytest.raises(ValueError):
+        cache.put_many("model", ["a", "b"], [_vector(1), _vector(2, dim=4)])
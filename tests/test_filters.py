@@ -0,0 +1,48 @@
+import pytest
+
+from src.filters import extract_filters
+
+
+FIELDS = {
+    "content": "text",
+    "score": "numeric",
+    "weekday": "text",
+    "source": "tag",
+    "created_timestamp": "numeric",
+}
+
+
+@pytest.mark.parametrize(
+    "question, expected",
+    [
+        ("What do 1-star reviews say?", "@score:[1 1]"),
+        ("What do reviews rated 3 say?", "@score:[3 3]"),
+        ("What do reviews rated 3 or lower say?", "@score:[1 3]"),
+        ("What do reviews rated 4 or higher praise?", "@score:[4 5]"),
+        ("What do reviews with a rating of 2 or less say?", "@score:[1 2]"),
+        ("What do 4 stars or better reviews say?", "@score:[4 5]"),
+        ("What do reviews with at least 4 stars say?", "@score:[4 5]"),
+        ("What do 1 or 2 star reviews say?", "@score:[1 2]"),
+        ("What do users like?", "*"),
+    ],
+)
+def test_score_filters(question, expected):
+    assert extract_filters(question, FIELDS) == expected
+
+
+def test_combines_source_weekday_and_score():
+    question = "What do Netflix users rated 2 or lower complain about on weekends?"
+
+    assert extract_filters(question, FIELDS) == (
+        "@score:[1 2] @source:{netflix} @weekday:(saturday|sunday)"
+    )
+
+
+def test_skips_fields_missing_from_the_index():
+    fields = {"content": "text", "score": "numeric"}
+
+    assert extract_filters("What do Spotify users say in 2023?", fields) == "*"
+    assert (
+        extract_filters("What do Spotify users rated 5 say in 2023?", fields)
+        == "@score:[5 5]"
+    )
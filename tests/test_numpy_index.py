@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import redis
+
+import llm
+from src.numpy_index import (
+    NumpyKNNRetriever,
+    NumpyVectorIndex,
+    exported_fields,
+    snapshot_version,
+)
+
+
+def _export(directory, exported_at=1.0):
+    documents = pd.DataFrame(
+        {
+            "id": ["doc:1", "doc:2", "doc:3"],
+            "content": ["Great playlists", "Love the mixes", "Too many ads, not great"],
+            "weekday": ["Saturday", "Sunday", "Monday"],
+            "source": ["spotify", "ChatGPT", "netflix"],
+            "score": [5, 4, 1],
+        }
+    )
+    documents.to_parquet(directory / "documents.parquet")
+    np.eye(3, dtype=np.float32).tofile(directory / "vectors.bin")
+    meta = {
+        "index_name": "reviews-1",
+        "count": 3,
+        "dims": 3,
+        "dtype": "float32",
+        "exported_at": exported_at,
+    }
+    with open(directory / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+
+@pytest.fixture
+def index(tmp_path):
+    _export(tmp_path)
+    return NumpyVectorIndex(str(tmp_path))
+
+
+@pytest.mark.parametrize(
+    "expression, rows",
+    [
+        ("@weekday:Saturday", [0]),
+        ("@weekday:(saturday|Sunday)", [0, 1]),
+        ("Great", [0, 2]),
+        ('"NOT Great"', [2]),
+        ("@source:{ChatGPT}", [1]),
+        ("@source:{chatgpt|Netflix}", [1, 2]),
+        ("@score:[4 5] -@weekday:sunday", [0]),
+    ],
+)
+def test_filters_match_regardless_of_case(index, expression, rows):
+    assert np.flatnonzero(index.mask(expression)).tolist() == rows
+
+
+def test_search_only_returns_rows_of_the_mask(index):
+    rows, _ = index.search(np.array([0.0, 1.0, 0.0]), 2, index.mask("Great"))
+
+    assert set(rows[0].tolist()) == {0, 2}
+
+
+def test_snapshot_version_and_fields(tmp_path):
+    assert snapshot_version(str(tmp_path)) is None
+
+    _export(tmp_path, exported_at=2.0)
+
+    assert snapshot_version(str(tmp_path)) == 2.0
+    assert exported_fields(str(tmp_path)) == ["weekday", "source", "score"]
+
+
+class _UnreachableRedis:
+    def ft(self, name):
+        raise redis.ConnectionError("Redis is down")
+
+    def hget(self, *args):
+        raise redis.ConnectionError("Redis is down")
+
+
+def test_numpy_backend_does_not_need_redis(tmp_path, monkeypatch):
+    _export(tmp_path, exported_at=1.0)
+    monkeypatch.setattr(llm, "RETRIEVER_BACKEND", "numpy")
+    monkeypatch.setattr(llm, "NUMPY_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(llm, "redis_client", _UnreachableRedis())
+    monkeypatch.setattr(llm, "_rag_components", None)
+    monkeypatch.setattr(llm, "_rag_chain_checked_at", float("-inf"))
+    monkeypatch.setattr(llm, "_filter_fields_loaded_at", float("-inf"))
+    monkeypatch.setattr(llm, "rag_chain_stats", {"builds": 0})
+
+    retriever = llm.get_rag_components().retriever
+
+    assert isinstance(retriever, NumpyKNNRetriever)
+    assert retriever.fields == ["weekday", "source", "score"]
+    assert set(llm.get_filter_fields()) == {"weekday", "source", "score"} & set(
+        llm.schema_fields
+    )
+
+    # A new export is picked up once the pipeline is checked again
+    _export(tmp_path, exported_at=2.0)
+    monkeypatch.setattr(llm, "_rag_chain_checked_at", float("-inf"))
+
+    assert llm.get_rag_components().retriever is not retriever
+    assert llm.rag_chain_stats["builds"] == 2
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from src.pipeline import SeenHashes, drop_seen_duplicates
+
+
+def test_drops_duplicates_within_and_across_chunks():
+    seen = SeenHashes()
+    first = pd.DataFrame({"content": ["a", "b", "a"], "score": [1, 2, 1]})
+    second = pd.DataFrame({"content": ["b", "c", "c", "a"], "score": [2, 3, 3, 5]})
+
+    kept = [drop_seen_duplicates(df, seen) for df in (first, second)]
+
+    assert kept[0].to_dict("list") == {"content": ["a", "b"], "score": [1, 2]}
+    assert kept[1].to_dict("list") == {"content": ["c", "a"], "score": [3, 5]}
+    assert len(seen) == 4
+
+
+def test_keeps_the_hashes_sorted_in_eight_bytes():
+    seen = SeenHashes()
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        seen.add(rng.integers(0, 1000, size=200, dtype=np.uint64))
+
+    assert seen.hashes.dtype == np.uint64
+    assert np.all(np.diff(seen.hashes.astype(np.int64)) > 0)
+    assert not seen.add(seen.hashes.copy()).any()
+
+
+def test_drops_duplicates_across_chunks_with_different_dtypes():
+    seen = SeenHashes()
+    first = pd.DataFrame({"content": ["a", "b"], "likes": [1, 2]})
+    second = pd.DataFrame({"content": ["a", "c"], "likes": [1.0, np.nan]})
+
+    kept = [drop_seen_duplicates(df, seen) for df in (first, second)]
+
+    assert first["likes"].dtype == "int64" and second["likes"].dtype == "float64"
+    assert [len(df) for df in kept] == [2, 1]
+    assert kept[1]["content"].tolist() == ["c"]
@@ -0,0 +1,76 @@
+import pytest
+
+from src.aggregation import canonical_request
+from src.query_parser import QueryError, count_query, parse_query, query_clauses
+
+
+FIELDS = {
+    "content": "text",
+    "weekday": "text",
+    "score": "numeric",
+    "source": "tag",
+}
+
+
+@pytest.mark.parametrize(
+    "query, canonical",
+    [
+        ("@score:5 @source:{Netflix}", "@score:[5 5] @source:{netflix}"),
+        ("@source:{netflix} @score:[5 5]", "@score:[5 5] @source:{netflix}"),
+        ("@weekday:Saturday | @weekday:Sunday", "@weekday:saturday|@weekday:sunday"),
+        ("@weekday:Sunday|@weekday:Saturday", "@weekday:saturday|@weekday:sunday"),
+        ("great|awesome", "awesome|great"),
+        ("(spotify|netflix) app", "(netflix|spotify) app"),
+        (
+            "@source:{spotify} (@score:1 | @score:[5 5])",
+            "(@score:[1 1]|@score:[5 5]) @source:{spotify}",
+        ),
+        ("bad app | @score:1", "(app bad)|@score:[1 1]"),
+        ("(crash) -(@score:4 | @score:5)", "-(@score:[4 4]|@score:[5 5]) crash"),
+        ("great | great", "great"),
+        ("NA", "na"),
+        ("*", "*"),
+        ("`*`", "*"),
+    ],
+)
+def test_canonical_form(query, canonical):
+    assert parse_query(query, FIELDS) == canonical
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "",
+        "@likes:[1 2]",
+        "-@score:1",
+        "great | -@score:1",
+        "(great",
+        "great)",
+        "a | | b",
+    ],
+)
+def test_rejects_invalid_queries(query):
+    with pytest.raises(QueryError):
+        parse_query(query, FIELDS)
+
+
+def test_clauses_of_a_conjunction():
+    assert list(query_clauses("-@score:[1 2] @source:{spotify} great")) == [
+        (True, "score", "[1 2]"),
+        (False, "source", "{spotify}"),
+        (False, None, "great"),
+    ]
+
+
+def test_clauses_reject_alternatives():
+    with pytest.raises(QueryError):
+        list(query_clauses("@weekday:saturday|@weekday:sunday"))
+
+
+def test_match_all_query_counts_all_reviews():
+    query = canonical_request("*", FIELDS)
+    search = count_query(query)
+
+    assert query == "*"
+    assert search.query_string() == "*"
+    assert search.get_args()[-3:] == ["LIMIT", 0, 0]
@@ -0,0 +1,44 @@
+import fakeredis
+import redis
+
+from src.response_cache import ResponseCache
+
+
+class _UnreachableRedis:
+    def get(self, key):
+        raise redis.ConnectionError("Redis is down")
+
+    def pipeline(self, transaction=True):
+        raise redis.ConnectionError("Redis is down")
+
+
+def test_redis_outage_is_a_miss_and_a_skipped_write():
+    cache = ResponseCache(_UnreachableRedis(), capacity=4)
+
+    assert cache.get("classify", "How many reviews?", "prompt", "model") is None
+    cache.put("classify", "How many reviews?", "prompt", "model", "quantitative")
+
+    # The response is still served from memory
+    assert (
+        cache.get("classify", "how many reviews", "prompt", "model") == "quantitative"
+    )
+    assert cache.stats()["classify"] == {
+        "memory": 1,
+        "redis": 0,
+        "semantic": 0,
+        "miss": 1,
+        "error": 2,
+        "hit_rate": 0.5,
+    }
+
+
+def test_entries_are_shared_through_redis():
+    client = fakeredis.FakeRedis()
+    ResponseCache(client).put("rephrase", "Question", "prompt", "model", "Answer")
+
+    cache = ResponseCache(client)
+
+    assert cache.get("rephrase", "question?", "prompt", "model") == "Answer"
+    assert cache.get("rephrase", "question", "other prompt", "model") is None
+    assert cache.stats()["rephrase"]["redis"] == 1
+    assert cache.stats()["rephrase"]["error"] == 0
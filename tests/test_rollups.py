@@ -0,0 +1,116 @@
+import json
+
+import fakeredis
+import pandas as pd
+
+from src.rollups import (
+    RollupBuilder,
+    has_rollup,
+    invalidate_rollups,
+    load_rollups,
+    missing_sources,
+    rollup_answer,
+    rollups_version,
+    write_rollup,
+)
+
+
+FIELDS = {"content": "text", "score": "numeric", "weekday": "text", "source": "tag"}
+
+
+def _frame(rows):
+    df = pd.DataFrame(
+        rows, columns=["content", "created_date", "score", "likes", "weekday"]
+    )
+    df["created_date"] = pd.to_datetime(df["created_date"])
+    df["likes_weighted"] = df["likes"].astype(float)
+    df["contains_source_word"] = False
+    return df
+
+
+def _stored(builder):
+    # Rollups are read back from their JSON in Redis
+    return json.loads(json.dumps(builder.rollup()))
+
+
+def test_counts_reviews_repeated_across_chunks_once():
+    builder = RollupBuilder("spotify")
+    builder.add(
+        _frame(
+            [
+                ("Great app", "2023-05-06", 5, 1, "Saturday"),
+                ("Crashes", "2023-05-07", 1, 0, "Sunday"),
+                ("Crashes", "2023-05-07", 2, 3, "Sunday"),
+            ]
+        )
+    )
+    builder.add(
+        _frame(
+            [
+                ("Great app", "2023-05-06", 5, 1, "Saturday"),
+                ("Love it", "2023-05-08", 4, 2, "Monday"),
+            ]
+        )
+    )
+
+    rollup = _stored(builder)
+
+    assert rollup["reviews"] == 3
+    assert rollup["counts"]["score"] == {"5": 1, "2": 1, "4": 1}
+    assert rollup["counts"]["created_date"]["2023-05"] == 3
+    assert rollup["stats"]["likes"][:2] == [3, 6.0]
+
+
+def test_answers_counts_from_the_rollups():
+    builder = RollupBuilder("spotify")
+    builder.add(_frame([("Great app", "2023-05-06", 5, 1, "Saturday")]))
+    rollups = {"spotify": _stored(builder)}
+
+    assert rollup_answer("*", rollups, FIELDS) == "1"
+    assert rollup_answer("@source:{spotify}", rollups, FIELDS) == "1"
+    assert rollup_answer("@score:[5 5]", rollups, FIELDS) == "1"
+    assert rollup_answer("@score:[1 1]|@score:[5 5]", rollups, FIELDS) is None
+
+
+def test_writing_and_invalidating_rollups_changes_the_version():
+    client = fakeredis.FakeRedis()
+    builder = RollupBuilder("netflix")
+    builder.add(_frame([("Too expensive", "2023-01-02", 2, 0, "Monday")]))
+
+    assert rollups_version(client) == 0
+    write_rollup(client, "reviews-1", "netflix", builder.rollup())
+    assert rollups_version(client) == 1
+    invalidate_rollups(client)
+    assert rollups_version(client) == 2
+    assert load_rollups(client, "reviews-1")["netflix"]["reviews"] == 1
+
+
+def test_sources_without_rollup_are_left_to_the_index():
+    builder = RollupBuilder("spotify")
+    builder.add(_frame([("Great app", "2023-05-06", 5, 1, "Saturday")]))
+    rollups = {"spotify": _stored(builder)}
+
+    assert rollup_answer("@source:{netflix}", rollups, FIELDS) is None
+    assert rollup_answer("@source:{netflix|spotify}", rollups, FIELDS) is None
+    assert rollup_answer("@source:{spotify} @score:[5 5]", rollups, FIELDS) == "1"
+
+
+class _Index:
+    def __init__(self, sources):
+        self.sources = sources
+
+    def tagvals(self, field):
+        return [source.encode() for source in self.sources]
+
+
+def test_missing_sources_are_the_tags_of_the_index_without_rollup():
+    client = fakeredis.FakeRedis()
+    client.ft = lambda name: _Index(["netflix", "spotify"])
+    builder = RollupBuilder("spotify")
+    builder.add(_frame([("Great app", "2023-05-06", 5, 1, "Saturday")]))
+    write_rollup(client, "reviews-1", "spotify", builder.rollup())
+    rollups = load_rollups(client, "reviews-1")
+
+    assert has_rollup(client, "reviews-1", "spotify")
+    assert not has_rollup(client, "reviews-1", "netflix")
+    assert missing_sources(client, "reviews-1", rollups) == {"netflix"}
@@ -0,0 +1,429 @@
+import asyncio
+import json
+import threading
+
+import httpx
+import pytest
+from langchain_core.documents import Document
+
+import server
+from src.admission import Backend
+
+
+class FakeOllama:
+    """
+    Stand-in for the Ollama calls of the server: classification, embedding and streamed answers.
+
+    While blocked, every classification waits until unblock is called, so requests can be held in
+    service, and while blocked_sub_questions is set only the classifications of sub-questions. If fail is set, classifications raise it, and if fail_stream is set, answer streams
+    raise it after their first token. Questions containing 'and' are compound, split into
+    sub_questions, and the classification of the sub-questions in failing raises.
+    """
+
+    def __init__(self):
+        self.blocked = False
+        self.blocked_sub_questions = False
+        self.fail = None
+        self.failing = set()
+        self.sub_questions = ["What is great?", "How many reviews are there?"]
+        self.fail_stream = None
+        self.hang_stream = False
+        self._unblocked = asyncio.Event()
+
+    def unblock(self):
+        self._unblocked.set()
+
+    async def classify_question(self, question):
+        if self.blocked or (
+            self.blocked_sub_questions and question in self.sub_questions
+        ):
+            await self._unblocked.wait()
+        if self.fail is not None:
+            raise self.fail
+        if question in self.failing:
+            raise RuntimeError(f"cannot classify {question}")
+        if " and " in question:
+            return "Compound"
+        return "Qualitative" if question.startswith("What") else "Quantitative"
+
+    async def decompose_question(self, question):
+        return self.sub_questions
+
+    async def embed_query(self, text):
+        return [0.1, 0.2, 0.3]
+
+    async def generate_quantitative_query(self, question):
+        return "@source:{spotify}"
+
+    async def _stream(self, key, tokens):
+        for position, token in enumerate(tokens):
+            if position == 1 and self.fail_stream is not None:
+                raise self.fail_stream
+            if position == 1 and self.hang_stream:
+                await asyncio.Event().wait()
+            yield {key: token} if key == "answer" else {"message": {"content": token}}
+
+    async def rephrase_answer(self, question, answer):
+        return self._stream("message", [f"There are {answer}", " reviews."])
+
+    async def rag_answer(self, question, context):
+        return self._stream("answer", ["Users like", " playlists."])
+
+
+class FakeRedis:
+    """
+    Stand-in for the Redis searches of the server.
+    """
+
+    def __init__(self):
+        self.documents = [
+            Document(page_content="Great playlists", metadata={"id": "doc:1"}),
+            Document(page_content="Love the mixes", metadata={"id": "doc:2"}),
+        ]
+        self.filters = []
+
+    async def search_nearest(self, vector, filter_expression="*"):
+        self.filters.append(filter_expression)
+        return self.documents
+
+    async def execute_quantitative_query(self, query):
+        return "42"
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    ollama, redis = FakeOllama(), FakeRedis()
+    monkeypatch.setattr(
+        server,
+        "backends",
+        {"ollama": Backend("ollama", 2, 1), "redis": Backend("redis", 4, 4)},
+    )
+    for name in (
+        "classify_question",
+        "decompose_question",
+        "embed_query",
+        "generate_quantitative_query",
+        "rephrase_answer",
+        "rag_answer",
+    ):
+        monkeypatch.setattr(server, name, getattr(ollama, name))
+    for name in ("search_nearest", "execute_quantitative_query"):
+        monkeypatch.setattr(server, name, getattr(redis, name))
+    monkeypatch.setattr(server, "question_filters", lambda question: "*")
+    return ollama, redis
+
+
+def _run(coroutine):
+    # A slot that is never released blocks the next request, fail instead of hanging
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=5))
+
+
+def _client():
+    transport = httpx.ASGITransport(app=server.app, raise_app_exceptions=False)
+    return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+
+async def _ask(client, question):
+    return await client.post("/ask", json={"question": question})
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+async def _wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError("condition not reached")
+
+
+def test_streams_qualitative_answer_as_ndjson_in_order(fakes):
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "What do users like about Spotify?")
+
+    response = _run(run())
+    lines = _lines(response)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [line["type"] for line in lines] == [
+        "meta",
+        "context",
+        "token",
+        "token",
+        "done",
+    ]
+    assert lines[0]["question_class"] == "qualitative"
+    assert lines[0]["queue_position"] == 0
+    assert [doc["content"] for doc in lines[1]["documents"]] == [
+        "Great playlists",
+        "Love the mixes",
+    ]
+    assert [line["content"] for line in lines[2:4]] == ["Users like", " playlists."]
+    assert server.backends["ollama"].in_service == 0
+    assert server.backends["redis"].stats()["admitted"] == 1
+
+
+def test_streams_quantitative_answer_without_context(fakes):
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "How many Spotify reviews are there?")
+
+    lines = _lines(_run(run()))
+
+    assert [line["type"] for line in lines] == ["meta", "token", "token", "done"]
+    assert lines[0]["question_class"] == "quantitative"
+    assert lines[1]["content"] == "There are 42"
+
+
+def test_rejects_empty_questions(fakes):
+    async def run():
+        async with _client() as client:
+            return await client.post("/ask", json={"question": " "})
+
+    assert _run(run()).status_code == 400
+
+
+@pytest.mark.parametrize("body", [b"{not json", b"\xff", b'["question"]', b"null"])
+def test_rejects_bodies_that_are_not_json_objects(fakes, body):
+    async def run():
+        async with _client() as client:
+            return await client.post(
+                "/ask", content=body, headers={"content-type": "application/json"}
+            )
+
+    response = _run(run())
+
+    assert response.status_code == 400
+    assert "error" in response.json()
+
+
+def test_admits_up_to_the_concurrency_limit_and_queues_the_rest(fakes):
+    ollama, _ = fakes
+    ollama.blocked = True
+    backend = server.backends["ollama"]
+
+    async def run():
+        async with _client() as client:
+            admitted = [
+                asyncio.create_task(_ask(client, "What is great?")) for _ in range(2)
+            ]
+            await _wait_until(lambda: backend.in_service == 2)
+            queued = asyncio.create_task(_ask(client, "What is bad?"))
+            await _wait_until(lambda: backend.waiting == 1)
+            assert backend.in_service == 2
+            ollama.unblock()
+            return await asyncio.gather(*admitted, queued)
+
+    responses = _run(run())
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert _lines(responses[2])[0]["queue_position"] == 1
+    assert backend.in_service == 0
+    assert backend.stats()["admitted"] == 3
+
+
+def test_rejects_with_queue_position_once_the_queue_is_full(fakes):
+    ollama, _ = fakes
+    ollama.blocked = True
+    backend = server.backends["ollama"]
+
+    async def run():
+        async with _client() as client:
+            pending = [
+                asyncio.create_task(_ask(client, "What is great?")) for _ in range(2)
+            ]
+            await _wait_until(lambda: backend.in_service == 2)
+            pending.append(asyncio.create_task(_ask(client, "What is bad?")))
+            await _wait_until(lambda: backend.waiting == 1)
+            rejected = await _ask(client, "What is new?")
+            ollama.unblock()
+            return rejected, await asyncio.gather(*pending)
+
+    rejected, responses = _run(run())
+
+    assert rejected.status_code == 429
+    assert rejected.headers["retry-after"] == "1"
+    assert rejected.json()["backend"] == "ollama"
+    assert rejected.json()["queue_position"] == 2
+    assert rejected.json()["queue_size"] == 1
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert backend.stats()["rejected"] == 1
+    assert backend.in_service == 0
+
+
+def test_releases_the_slot_when_the_answer_fails(fakes):
+    ollama, _ = fakes
+    ollama.fail = RuntimeError("ollama is down")
+
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "What is great?")
+
+    response = _run(run())
+
+    assert response.status_code == 500
+    assert server.backends["ollama"].in_service == 0
+    assert server.backends["ollama"].queue_position() == 0
+
+
+def test_releases_the_slot_when_the_stream_fails(fakes):
+    ollama, _ = fakes
+    ollama.fail_stream = RuntimeError("connection reset")
+
+    async def run():
+        async with _client() as client:
+            try:
+                await _ask(client, "What is great?")
+            except httpx.HTTPError:
+                pass
+
+    _run(run())
+
+    assert server.backends["ollama"].in_service == 0
+    assert server.backends["redis"].in_service == 0
+
+
+def test_releases_the_slot_when_the_client_disconnects(fakes):
+    ollama, _ = fakes
+    ollama.hang_stream = True
+    backend = server.backends["ollama"]
+
+    async def run():
+        disconnected = asyncio.Event()
+        messages = []
+        request = [
+            {
+                "type": "http.request",
+                "body": json.dumps({"question": "What is great?"}).encode(),
+                "more_body": False,
+            }
+        ]
+
+        async def receive():
+            if request:
+                return request.pop()
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            # Hang up once the first token arrived, while the answer is still streamed
+            if b'"token"' in message.get("body", b""):
+                disconnected.set()
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/ask",
+            "raw_path": b"/ask",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("test", 1),
+            "server": ("test", 80),
+        }
+        await server.app(scope, receive, send)
+        return messages
+
+    messages = _run(run())
+    bodies = b"".join(message.get("body", b"") for message in messages)
+
+    assert b'"done"' not in bodies
+    assert backend.in_service == 0
+    assert backend.queue_position() == 0
+
+
+def test_compound_question_holds_a_slot_per_sub_question(fakes):
+    ollama, _ = fakes
+    ollama.blocked_sub_questions = True
+    backend = server.backends["ollama"]
+
+    async def run():
+        async with _client() as client:
+            compound = asyncio.create_task(_ask(client, "What is great and how many?"))
+            await _wait_until(lambda: backend.in_service == 2)
+            # The sub-questions hold both slots, so the next request has to wait
+            queued = asyncio.create_task(_ask(client, "What is bad?"))
+            await _wait_until(lambda: backend.waiting == 1)
+            assert backend.in_service == 2
+            ollama.unblock()
+            return await asyncio.gather(compound, queued)
+
+    compound, queued = _run(run())
+    lines = _lines(compound)
+    tokens = "".join(line["content"] for line in lines if line["type"] == "token")
+
+    assert compound.status_code == 200
+    assert lines[0]["question_class"] == "compound"
+    assert tokens.index("**What is great?**") < tokens.index("Users like")
+    assert tokens.index("Users like") < tokens.index("**How many reviews are there?**")
+    assert tokens.endswith("There are 42 reviews.")
+    assert queued.status_code == 200
+    assert backend.in_service == 0
+    assert backend.stats()["admitted"] == 4
+
+
+def test_compound_question_cancels_the_other_parts_when_one_fails(fakes):
+    ollama, _ = fakes
+    ollama.hang_stream = True
+    ollama.failing = {"How many reviews are there?"}
+    backend = server.backends["ollama"]
+
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "What is great and how many?")
+
+    response = _run(run())
+
+    assert response.status_code == 500
+    assert backend.in_service == 0
+    assert server.backends["redis"].in_service == 0
+
+
+def test_answers_unknown_classes_like_qualitative_questions(fakes, monkeypatch):
+    async def classify_question(question):
+        return "I am not sure."
+
+    monkeypatch.setattr(server, "classify_question", classify_question)
+
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "Is it good?")
+
+    lines = _lines(_run(run()))
+
+    assert lines[0]["question_class"] == "qualitative"
+    assert [line["type"] for line in lines] == [
+        "meta",
+        "context",
+        "token",
+        "token",
+        "done",
+    ]
+
+
+def test_extracts_filters_outside_of_the_event_loop(fakes, monkeypatch):
+    _, redis = fakes
+    threads = []
+
+    def question_filters(question):
+        threads.append(threading.current_thread())
+        return "@source:{spotify}"
+
+    monkeypatch.setattr(server, "question_filters", question_filters)
+    monkeypatch.setattr(server, "RETRIEVAL_PREFILTER", True)
+
+    async def run():
+        async with _client() as client:
+            return await _ask(client, "What do Spotify users like?")
+
+    assert _run(run()).status_code == 200
+    assert threads and threads[0] is not threading.main_thread()
+    assert redis.filters == ["@source:{spotify}"]
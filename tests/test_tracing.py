@@ -0,0 +1,68 @@
+import re
+
+import pytest
+
+from src import tracing
+
+
+@pytest.fixture
+def enabled_tracing():
+    tracing.enable(True)
+    tracing._histograms.clear()
+    yield
+    tracing._histograms.clear()
+    tracing.enable(False)
+
+
+def _samples(text: str, stage: str):
+    samples = {}
+    for line in text.splitlines():
+        match = re.fullmatch(
+            r"two_agent_stage_seconds_(\w+)\{stage=\""
+            + re.escape(stage)
+            + r"\"(?:,le=\"([^\"]+)\")?\} (\S+)",
+            line,
+        )
+        if match:
+            kind, bound, value = match.groups()
+            samples[(kind, bound)] = float(value)
+    return samples
+
+
+def test_values_beyond_the_last_bucket_are_counted_once(enabled_tracing):
+    tracing.record("classify", 0.001)
+    tracing.record("classify", 100.0)
+
+    samples = _samples(tracing.prometheus_text(), "classify")
+
+    assert samples[("count", None)] == 2
+    assert samples[("sum", None)] == pytest.approx(100.001)
+    assert samples[("bucket", "0.005")] == 1
+    assert samples[("bucket", "60")] == 1
+    assert samples[("bucket", "+Inf")] == 2
+
+
+def test_buckets_are_cumulative_and_end_with_inf(enabled_tracing):
+    for seconds in (0.01, 0.2, 0.2, 3.0):
+        tracing.record("retrieval.search", seconds)
+
+    samples = _samples(tracing.prometheus_text(), "retrieval.search")
+    bounds = [*tracing.BUCKETS["seconds"], "+Inf"]
+    buckets = [samples[("bucket", f"{bound}")] for bound in bounds]
+
+    assert len(buckets) == len(tracing.BUCKETS["seconds"]) + 1
+    assert buckets == sorted(buckets)
+    assert samples[("bucket", "0.01")] == 1
+    assert samples[("bucket", "0.25")] == 3
+    assert samples[("bucket", "5")] == 4
+    assert buckets[-1] == samples[("count", None)] == 4
+    assert samples[("sum", None)] == pytest.approx(3.41)
+
+
+def test_records_are_ignored_while_disabled():
+    tracing.enable(False)
+    tracing._histograms.clear()
+
+    tracing.record("classify", 1.0)
+
+    assert "classify" not in tracing.prometheus_text()